@@ -0,0 +1,78 @@
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.utils import timezone
+from django.utils.translation import ugettext as _
+
+from mailing.models import Message, MessageAuthor
+from .models import Participant, Room, Tag, Talk, Track
+from .planning import invalidate_schedule
+
+
+def create_talk_messages(conference, author, talks, subject, content):
+    """
+    Post a message from author on the conversation of each talk, and queue the
+    staff notifications of all of them at once.
+    `subject` and `content` are called with the talk to get the message texts.
+    """
+    author_type = ContentType.objects.get_for_model(author)
+    message_author, _created = MessageAuthor.objects.get_or_create(author_type=author_type, author_id=author.pk)
+    messages = [Message(thread_id=talk.conversation_id, author=message_author,
+                        subject=subject(talk), content=content(talk)) for talk in talks]
+    Message.objects.bulk_create(messages)
+    # primary keys are not set by bulk_create on every database backend
+    messages = Message.objects.filter(token__in=[message.token for message in messages])
+    sender = (author.get_full_name(), conference.contact_email)
+    if conference.reply_email:
+        reply_to = (str(conference), conference.reply_email)
+    else:
+        reply_to = None
+    message_id = '<{id}@%s>' % conference.site.domain
+    staff_dests = [(user, user.get_full_name(), user.email) for user in conference.staff.all()]
+    Message.objects.send_notifications([
+        (message, {'sender': sender, 'dests': staff_dests, 'reply_to': reply_to, 'message_id': message_id})
+        for message in messages
+    ])
+    return messages
+
+
+def apply_talk_actions(conference, author, talk_ids, decision=None, track=None, tag=None, room=None):
+    """
+    Apply the staff bulk actions of the talk list with set-based queries.
+    `track`, `tag` and `room` are slugs. Return the number of selected talks.
+    """
+    site = conference.site
+    talks = Talk.objects.filter(site=site, pk__in=talk_ids)
+    updates = dict()
+    if track:
+        updates['track'] = Track.objects.get(site=site, slug=track)
+    if room:
+        updates['room'] = Room.objects.get(site=site, slug=room)
+    if tag:
+        tag = Tag.objects.get(site=site, slug=tag)
+    with transaction.atomic():
+        if decision is not None:
+            changed = list(talks.exclude(accepted=decision).only('pk', 'title', 'conversation'))
+            if changed:
+                action = _('accepted') if decision else _('declined')
+                create_talk_messages(
+                    conference, author, changed,
+                    subject=lambda talk: _("[%(conference)s] The talk '%(talk)s' have been %(action)s") % {
+                        'conference': conference,
+                        'talk': talk,
+                        'action': action,
+                    },
+                    content=lambda talk: _('The talk has been %(action)s.') % {'action': action},
+                )
+                Talk.objects.filter(pk__in=[talk.pk for talk in changed]).update(accepted=decision, updated=timezone.now())
+                # queryset updates do not send the signals maintaining the counters
+                Participant.objects.filter(talk__in=changed).update_talk_counts()
+        if updates:
+            talks.update(updated=timezone.now(), **updates)
+        if tag:
+            through = Talk.tags.through
+            tagged = set(through.objects.filter(tag=tag, talk__in=talks).values_list('talk_id', flat=True))
+            through.objects.bulk_create([through(talk_id=talk_id, tag_id=tag.pk)
+                                         for talk_id in talks.values_list('pk', flat=True) if talk_id not in tagged])
+        # queryset updates and bulk inserts do not send the signals either
+        invalidate_schedule(site.pk)
+    return talks.count()
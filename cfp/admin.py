@@ -1,6 +1,7 @@
 from django.contrib import admin
 from django.contrib.sites.models import Site
 
+from .conflicts import warn_talk_conflicts
 from .mixins import OnSiteAdminMixin
 from .models import Conference, Participant, Talk, TalkCategory, Track, \
                     Vote, Volunteer, Activity, Tag
@@ -36,6 +37,10 @@ class TalkAdmin(OnSiteAdminMixin, admin.ModelAdmin):
         form.base_fields['category'].queryset = TalkCategory.objects.filter(site=request.conference.site)
         return form
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        warn_talk_conflicts(request, [form.instance])
+
 
 class VoteAdmin(admin.ModelAdmin):
     def get_queryset(self, request):
@@ -0,0 +1,114 @@
+"""
+Detection of the scheduling conflicts: talks overlapping in a room, and
+speakers giving overlapping talks.
+"""
+
+from django.contrib import messages
+from django.db.models import Q
+from django.utils.translation import ugettext as _
+
+from collections import defaultdict, namedtuple
+from heapq import heappush, heappop
+
+from .models import Talk
+
+
+Conflict = namedtuple('Conflict', ['kind', 'subject', 'talks'])
+
+ROOM = 'room'
+SPEAKER = 'speaker'
+
+
+def find_overlaps(intervals):
+    """
+    Return the pairs of items of overlapping (start, end, item) intervals,
+    sweeping the intervals by start date while keeping the ones not ended yet
+    in a heap: O(n log n + k) for n intervals and k overlapping pairs. Touching
+    intervals do not overlap.
+    """
+    overlaps = []
+    ongoing = []
+    for index, (start, end, item) in enumerate(sorted(intervals, key=lambda interval: interval[:2])):
+        while ongoing and ongoing[0][0] <= start:
+            heappop(ongoing)
+        overlaps += [(other, item) for _, _, other in ongoing]
+        heappush(ongoing, (end, index, item))
+    return overlaps
+
+
+def scheduled_talks(site):
+    """Talks of the staff schedule, with their computed end and speakers."""
+    return Talk.objects.filter(site=site).in_schedule()\
+                       .select_related('room').prefetch_related('speakers')
+
+
+def find_conflicts(talks):
+    """
+    Return the conflicts between talks annotated with their computed end
+    (see TalkQuerySet.with_schedule), ordered by date.
+    """
+    by_room = defaultdict(list)
+    by_speaker = defaultdict(list)
+    speakers = dict()
+    rooms = dict()
+    for talk in talks:
+        interval = (talk.start_date, talk.computed_end, talk)
+        rooms[talk.room_id] = talk.room
+        by_room[talk.room_id].append(interval)
+        for speaker in talk.speakers.all():
+            speakers[speaker.pk] = speaker
+            by_speaker[speaker.pk].append(interval)
+    conflicts = []
+    for room_id, intervals in by_room.items():
+        conflicts += [Conflict(ROOM, rooms[room_id], pair) for pair in find_overlaps(intervals)]
+    for speaker_id, intervals in by_speaker.items():
+        conflicts += [Conflict(SPEAKER, speakers[speaker_id], pair) for pair in find_overlaps(intervals)]
+    conflicts.sort(key=lambda conflict: (conflict.talks[0].start_date, conflict.kind, str(conflict.subject)))
+    return conflicts
+
+
+def get_conflicts(site):
+    return find_conflicts(scheduled_talks(site))
+
+
+def get_talk_conflicts(talk):
+    """Return the conflicts of a single talk, using the schedule indexes rather than the whole schedule."""
+    talk = scheduled_talks(talk.site_id).filter(pk=talk.pk).first()
+    if talk is None:
+        return []
+    others = scheduled_talks(talk.site_id).exclude(pk=talk.pk)\
+                         .filter(start_date__lt=talk.computed_end, computed_end__gt=talk.start_date)\
+                         .filter(Q(room=talk.room_id) | Q(speakers__in=talk.speakers.all()))\
+                         .distinct()
+    speakers = {speaker.pk: speaker for speaker in talk.speakers.all()}
+    conflicts = []
+    for other in others:
+        pair = tuple(sorted([talk, other], key=lambda t: (t.start_date, t.pk)))
+        if other.room_id == talk.room_id:
+            conflicts.append(Conflict(ROOM, talk.room, pair))
+        conflicts += [Conflict(SPEAKER, speakers[speaker.pk], pair)
+                      for speaker in other.speakers.all() if speaker.pk in speakers]
+    return conflicts
+
+
+def warn_talk_conflicts(request, talks):
+    """
+    Warn the staff about the conflicts of the given talks. Every view changing
+    the schedule calls it once the talks are saved.
+    """
+    talks = list(talks)
+    if len(talks) == 1:
+        conflicts = get_talk_conflicts(talks[0])
+    else:
+        talk_ids = {talk.pk for talk in talks}
+        conflicts = [conflict for conflict in get_conflicts(request.conference.site)
+                     if talk_ids.intersection(talk.pk for talk in conflict.talks)]
+    for conflict in conflicts:
+        if conflict.kind == ROOM:
+            message = _('"%(talk)s" overlaps with "%(other)s" in the room %(room)s.')
+        else:
+            message = _('"%(talk)s" overlaps with "%(other)s" of the speaker %(speaker)s.')
+        first, second = conflict.talks
+        messages.warning(request, message % {'talk': first, 'other': second,
+                                             'room': conflict.subject, 'speaker': conflict.subject})
+    return conflicts
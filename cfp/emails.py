@@ -5,75 +5,69 @@ from pprint import pformat
 from textwrap import indent
 
 from mailing.utils import send_message
-from .environment import TalkEnvironment, SpeakerEnvironment, VolunteerEnvironment
+from .environment import talk_context, speaker_context, volunteer_context, \
+                         talk_recipients, speaker_recipients, volunteer_recipients, \
+                         compile_template, render_template
 
 
-def talk_email_render_preview(talk, speaker, subject, body):
-    env = TalkEnvironment(talk, speaker)
+def render_preview(context, subject, body):
     try:
-        subject = env.from_string(subject).render()
+        subject = render_template(subject, context)
     except Exception:
         return _('There is an error in your subject template.')
     try:
-        body = env.from_string(body).render()
+        body = render_template(body, context)
     except Exception:
         return _('There is an error in your body template.')
-    context = {'talk': env.globals['talk'], 'speaker': env.globals['speaker']}
     preview = '<b>' + _('Environment:') + '</b>\n\n' + escape(indent(pformat(context, indent='2'), '  '))
     preview += '\n\n<b>' + _('Subject:') + '</b> ' + escape(subject) + '\n<b>' + _('Body:') + '</b>\n' + escape(body)
     return preview
 
 
+def talk_email_render_preview(talk, speaker, subject, body):
+    return render_preview(talk_context(talk, speaker), subject, body)
+
+
 def speaker_email_render_preview(speaker, subject, body):
-    env = SpeakerEnvironment(speaker)
-    try:
-        subject = env.from_string(subject).render()
-    except Exception:
-        return _('There is an error in your subject template.')
-    try:
-        body = env.from_string(body).render()
-    except Exception:
-        return _('There is an error in your body template.')
-    context = {'speaker': env.globals['speaker']}
-    preview = '<b>' + _('Environment:') + '</b>\n\n' + escape(indent(pformat(context, indent='2'), '  '))
-    preview += '\n\n<b>' + _('Subject:') + '</b> ' + escape(subject) + '\n<b>' + _('Body:') + '</b>\n' + escape(body)
-    return preview
+    return render_preview(speaker_context(speaker), subject, body)
 
 
 def volunteer_email_render_preview(volunteer, subject, body):
-    env = VolunteerEnvironment(volunteer)
-    try:
-        subject = env.from_string(subject).render()
-    except Exception:
-        return _('There is an error in your subject template.')
-    try:
-        body = env.from_string(body).render()
-    except Exception:
-        return _('There is an error in your body template.')
-    context = {'volunteer': env.globals['volunteer']}
-    preview = '<b>' + _('Environment:') + '</b>\n\n' + escape(indent(pformat(context, indent='2'), '  '))
-    preview += '\n\n<b>' + _('Subject:') + '</b> ' + escape(subject) + '\n<b>' + _('Body:') + '</b>\n' + escape(body)
-    return preview
+    return render_preview(volunteer_context(volunteer), subject, body)
+
+
+def talk_email_render(talks, subject, body):
+    subject, body = compile_template(subject), compile_template(body)
+    for talk, speaker in talk_recipients(talks):
+        context = talk_context(talk, speaker)
+        yield talk, speaker, subject.render(context), body.render(context)
+
+
+def speaker_email_render(speakers, subject, body):
+    subject, body = compile_template(subject), compile_template(body)
+    for speaker in speaker_recipients(speakers):
+        context = speaker_context(speaker)
+        yield speaker, subject.render(context), body.render(context)
+
+
+def volunteer_email_render(volunteers, subject, body):
+    subject, body = compile_template(subject), compile_template(body)
+    for volunteer in volunteer_recipients(volunteers):
+        context = volunteer_context(volunteer)
+        yield volunteer, subject.render(context), body.render(context)
 
 
 def talk_email_send(talks, subject, body):
     sent = 0
-    for talk in talks.all():
-        for speaker in talk.speakers.all():
-            env = TalkEnvironment(talk, speaker)
-            s = env.from_string(subject).render()
-            c = env.from_string(body).render()
-            send_message(speaker.conversation, talk.site.conference, subject=s, content=c)
-            sent += 1
+    for talk, speaker, s, c in talk_email_render(talks, subject, body):
+        send_message(speaker.conversation, talk.site.conference, subject=s, content=c)
+        sent += 1
     return sent
 
 
 def speaker_email_send(speakers, subject, body):
     sent = 0
-    for speaker in speakers.all():
-        env = SpeakerEnvironment(speaker)
-        s = env.from_string(subject).render()
-        c = env.from_string(body).render()
+    for speaker, s, c in speaker_email_render(speakers, subject, body):
         send_message(speaker.conversation, speaker.site.conference, subject=s, content=c)
         sent += 1
     return sent
@@ -81,10 +75,7 @@ def speaker_email_send(speakers, subject, body):
 
 def volunteer_email_send(volunteers, subject, body):
     sent = 0
-    for volunteer in volunteers.all():
-        env = VolunteerEnvironment(volunteer)
-        s = env.from_string(subject).render()
-        c = env.from_string(body).render()
+    for volunteer, s, c in volunteer_email_render(volunteers, subject, body):
         send_message(volunteer.conversation, volunteer.site.conference, subject=s, content=c)
         sent += 1
     return sent
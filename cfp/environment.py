@@ -1,10 +1,15 @@
 from django.conf import settings
 from django.urls import reverse
 
+from django.db.models import Prefetch
+
 from jinja2.sandbox import SandboxedEnvironment
 
+from functools import lru_cache
 import pytz
 
+from .models import Participant, Talk
+
 
 def talk_to_dict(talk, speaker):
     base_url = ('https' if talk.site.conference.secure_domain else 'http') + '://' + talk.site.domain
@@ -50,26 +55,57 @@ def volunteer_to_dict(volunteer):
     }
 
 
-class TalkEnvironment(SandboxedEnvironment):
-    def __init__(self, talk, speaker, **options):
-        super().__init__(**options)
-        self.globals.update({
-            'talk': talk_to_dict(talk, speaker),
-            'speaker': speaker_to_dict(speaker),
-        })
+def talk_context(talk, speaker):
+    return {
+        'talk': talk_to_dict(talk, speaker),
+        'speaker': speaker_to_dict(speaker),
+    }
 
 
-class SpeakerEnvironment(SandboxedEnvironment):
-    def __init__(self, speaker, **options):
-        super().__init__(**options)
-        self.globals.update({
-            'speaker': speaker_to_dict(speaker, include_talks=True),
-        })
+def speaker_context(speaker):
+    return {
+        'speaker': speaker_to_dict(speaker, include_talks=True),
+    }
 
 
-class VolunteerEnvironment(SandboxedEnvironment):
-    def __init__(self, volunteer, **options):
-        super().__init__(**options)
-        self.globals.update({
-            'volunteer': volunteer_to_dict(volunteer),
-        })
+def volunteer_context(volunteer):
+    return {
+        'volunteer': volunteer_to_dict(volunteer),
+    }
+
+
+def talk_recipients(talks):
+    """Yield (talk, speaker) couples, loading everything needed by talk_context() with a fixed number of queries."""
+    talks = talks.select_related('site__conference', 'category', 'track').prefetch_related(
+        Prefetch('speakers', queryset=Participant.objects.select_related('conversation')),
+    )
+    for talk in talks:
+        for speaker in talk.speakers.all():
+            yield talk, speaker
+
+
+def speaker_recipients(speakers):
+    """Yield speakers, loading everything needed by speaker_context() with a fixed number of queries."""
+    return speakers.select_related('site__conference', 'conversation').prefetch_related(
+        Prefetch('talk_set', queryset=Talk.objects.select_related('site__conference', 'category', 'track')
+                                                  .prefetch_related('speakers')),
+    )
+
+
+def volunteer_recipients(volunteers):
+    """Yield volunteers, loading everything needed by volunteer_context() with a fixed number of queries."""
+    return volunteers.select_related('site__conference', 'conversation').prefetch_related('activities')
+
+
+# Templates are compiled once in a shared sandbox and then rendered with a
+# context for each recipient.
+env = SandboxedEnvironment()
+
+
+@lru_cache(maxsize=32)
+def compile_template(source):
+    return env.from_string(source)
+
+
+def render_template(source, context):
+    return compile_template(source).render(context)
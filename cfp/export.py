@@ -0,0 +1,42 @@
+import csv
+
+
+CHUNK_SIZE = 500
+
+
+class Echo:
+    """File-like object returning what is written, to use csv.writer with a generator."""
+    def write(self, value):
+        return value
+
+
+def iter_chunks(queryset, chunk_size=CHUNK_SIZE):
+    """
+    Iterate over a queryset keeping its ordering, but fetching objects (and their
+    prefetched relations) by chunks of chunk_size rows.
+    """
+    pks = list(queryset.values_list('pk', flat=True))
+    for i in range(0, len(pks), chunk_size):
+        chunk = pks[i:i+chunk_size]
+        objects = {obj.pk: obj for obj in queryset.filter(pk__in=chunk)}
+        for pk in chunk:
+            yield objects[pk]
+
+
+def iter_csv(rows):
+    writer = csv.writer(Echo())
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def talks_csv(talks, chunk_size=CHUNK_SIZE):
+    talks = talks.select_related('category', 'track', 'room').prefetch_related('speakers', 'tags')
+    return iter_csv(talk.get_csv_row() for talk in iter_chunks(talks, chunk_size))
+
+
+def participants_csv(participants, chunk_size=CHUNK_SIZE):
+    return iter_csv(participant.get_csv_row() for participant in iter_chunks(participants, chunk_size))
+
+
+def volunteers_csv(volunteers, chunk_size=CHUNK_SIZE):
+    return iter_csv(volunteer.get_csv_row() for volunteer in iter_chunks(volunteers, chunk_size))
@@ -0,0 +1,98 @@
+"""
+Synthetic conference data, used by the query budget tests and the views
+benchmark. Rows are inserted in bulk, so the signals maintaining the counters
+are replaced by a recomputation at the end.
+"""
+
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from datetime import timedelta
+from random import Random
+
+from mailing.models import Message, MessageAuthor, MessageThread
+from .models import Activity, Conference, Participant, Room, Tag, Talk, TalkCategory, Track, Volunteer, Vote
+
+
+def create_threads(count):
+    threads = [MessageThread() for _ in range(count)]
+    MessageThread.objects.bulk_create(threads)
+    # primary keys are not set by bulk_create on every database backend
+    return list(MessageThread.objects.filter(token__in=[thread.token for thread in threads]))
+
+
+def create_conference_data(site, talks=100, staff=5, messages=2, seed=0):
+    """
+    Fill the conference of a site with `talks` talks, two speakers for three
+    talks, a vote of each staff member on each talk, `messages` messages in
+    each talk conversation and some volunteers. Return the staff users.
+    """
+    rnd = Random(seed)
+    conference = Conference.objects.get(site=site)
+    start = timezone.now().replace(hour=9, minute=0, second=0, microsecond=0) + timedelta(days=30)
+
+    users = [User.objects.create_user('staff-%d-%d' % (site.pk, i), email='staff%d@example.org' % i, password='staff')
+             for i in range(staff)]
+    conference.staff.add(*users)
+    categories = [TalkCategory.objects.create(site=site, name=name, label=name.lower(), duration=duration)
+                  for name, duration in [('Conference', 30), ('Workshop', 120), ('Lightning talk', 5)]]
+    tracks = [Track.objects.create(site=site, name='Track %d' % i) for i in range(5)]
+    rooms = [Room.objects.create(site=site, name='Room %d' % i, capacity=100) for i in range(10)]
+    tags = [Tag.objects.create(site=site, name='Tag %d' % i, public=bool(i % 2), staff=bool(i % 3))
+            for i in range(10)]
+    activities = [Activity.objects.create(site=site, name='Activity %d' % i) for i in range(5)]
+
+    speaker_count = max(1, talks * 2 // 3)
+    threads = create_threads(speaker_count + talks + talks // 2)
+    participants = [Participant(site=site, name='Speaker %d' % i, email='speaker%d@example.org' % i,
+                                biography='Biography of speaker %d.' % i, conversation=threads.pop())
+                    for i in range(speaker_count)]
+    Participant.objects.bulk_create(participants)
+    participants = list(Participant.objects.filter(site=site))
+
+    talk_objects = []
+    for i in range(talks):
+        accepted = rnd.choice([None, True, True, False])
+        scheduled = accepted and rnd.random() < 0.8
+        talk_objects.append(Talk(
+            site=site, title='Talk %d' % i, description='Description of talk %d.' % i,
+            category=rnd.choice(categories), track=rnd.choice(tracks + [None]),
+            accepted=accepted, confirmed=rnd.choice([None, True]) if accepted else None,
+            room=rnd.choice(rooms) if scheduled else None,
+            start_date=start + timedelta(days=rnd.randrange(3), minutes=15 * rnd.randrange(40)) if scheduled else None,
+            duration=rnd.choice([0, 20, 45]), conversation=threads.pop(),
+        ))
+    Talk.objects.bulk_create(talk_objects)
+    talk_objects = list(Talk.objects.filter(site=site))
+
+    Talk.speakers.through.objects.bulk_create([
+        Talk.speakers.through(talk_id=talk.pk, participant_id=participant.pk)
+        for talk in talk_objects for participant in rnd.sample(participants, min(len(participants), rnd.choice([1, 1, 2])))
+    ])
+    Talk.tags.through.objects.bulk_create([
+        Talk.tags.through(talk_id=talk.pk, tag_id=tag.pk)
+        for talk in talk_objects for tag in rnd.sample(tags, rnd.randrange(3))
+    ])
+    Vote.objects.bulk_create([Vote(talk=talk, user=user, vote=rnd.randint(-2, 2))
+                              for talk in talk_objects for user in users])
+
+    authors = MessageAuthor.objects.get_for_objects(users + participants)
+    author_list = list(authors.values())
+    Message.objects.bulk_create([
+        Message(thread_id=talk.conversation_id, author=rnd.choice(author_list),
+                subject='Message %d' % i, content='Content of the message.')
+        for talk in talk_objects for i in range(messages)
+    ])
+
+    volunteers = [Volunteer(site=site, name='Volunteer %d' % i, email='volunteer%d@example.org' % i,
+                            conversation=threads.pop())
+                  for i in range(talks // 2)]
+    Volunteer.objects.bulk_create(volunteers)
+    Volunteer.activities.through.objects.bulk_create([
+        Volunteer.activities.through(volunteer_id=volunteer.pk, activity_id=activity.pk)
+        for volunteer in Volunteer.objects.filter(site=site) for activity in rnd.sample(activities, rnd.randrange(3))
+    ])
+
+    Participant.objects.filter(site=site).update_talk_counts()
+    Talk.objects.filter(site=site).update_votes()
+    return users
@@ -11,7 +11,8 @@ from django_select2.forms import ModelSelect2MultipleWidget
 
 from .models import Participant, Talk, TalkCategory, Track, Tag, \
                     Conference, Room, Volunteer, Activity
-from .environment import TalkEnvironment, SpeakerEnvironment, VolunteerEnvironment
+from .environment import talk_context, speaker_context, volunteer_context, \
+                         talk_recipients, speaker_recipients, volunteer_recipients, render_template
 
 
 ACCEPTATION_CHOICES = [
@@ -316,14 +317,11 @@ class SendTalkMailForm(SendMailForm):
     def __init__(self, *args, **kwargs):
         self._talks = kwargs.pop('talks')
         super().__init__(*args, **kwargs)
-        self._env = dict()
 
     def clean_template(self, template):
         try:
-            for talk in self._talks.all():
-                for speaker in talk.speakers.all():
-                    env = self._env.get((talk, speaker), TalkEnvironment(talk, speaker))
-                    env.from_string(self.cleaned_data.get(template)).render()
+            for talk, speaker in talk_recipients(self._talks):
+                render_template(self.cleaned_data.get(template), talk_context(talk, speaker))
         except Exception as e:
             raise forms.ValidationError(_("Your template does not compile (at least) with talk '%(talk)s' and speaker '%(speaker)s'.") %
                         {'talk': talk, 'speaker': speaker})
@@ -334,13 +332,11 @@ class SendSpeakerMailForm(SendMailForm):
     def __init__(self, *args, **kwargs):
         self._speakers = kwargs.pop('speakers')
         super().__init__(*args, **kwargs)
-        self._env = dict()
 
     def clean_template(self, template):
         try:
-            for speaker in self._speakers.all():
-                env = self._env.get(speaker, SpeakerEnvironment(speaker))
-                env.from_string(self.cleaned_data.get(template)).render()
+            for speaker in speaker_recipients(self._speakers):
+                render_template(self.cleaned_data.get(template), speaker_context(speaker))
         except Exception as e:
             raise forms.ValidationError(_("Your template does not compile (at least) with speaker '%(speaker)s'.") %
                         {'speaker': speaker})
@@ -351,13 +347,11 @@ class SendVolunteerMailForm(SendMailForm):
     def __init__(self, *args, **kwargs):
         self._volunteers = kwargs.pop('volunteers')
         super().__init__(*args, **kwargs)
-        self._env = dict()
 
     def clean_template(self, template):
         try:
-            for volunteer in self._volunteers.all():
-                env = self._env.get(volunteer, VolunteerEnvironment(volunteer))
-                env.from_string(self.cleaned_data.get(template)).render()
+            for volunteer in volunteer_recipients(self._volunteers):
+                render_template(self.cleaned_data.get(template), volunteer_context(volunteer))
         except Exception as e:
             raise forms.ValidationError(_("Your template does not compile (at least) with volunteer '%(volunteer)s'.") %
                         {'volunteer': volunteer})
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.sites.models import Site
+from django.conf import settings
+from django.utils.timezone import localtime
+
+from cfp.conflicts import get_conflicts
+
+
+class Command(BaseCommand):
+    help = 'List the talks overlapping in a room or for a speaker'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--site', help='Domain or id of the site (default: SITE_ID)')
+
+    def handle(self, *args, **options):
+        site = options['site'] or getattr(settings, 'SITE_ID', 1)
+        try:
+            if str(site).isdigit():
+                site = Site.objects.get(pk=site)
+            else:
+                site = Site.objects.get(domain=site)
+        except Site.DoesNotExist:
+            raise CommandError('Site "%s" does not exist' % site)
+        conflicts = get_conflicts(site)
+        for conflict in conflicts:
+            first, second = conflict.talks
+            self.stdout.write('%s %s: "%s" (%s - %s) and "%s" (%s - %s)' % (
+                conflict.kind, conflict.subject,
+                first, localtime(first.start_date), localtime(first.computed_end).strftime('%H:%M'),
+                second, localtime(second.start_date), localtime(second.computed_end).strftime('%H:%M'),
+            ))
+        self.stdout.write('%d conflict(s)' % len(conflicts))
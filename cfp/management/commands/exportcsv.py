@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.sites.models import Site
+from django.conf import settings
+
+from cfp.models import Participant, Talk, Volunteer
+from cfp.export import talks_csv, participants_csv, volunteers_csv
+
+
+EXPORTS = {
+    'talks': lambda site: talks_csv(Talk.objects.filter(site=site)),
+    'participants': lambda site: participants_csv(Participant.objects.filter(site=site)
+                                                  .extra(select={'lower_name': 'lower(name)'})
+                                                  .order_by('lower_name')),
+    'volunteers': lambda site: volunteers_csv(Volunteer.objects.filter(site=site).order_by('pk')),
+}
+
+
+class Command(BaseCommand):
+    help = 'Export talks, participants or volunteers of a site as CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('export', choices=sorted(EXPORTS.keys()))
+        parser.add_argument('--site', help='Domain or id of the site (default: SITE_ID)')
+        parser.add_argument('--output', help='Output file (default: standard output)')
+
+    def handle(self, *args, **options):
+        site = options['site'] or getattr(settings, 'SITE_ID', 1)
+        try:
+            if str(site).isdigit():
+                site = Site.objects.get(pk=site)
+            else:
+                site = Site.objects.get(domain=site)
+        except Site.DoesNotExist:
+            raise CommandError('Site "%s" does not exist' % site)
+        rows = EXPORTS[options['export']](site)
+        if options['output']:
+            with open(options['output'], 'w', newline='') as f:
+                f.writelines(rows)
+        else:
+            for row in rows:
+                self.stdout.write(row, ending='')
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cfp.models import Conference
+from cfp.planning import write_schedule_snapshots, delete_schedule_snapshots
+
+
+class Command(BaseCommand):
+    help = 'Write the public schedule of the conferences to static files under MEDIA_ROOT'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--site', help='Domain or id of the site (default: all sites)')
+
+    def handle(self, *args, **options):
+        conferences = Conference.objects.select_related('site')
+        site = options['site']
+        if site:
+            if str(site).isdigit():
+                conferences = conferences.filter(site__pk=site)
+            else:
+                conferences = conferences.filter(site__domain=site)
+            if not conferences.exists():
+                raise CommandError('Site "%s" does not exist' % site)
+        for conference in conferences:
+            if conference.schedule_available:
+                write_schedule_snapshots(conference)
+                self.stdout.write('%s: schedule written' % conference.site.domain)
+            else:
+                delete_schedule_snapshots(conference.site_id)
+                self.stdout.write('%s: schedule not published' % conference.site.domain)
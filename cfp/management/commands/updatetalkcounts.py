@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from cfp.models import Participant
+
+
+class Command(BaseCommand):
+    help = 'Recompute the accepted, pending and refused talk counts of the participants'
+
+    def handle(self, *args, **options):
+        count = Participant.objects.all().update_talk_counts()
+        self.stdout.write('%d participant(s) updated' % count)
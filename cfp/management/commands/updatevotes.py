@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from cfp.models import Talk
+
+
+class Command(BaseCommand):
+    help = 'Recompute the vote count and sum of the talks'
+
+    def handle(self, *args, **options):
+        count = Talk.objects.all().update_votes()
+        self.stdout.write('%d talk(s) updated' % count)
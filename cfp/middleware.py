@@ -1,6 +1,78 @@
 from django.contrib.sites.shortcuts import get_current_site
+from django.core.cache import cache
+from django.db import transaction
+
+from django.contrib.sites.models import Site
+
+from collections import Counter
+from uuid import uuid4
 
 from .models import Conference
+from .utils import get_staff_ids
+
+
+CONFERENCE_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Process-local copies of the conferences, indexed by site id. Each entry is
+# tagged with the version stored in the shared cache: any worker can invalidate
+# the copies of the other workers by deleting this version.
+# Only the field values and the staff ids are cached, not the model instances.
+_local_conferences = dict()
+
+conference_cache_stats = Counter(local_hits=0, shared_hits=0, misses=0)
+
+
+def _version_key(site_id):
+    return 'ponyconf-conference-version-%d' % site_id
+
+
+def _conference_key(site_id, version):
+    return 'ponyconf-conference-%d-%s' % (site_id, version)
+
+
+def _field_values(instance):
+    return tuple(getattr(instance, field.attname) for field in instance._meta.concrete_fields)
+
+
+def _from_field_values(model, values):
+    return model.from_db('default', [field.attname for field in model._meta.concrete_fields], values)
+
+
+def get_conference(site):
+    version = cache.get(_version_key(site.pk))
+    if version is None:
+        version = uuid4().hex
+        if not cache.add(_version_key(site.pk), version, None):
+            version = cache.get(_version_key(site.pk), version)
+    local = _local_conferences.get(site.pk)
+    if local is not None and local[0] == version:
+        conference_cache_stats['local_hits'] += 1
+        data = local[1]
+    else:
+        data = cache.get(_conference_key(site.pk, version))
+        if data is None:
+            conference_cache_stats['misses'] += 1
+            conference = Conference.objects.select_related('site').get(site=site)
+            data = (_field_values(conference), _field_values(conference.site), get_staff_ids(conference))
+            cache.set(_conference_key(site.pk, version), data, CONFERENCE_CACHE_TIMEOUT)
+        else:
+            conference_cache_stats['shared_hits'] += 1
+        _local_conferences[site.pk] = (version, data)
+    # each request gets its own instance, as views may modify it
+    conference_values, site_values, staff_ids = data
+    conference = _from_field_values(Conference, conference_values)
+    conference.site = _from_field_values(Site, site_values)
+    conference.staff_ids = staff_ids
+    return conference
+
+
+def invalidate_conference(site_id):
+    def invalidate():
+        _local_conferences.pop(site_id, None)
+        cache.delete(_version_key(site_id))
+    invalidate()
+    # prevent concurrent requests from caching data about to be replaced
+    transaction.on_commit(invalidate)
 
 
 class ConferenceMiddleware:
@@ -12,5 +84,4 @@ class ConferenceMiddleware:
 
     def process_view(self, request, view, view_args, view_kwargs):
         site = get_current_site(request)
-        conf = Conference.objects.select_related('site').prefetch_related('staff').get(site=site)
-        request.conference = conf
+        request.conference = get_conference(site)
@@ -0,0 +1,41 @@
+# Generated by Django 2.0.13 on 2026-10-18 09:18
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def compute_talk_counts(apps, schema_editor):
+    Participant = apps.get_model("cfp", "Participant")
+    Talk = apps.get_model("cfp", "Talk")
+    db_alias = schema_editor.connection.alias
+    talks = Talk.speakers.through.objects.using(db_alias)
+    for field, accepted in [('accepted_talk_count', True), ('pending_talk_count', None), ('refused_talk_count', False)]:
+        counts = talks.filter(talk__accepted=accepted).values_list('participant').annotate(count=Count('talk'))
+        for participant_id, count in counts:
+            Participant.objects.using(db_alias).filter(pk=participant_id).update(**{field: count})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cfp', '0026_conference_end_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='participant',
+            name='accepted_talk_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='participant',
+            name='pending_talk_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='participant',
+            name='refused_talk_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(compute_talk_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 2.0.13 on 2026-10-18 09:20
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def compute_votes(apps, schema_editor):
+    Talk = apps.get_model("cfp", "Talk")
+    Vote = apps.get_model("cfp", "Vote")
+    db_alias = schema_editor.connection.alias
+    votes = Vote.objects.using(db_alias).values_list('talk').annotate(count=Count('pk'), sum=Sum('vote'))
+    for talk_id, count, total in votes:
+        Talk.objects.using(db_alias).filter(pk=talk_id).update(vote_count=count, vote_sum=total)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cfp', '0027_participant_talk_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='talk',
+            name='vote_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='talk',
+            name='vote_sum',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(compute_votes, migrations.RunPython.noop),
+    ]
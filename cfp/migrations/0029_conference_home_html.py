@@ -0,0 +1,29 @@
+# Generated by Django 2.0.13 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+from ponyconf.utils import render_markdown
+
+
+def render_home(apps, schema_editor):
+    Conference = apps.get_model("cfp", "Conference")
+    db_alias = schema_editor.connection.alias
+    for conference in Conference.objects.using(db_alias).exclude(home=''):
+        conference.home_html = render_markdown(conference.home)
+        conference.save(update_fields=['home_html'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cfp', '0028_talk_votes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conference',
+            name='home_html',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.RunPython(render_home, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.0.13 on 2026-10-18 09:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cfp', '0029_conference_home_html'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='talk',
+            index=models.Index(fields=['room', 'start_date'], name='cfp_talk_room_id_b5fc5e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='talk',
+            index=models.Index(fields=['site', 'start_date'], name='cfp_talk_site_id_2446ed_idx'),
+        ),
+    ]
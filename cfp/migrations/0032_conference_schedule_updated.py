@@ -0,0 +1,19 @@
+# Generated by Django 2.0.13 on 2026-10-18 10:16
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cfp', '0030_talk_schedule_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conference',
+            name='schedule_updated',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -4,7 +4,7 @@ from django.urls import reverse
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.core.exceptions import ValidationError
 from django.db import models
-from django.db.models import Q, Count, Avg, Case, When
+from django.db.models import Q, F, Count, Sum, Case, When, OuterRef, Subquery
 from django.db.models.functions import Coalesce
 from django.utils import timezone
 from django.utils.translation import ugettext, ugettext_lazy as _
@@ -19,7 +19,7 @@ import uuid
 from datetime import timedelta
 from os.path import join, basename
 
-from ponyconf.utils import PonyConfModel
+from ponyconf.utils import CounterFieldsMixin, PonyConfModel, markdown_to_html
 from mailing.models import MessageThread
 
 
@@ -29,6 +29,7 @@ class Conference(models.Model):
 
     name = models.CharField(blank=True, max_length=100, verbose_name=_('Conference name'))
     home = models.TextField(blank=True, default="", verbose_name=_('Homepage (markdown)'))
+    home_html = models.TextField(blank=True, default="", editable=False)
     venue = models.TextField(blank=True, default="", verbose_name=_('Venue information'))
     city = models.CharField(max_length=64, blank=True, default="", verbose_name=_('City'))
     contact_email = models.CharField(max_length=100, blank=True, verbose_name=_('Contact email'))
@@ -46,6 +47,8 @@ class Conference(models.Model):
 
     custom_css = models.TextField(blank=True)
     external_css_link = models.URLField(blank=True)
+    # date of the last change of the schedule, see cfp.planning.invalidate_schedule
+    schedule_updated = models.DateTimeField(default=timezone.now, editable=False)
 
     def volunteers_enrollment_is_open(self):
         now = timezone.now()
@@ -90,22 +93,44 @@ class Conference(models.Model):
                     'reply_email': _('The reply email should be a formatable string accepting a token argument (e.g. ponyconf+{token}@exemple.com).'),
                 })
 
+    def save(self, *args, **kwargs):
+        # render the homepage once here rather than on each view
+        self.home_html = markdown_to_html(self.home)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'home' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'home_html'}
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return self.name
 
 
-class ParticipantManager(models.Manager):
-    def get_queryset(self):
-        qs = super().get_queryset()
-        qs = qs.annotate(
-            accepted_talk_count=Count(Case(When(talk__accepted=True, then='talk__pk'), output_field=models.IntegerField()), distinct=True),
-            pending_talk_count=Count(Case(When(talk__accepted=None, then='talk__pk'), output_field=models.IntegerField()), distinct=True),
-            refused_talk_count=Count(Case(When(talk__accepted=False, then='talk__pk'), output_field=models.IntegerField()), distinct=True),
+class ParticipantQuerySet(models.QuerySet):
+    def with_live_talk_counts(self):
+        """
+        Annotate the talk counts computed from the talks themselves. This costs a
+        GROUP BY over the talks join: prefer the maintained *_talk_count fields.
+        """
+        return self.annotate(
+            live_accepted_talk_count=Count(Case(When(talk__accepted=True, then='talk__pk'), output_field=models.IntegerField()), distinct=True),
+            live_pending_talk_count=Count(Case(When(talk__accepted=None, then='talk__pk'), output_field=models.IntegerField()), distinct=True),
+            live_refused_talk_count=Count(Case(When(talk__accepted=False, then='talk__pk'), output_field=models.IntegerField()), distinct=True),
+        )
+
+    def update_talk_counts(self):
+        """Recompute the maintained talk counts of the participants."""
+        def talk_count(accepted):
+            talks = Talk.speakers.through.objects.filter(participant=OuterRef('pk'), talk__accepted=accepted)
+            talks = talks.values('participant').annotate(count=Count('talk')).values('count')
+            return Coalesce(Subquery(talks, output_field=models.IntegerField()), 0)
+        return self.update(
+            accepted_talk_count=talk_count(True),
+            pending_talk_count=talk_count(None),
+            refused_talk_count=talk_count(False),
         )
-        return qs
 
 
-class Participant(PonyConfModel):
+class Participant(CounterFieldsMixin, PonyConfModel):
     site = models.ForeignKey(Site, on_delete=models.CASCADE)
     name = models.CharField(max_length=128, verbose_name=_('Name'))
     email = models.EmailField()
@@ -123,8 +148,13 @@ class Participant(PonyConfModel):
                              help_text=_('This field is only visible by organizers.'))
     vip = models.BooleanField(default=False, verbose_name=_('Invited speaker'))
     conversation = models.OneToOneField(MessageThread, on_delete=models.PROTECT)
+    # maintained by signals, see ParticipantQuerySet.update_talk_counts
+    accepted_talk_count = models.PositiveIntegerField(default=0, editable=False)
+    pending_talk_count = models.PositiveIntegerField(default=0, editable=False)
+    refused_talk_count = models.PositiveIntegerField(default=0, editable=False)
 
-    objects = ParticipantManager()
+    objects = ParticipantQuerySet.as_manager()
+    counter_fields = ('accepted_talk_count', 'pending_talk_count', 'refused_talk_count')
 
     def get_absolute_url(self):
         return reverse('participant-details', kwargs={'participant_id': self.pk})
@@ -161,6 +191,43 @@ class Participant(PonyConfModel):
         return self.talk_set.filter(accepted=False)
 
 
+class Minutes(models.Func):
+    """Duration of a number of minutes, to be added to a date."""
+    output_field = models.DurationField()
+
+    def as_sql(self, compiler, connection):
+        if connection.features.has_native_duration_field:
+            template = "(%(expressions)s * INTERVAL '1 minute')"
+        else: # durations are stored in microseconds
+            template = '(%(expressions)s * 60000000)'
+        return super().as_sql(compiler, connection, template=template)
+
+
+def talk_duration(prefix=''):
+    """
+    Expression of the estimated duration of a talk: its own duration, or the
+    default duration of its category when not set, like Talk.estimated_duration.
+    `prefix` is the path to the talk, e.g. 'talk__' from a track.
+    """
+    return Case(When(**{prefix + 'duration': 0, 'then': F(prefix + 'category__duration')}),
+                default=F(prefix + 'duration'), output_field=models.PositiveIntegerField())
+
+
+class TrackQuerySet(models.QuerySet):
+    def with_statistics(self):
+        """
+        Annotate the number of talks (total, accepted and pending) and their
+        total and scheduled duration, in minutes.
+        """
+        return self.annotate(
+            talk_count=Count('talk'),
+            accepted_talk_count=Count('talk', filter=Q(talk__accepted=True)),
+            pending_talk_count=Count('talk', filter=Q(talk__accepted__isnull=True)),
+            total_duration=Coalesce(Sum(talk_duration('talk__')), 0),
+            scheduled_duration=Coalesce(Sum(talk_duration('talk__'), filter=Q(talk__start_date__isnull=False)), 0),
+        )
+
+
 class Track(PonyConfModel):
     site = models.ForeignKey(Site, on_delete=models.CASCADE)
     name = models.CharField(max_length=128, verbose_name=_('Name'))
@@ -169,12 +236,14 @@ class Track(PonyConfModel):
 
     #managers = models.ManyToManyField(User, blank=True, verbose_name=_('Managers'))
 
+    objects = TrackQuerySet.as_manager()
+
     class Meta:
         unique_together = ('site', 'name')
         ordering = ['name']
 
     def estimated_duration(self):
-        return sum([talk.estimated_duration for talk in self.talk_set.all()])
+        return self.talk_set.aggregate(duration=Coalesce(Sum(talk_duration()), 0))['duration']
 
     def __str__(self):
         return self.name
@@ -206,11 +275,12 @@ class Room(models.Model):
 
     @property
     def talks_by_date(self):
-        return self.talks.filter(start_date__isnull=False).exclude(duration=0, category__duration=0).order_by('start_date').all()
+        return self.talks.scheduled().order_by('start_date').select_related('category').prefetch_related('speakers')
 
     @property
     def unscheduled_talks(self):
-        return self.talks.filter(Q(start_date__isnull=True) | Q(duration=0, category__duration=0)).all()
+        return self.talks.with_schedule().filter(Q(start_date__isnull=True) | Q(effective_duration=0))\
+                         .select_related('category').prefetch_related('speakers')
 
 
 class Tag(models.Model):
@@ -310,18 +380,61 @@ class TalkCategory(models.Model): # type of talk (conf 30min, 1h, stand, …)
 #        return self.get_name()
 
 
-class TalkManager(models.Manager):
-    def get_queryset(self):
-        qs = super().get_queryset()
-        qs = qs.annotate(score=Coalesce(Avg('vote__vote'), 0))
-        return qs
+class TalkQuerySet(models.QuerySet):
+    def with_schedule(self):
+        """
+        Annotate the effective duration of the talks, in minutes, and their
+        computed end, like the estimated_duration and end_date properties.
+        """
+        return self.annotate(effective_duration=talk_duration()).annotate(
+            computed_end=models.ExpressionWrapper(F('start_date') + Minutes(F('effective_duration')),
+                                                  output_field=models.DateTimeField()),
+        )
+
+    def scheduled(self):
+        """Talks with a room, a start date and a duration."""
+        return self.with_schedule().filter(room__isnull=False, start_date__isnull=False, effective_duration__gt=0)
+
+    def in_schedule(self, pending=True):
+        """
+        Scheduled talks displayed in the schedule: not cancelled, in a category
+        with a label, and accepted (or not declined yet if pending is set).
+        """
+        talks = self.exclude(category__label__exact='').exclude(confirmed=False).scheduled()
+        if pending:
+            return talks.exclude(accepted=False)
+        return talks.filter(accepted=True)
+
+    def at(self, date):
+        """Scheduled talks taking place at the given date."""
+        return self.scheduled().filter(start_date__lte=date, computed_end__gt=date)
+
+    def overlapping(self, start, end):
+        """Scheduled talks overlapping the given period."""
+        return self.scheduled().filter(start_date__lt=end, computed_end__gt=start)
+
+    def ending_before(self, date):
+        return self.scheduled().filter(computed_end__lte=date)
+
+    def order_by_score(self, descending=True):
+        score = Case(When(vote_count=0, then=0), default=F('vote_sum') * 1.0 / F('vote_count'),
+                     output_field=models.FloatField())
+        return self.order_by(score.desc() if descending else score.asc(), 'pk')
+
+    def update_votes(self):
+        """Recompute the vote count and sum of the talks."""
+        votes = Vote.objects.filter(talk=OuterRef('pk')).values('talk')
+        return self.update(
+            vote_count=Coalesce(Subquery(votes.annotate(c=Count('pk')).values('c'), output_field=models.IntegerField()), 0),
+            vote_sum=Coalesce(Subquery(votes.annotate(s=Sum('vote')).values('s'), output_field=models.IntegerField()), 0),
+        )
 
 
 def talks_materials_destination(talk, filename):
     return join(talk.site.name, talk.slug, filename)
 
 
-class Talk(PonyConfModel):
+class Talk(CounterFieldsMixin, PonyConfModel):
     LICENCES = (
         ('CC-Zero CC-BY', 'CC-Zero CC-BY'),
         ('CC-BY-SA', 'CC-BY-SA'),
@@ -360,8 +473,12 @@ class Talk(PonyConfModel):
     video = models.URLField(max_length=1000, blank=True, default='', verbose_name='Video URL')
     token = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     conversation = models.OneToOneField(MessageThread, on_delete=models.PROTECT)
+    # maintained by signals, see TalkQuerySet.update_votes
+    vote_count = models.PositiveIntegerField(default=0, editable=False)
+    vote_sum = models.IntegerField(default=0, editable=False)
 
-    objects = TalkManager()
+    objects = TalkQuerySet.as_manager()
+    counter_fields = ('vote_count', 'vote_sum')
 
     class Meta:
         ordering = ('title',)
@@ -369,6 +486,12 @@ class Talk(PonyConfModel):
     def __str__(self):
         return self.title
 
+    @property
+    def score(self):
+        if not self.vote_count:
+            return 0
+        return self.vote_sum / self.vote_count
+
     def get_speakers_str(self):
         speakers = list(map(str, self.speakers.all()))
         if len(speakers) == 0:
@@ -408,14 +531,15 @@ class Talk(PonyConfModel):
         return mark_safe(' '.join(map(lambda tag: tag.link, self.tags.all())))
 
     def get_csv_row(self):
+        speakers = self.speakers.all()
         return [
             self.pk,
             self.title,
             self.description,
             self.category,
             self.track,
-            [speaker.pk for speaker in self.speakers.all()],
-            [speaker.name for speaker in self.speakers.all()],
+            [speaker.pk for speaker in speakers],
+            [speaker.name for speaker in speakers],
             [tag.name for tag in self.tags.all()],
             1 if self.videotaped else 0,
             self.video_licence,
@@ -447,6 +571,10 @@ class Talk(PonyConfModel):
 
     class Meta:
         ordering = ('category__id', 'title',)
+        indexes = [
+            models.Index(fields=['room', 'start_date']),
+            models.Index(fields=['site', 'start_date']),
+        ]
 
 
 class Vote(PonyConfModel):
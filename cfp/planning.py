@@ -1,24 +1,210 @@
-from django.db.models import Q, Prefetch
+from django.contrib.sites.models import Site
+from django.db.models import Prefetch
 from django.utils.safestring import mark_safe
 from django.utils.html import escape
-from django.utils.timezone import localtime, now
-from django.core.cache import cache
+from django.utils.timezone import localtime, now, utc
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.db import transaction
 from django.urls import reverse
 from django.template.loader import get_template
 from django.conf import settings
 
 from datetime import datetime, timedelta
 from copy import deepcopy
-from collections import OrderedDict, namedtuple
+from collections import Counter, OrderedDict, namedtuple
+from bisect import bisect_left, bisect_right, insort
 from itertools import islice
-from zlib import adler32
-import xml.etree.ElementTree as ET
+from hashlib import sha256
+from time import time
+from io import StringIO
+import gzip
+import os
+import tempfile
+from xml.sax.saxutils import XMLGenerator
 from icalendar import Calendar as iCalendar, Event as iEvent
 
-from .models import Conference, Talk, Room, Tag
+from ponyconf.profiling import profiled
+
+from .models import Conference, Talk, Tag
+
+
+SCHEDULE_CACHE_TIMEOUT = 24 * 60 * 60
+# formats depending on the current time
+SCHEDULE_LIVE_CACHE_TIMEOUT = 60
+# while a request renders the new version of a schedule, the concurrent
+# requests are served the previous one
+SCHEDULE_RENDER_TIMEOUT = 60
+
+
+def _schedule_version_key(site_id):
+    return 'ponyconf-schedule-version-%d' % site_id
+
+
+def get_schedule_updated(site_id):
+    """Return the date of the last change of the schedule of a site, as stored in database."""
+    return Conference.objects.filter(site_id=site_id).values_list('schedule_updated', flat=True).first()
+
+
+def get_schedule_version(site_id):
+    """
+    Return the current version of the schedules of a site. The version is the
+    time of its creation: as it is recreated after each change, it is never
+    older than the last modification of the schedule. Without a shared cache,
+    this is the date of the last change stored in database.
+    """
+    if isinstance(caches['default'], DummyCache):
+        updated = get_schedule_updated(site_id)
+        return '%.6f' % updated.timestamp() if updated else '0'
+    version = cache.get(_schedule_version_key(site_id))
+    if version is None:
+        version = '%.6f' % time()
+        if not cache.add(_schedule_version_key(site_id), version, None):
+            version = cache.get(_schedule_version_key(site_id), version)
+    return version
+
+
+def invalidate_schedule(site_id):
+    """Make the cached schedules of a site outdated, without touching the other sites."""
+    def invalidate():
+        cache.delete(_schedule_version_key(site_id))
+        if getattr(settings, 'SCHEDULE_SNAPSHOTS', False):
+            delete_schedule_snapshots(site_id)
+    Conference.objects.filter(site_id=site_id).update(schedule_updated=now())
+    invalidate()
+    # prevent concurrent requests from caching data about to be replaced
+    transaction.on_commit(invalidate)
 
 
 Event = namedtuple('Event', ['talk', 'row', 'rowcount'])
+Placement = namedtuple('Placement', ['talk', 'day', 'room', 'start', 'end', 'col'])
+
+
+class XMLWriter:
+    """
+    Incremental XML writer: elements are written as soon as they are opened,
+    and the output produced so far is retrieved with flush().
+    """
+    def __init__(self):
+        self.buffer = StringIO()
+        self.generator = XMLGenerator(self.buffer, encoding='utf-8', short_empty_elements=True)
+        self.generator.startDocument()
+
+    def start(self, name, attrs=None):
+        self.generator.startElement(name, attrs or {})
+
+    def end(self, name):
+        self.generator.endElement(name)
+
+    def element(self, name, text=None, attrs=None):
+        self.start(name, attrs)
+        if text:
+            self.generator.characters(text)
+        self.end(name)
+
+    def flush(self):
+        output = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return output.encode('utf-8')
+
+
+class Grid:
+    """
+    Day / timeslot / room grid of a schedule.
+
+    Timeslots of each day are kept sorted and looked up by bisection, and the
+    rows of a day are built on demand: adding a talk only invalidates the rows
+    of its day.
+    """
+    def __init__(self):
+        self.placements = {}
+        self.timeslots = {}
+        self._boundaries = Counter()
+        self._rooms = Counter()
+        self._by_day = {}
+        self._rows = {}
+        self._cols = None
+
+    @property
+    def days(self):
+        return sorted(self.timeslots.keys())
+
+    @property
+    def rooms(self):
+        return sorted(self._rooms.keys(), key=lambda room: (room.name, room.pk))
+
+    @property
+    def cols(self):
+        if self._cols is None:
+            cols = dict()
+            for placement in self.placements.values():
+                cols[placement.room] = max(cols.get(placement.room, 1), placement.col + 1)
+            self._cols = OrderedDict([(room, cols[room]) for room in self.rooms])
+        return self._cols
+
+    def __contains__(self, talk):
+        return talk.pk in self.placements
+
+    def __len__(self):
+        return len(self.placements)
+
+    def add(self, talk):
+        start = talk.start_date
+        end = start + timedelta(minutes=talk.estimated_duration)
+        day = localtime(start).date()
+        assert(localtime(end).date() == day) # this is a current limitation
+        room = talk.room
+        placements = self._by_day.setdefault(day, {}).setdefault(room, [])
+        used = set(p.col for p in placements if p.start < end and p.end > start)
+        col = 0
+        while col in used:
+            col += 1
+        placement = Placement(talk=talk, day=day, room=room, start=start, end=end, col=col)
+        placements.append(placement)
+        self.placements[talk.pk] = placement
+        if not self._rooms[room]:
+            # every row has a cell for each room
+            self._rows.clear()
+        self._rooms[room] += 1
+        self._add_timeslot(day, start)
+        self._add_timeslot(day, end)
+        self._invalidate(day)
+        return placement
+
+    def _add_timeslot(self, day, dt):
+        if not self._boundaries[dt]:
+            insort(self.timeslots.setdefault(day, []), dt)
+        self._boundaries[dt] += 1
+
+    def _invalidate(self, day):
+        self._rows.pop(day, None)
+        self._cols = None
+
+    def talks(self, day, room):
+        placements = self._by_day.get(day, {}).get(room, [])
+        return [placement.talk for placement in sorted(placements, key=lambda p: (p.start, p.talk.pk))]
+
+    def span(self, placement):
+        timeslots = self.timeslots[placement.day]
+        return bisect_left(timeslots, placement.start), bisect_left(timeslots, placement.end)
+
+    def rows(self, day):
+        rows = self._rows.get(day)
+        if rows is None:
+            timeslots = self.timeslots[day]
+            rooms = self.rooms
+            rows = OrderedDict([(timeslot, OrderedDict([(room, []) for room in rooms])) for timeslot in timeslots[:-1]])
+            for placements in self._by_day[day].values():
+                for placement in placements:
+                    first, last = self.span(placement)
+                    for row, timeslot in enumerate(islice(timeslots, first, last)):
+                        events = rows[timeslot][placement.room]
+                        while len(events) <= placement.col:
+                            events.append(None)
+                        events[placement.col] = Event(talk=placement.talk, row=row, rowcount=last-first)
+            self._rows[day] = rows
+        return rows
 
 
 class Program:
@@ -35,75 +221,37 @@ class Program:
     def _lazy_init(self):
         self.conference = Conference.objects.get(site=self.site)
         self.talks = Talk.objects.\
-                            exclude(category__label__exact='').\
-                            exclude(confirmed=False).\
-                            filter(site=self.site, room__isnull=False, start_date__isnull=False).\
-                            filter(Q(duration__gt=0) | Q(category__duration__gt=0)).\
+                            filter(site=self.site).in_schedule(pending=self.pending).\
                             prefetch_related(
                                 Prefetch('tags', queryset=Tag.objects.filter(staff=True), to_attr='staff_tags'),
                                 Prefetch('tags', queryset=Tag.objects.filter(public=True), to_attr='public_tags'),
                                 'category', 'speakers', 'track', 'tags', 'room',
                             )
 
-        if self.pending:
-            self.talks = self.talks.exclude(accepted=False)
-        else:
-            self.talks = self.talks.filter(accepted=True)
-
-        self.talks = self.talks.order_by('start_date')
-
-        self.rooms = Room.objects.filter(talk__in=self.talks.all()).order_by('name').distinct()
-
-        self.days = {}
-        for talk in self.talks.all():
-            duration = talk.estimated_duration
-            assert(duration)
-            dt1 = talk.start_date
-            d1 = localtime(dt1).date()
-            if d1 not in self.days.keys():
-                self.days[d1] = {'timeslots': []}
-            dt2 = dt1 + timedelta(minutes=duration)
-            d2 = localtime(dt2).date()
-            if d2 not in self.days.keys():
-                self.days[d2] = {'timeslots': []}
-            if dt1 not in self.days[d1]['timeslots']:
-                self.days[d1]['timeslots'].append(dt1)
-            if dt2 not in self.days[d2]['timeslots']:
-                self.days[d2]['timeslots'].append(dt2)
-
-        self.cols = OrderedDict([(room, 1) for room in self.rooms])
-        for day in self.days.keys():
-            self.days[day]['timeslots'] = sorted(self.days[day]['timeslots'])
-            self.days[day]['rows'] = OrderedDict([(timeslot, OrderedDict([(room, []) for room in self.rooms])) for timeslot in self.days[day]['timeslots'][:-1]])
-
-        for talk in self.talks.exclude(plenary=True).all():
-            self._add_talk(talk)
-
-        for talk in self.talks.filter(plenary=True).all():
-            self._add_talk(talk)
+        self.talks = self.talks.order_by('start_date', 'pk')
+
+        self.grid = Grid()
+        for talk in sorted(self.talks, key=self._placement_order):
+            self.grid.add(talk)
 
         self.initialized = True
 
-    def _add_talk(self, talk):
-        room = talk.room
-        dt1 = talk.start_date
-        d1 = localtime(dt1).date()
-        dt2 = talk.start_date + timedelta(minutes=talk.estimated_duration)
-        d2 = localtime(dt2).date()
-        assert(d1 == d2) # this is a current limitation
-        dt1 = self.days[d1]['timeslots'].index(dt1)
-        dt2 = self.days[d1]['timeslots'].index(dt2)
-        col = None
-        for row, timeslot in enumerate(islice(self.days[d1]['timeslots'], dt1, dt2)):
-            if col is None:
-                col = 0
-                while col < len(self.days[d1]['rows'][timeslot][room]) and self.days[d1]['rows'][timeslot][room][col]:
-                    col += 1
-                self.cols[room] = max(self.cols[room], col+1)
-            event = Event(talk=talk, row=row, rowcount=dt2-dt1)
-            while len(self.days[d1]['rows'][timeslot][room]) <= col:
-                self.days[d1]['rows'][timeslot][room].append(None)
-            self.days[d1]['rows'][timeslot][room][col] = event
+    @property
+    def days(self):
+        return self.grid.days
+
+    @property
+    def rooms(self):
+        return self.grid.rooms
+
+    @property
+    def cols(self):
+        return self.grid.cols
+
+    @staticmethod
+    def _placement_order(talk):
+        # plenary talks are placed last so they take the remaining columns
+        return (talk.plenary, talk.start_date, talk.pk)
 
     def _html_header(self):
         output = '<td>Room</td>'
@@ -115,7 +263,7 @@ class Program:
 
     def _html_body(self):
         output = ''
-        for day in sorted(self.days.keys()):
+        for day in self.days:
             output += self._html_day_header(day)
             output += self._html_day(day)
         return output
@@ -132,7 +280,7 @@ class Program:
 
     def _html_day(self, day):
         output = []
-        rows = self.days[day]['rows']
+        rows = self.grid.rows(day)
         for ts, rooms in rows.items():
             output.append(self._html_row(day, ts, rooms))
         return '\n'.join(output)
@@ -173,7 +321,8 @@ class Program:
     def _html_timeslot(self, day, ts):
         template = '<td>%(content)s</td>'
         start = ts
-        end = self.days[day]['timeslots'][self.days[day]['timeslots'].index(ts)+1]
+        timeslots = self.grid.timeslots[day]
+        end = timeslots[bisect_right(timeslots, ts)]
         duration = (end - start).seconds / 60
         date_to_string = lambda date: datetime.strftime(localtime(date), '%H:%M')
         style = 'height: %dpx;' % int(duration * 1.2)
@@ -189,81 +338,75 @@ class Program:
             'body': self._html_body(),
         }
 
-    def _as_xml(self):
+    def _iter_xml(self):
         if not self.initialized:
             self._lazy_init()
-        schedule = ET.Element('schedule')
-
-        conference = ET.SubElement(schedule, 'conference')
-        elt = ET.SubElement(conference, 'title')
-        elt.text = self.conference.name
-        elt = ET.SubElement(conference, 'venue')
-        elt.text = ', '.join(map(lambda x: x.strip(), self.conference.venue.split('\n')))
-        elt = ET.SubElement(conference, 'city')
-        elt.text = self.conference.city
+        xml = XMLWriter()
+        xml.start('schedule')
+
+        xml.start('conference')
+        xml.element('title', self.conference.name)
+        xml.element('venue', ', '.join(map(lambda x: x.strip(), self.conference.venue.split('\n'))))
+        xml.element('city', self.conference.city)
         if self.days:
-            elt = ET.SubElement(conference, 'start_date')
-            elt.text = sorted(self.days.keys())[0].strftime('%Y-%m-%d')
-            elt = ET.SubElement(conference, 'end_date')
-            elt.text = sorted(self.days.keys(), reverse=True)[0].strftime('%Y-%m-%d')
-            elt = ET.SubElement(conference, 'days_count')
-            elt.text = str(len(self.days))
-
-        for index, day in enumerate(sorted(self.days.keys())):
-            day_elt = ET.SubElement(schedule, 'day', index=str(index+1), date=day.strftime('%Y-%m-%d'))
-            for room in self.rooms.all():
-                room_elt = ET.SubElement(day_elt, 'room', name=room.name)
-                for talk in self.talks.filter(room=room).order_by('start_date'):
-                    if localtime(talk.start_date).date() != day:
-                        continue
-                    talk_elt = ET.SubElement(day_elt, 'event', id=str(talk.id))
-                    duration = talk.estimated_duration
-                    persons_elt = ET.SubElement(talk_elt, 'persons')
-                    for speaker in talk.speakers.all():
-                        person_elt = ET.SubElement(talk_elt, 'person', id=str(speaker.id))
-                        person_elt.text = str(speaker)
-#                    #if talk.registration_required and self.conference.subscriptions_open:
-#                    #    links += mark_safe("""
-#                    #    <link tag="registration">%(link)s</link>""" % {
-#                    #        'link': reverse('register-for-a-talk', args=[talk.slug]),
-#                    #    })
-#                    #    registration = """
-#                    #  <attendees_max>%(max)s</attendees_max>
-#                    #  <attendees_remain>%(remain)s</attendees_remain>""" % {
-#                    #    'max': talk.attendees_limit,
-#                    #    'remain': talk.remaining_attendees or 0,
-#                    #  }
-                    tags_elt = ET.SubElement(talk_elt, 'tags')
-                    for tag in talk.tags.filter(public=True):
-                        tag_elt = ET.SubElement(tags_elt, 'tag', slug=str(tag.slug))
-                        tag_elt.text = tag.name
-                    elt = ET.SubElement(talk_elt, 'start')
-                    elt.text = localtime(talk.start_date).strftime('%H:%M')
-                    elt = ET.SubElement(talk_elt, 'duration')
-                    elt.text = '%02d:%02d' % (talk.estimated_duration / 60, talk.estimated_duration % 60)
-                    elt = ET.SubElement(talk_elt, 'room')
-                    elt.text = room.name
-                    elt = ET.SubElement(talk_elt, 'slug')
-                    elt.text = talk.slug
-                    elt = ET.SubElement(talk_elt, 'title')
-                    elt.text = talk.title
-                    elt = ET.SubElement(talk_elt, 'subtitle')
-                    elt = ET.SubElement(talk_elt, 'track')
-                    elt.text = str(talk.track) if talk.track else ''
-                    elt = ET.SubElement(talk_elt, 'type')
-                    elt.text = talk.category.label
-                    elt = ET.SubElement(talk_elt, 'language')
-                    elt = ET.SubElement(talk_elt, 'description')
-                    elt.text = talk.description
-                    links_elt = ET.SubElement(talk_elt, 'links')
-                    if talk.materials:
-                        elt = ET.SubElement(links_elt, 'link', tag='slides')
-                        elt.text = talk.materials.url
-                    if talk.video and self.conference.videos_available:
-                        elt = ET.SubElement(links_elt, 'link', tag='video')
-                        elt.text = talk.video
-
-        return ET.tostring(schedule)
+            xml.element('start_date', self.days[0].strftime('%Y-%m-%d'))
+            xml.element('end_date', self.days[-1].strftime('%Y-%m-%d'))
+            xml.element('days_count', str(len(self.days)))
+        xml.end('conference')
+        yield xml.flush()
+
+        rooms = self.rooms
+        for index, day in enumerate(self.days):
+            xml.start('day', {'index': str(index+1), 'date': day.strftime('%Y-%m-%d')})
+            for room in rooms:
+                xml.element('room', attrs={'name': room.name})
+                for talk in self.grid.talks(day, room):
+                    self._xml_talk(xml, talk, room)
+                    yield xml.flush()
+            xml.end('day')
+        xml.end('schedule')
+        yield xml.flush()
+
+    def _xml_talk(self, xml, talk, room):
+        xml.start('event', {'id': str(talk.id)})
+        xml.element('persons')
+        for speaker in talk.speakers.all():
+            xml.element('person', str(speaker), {'id': str(speaker.id)})
+#        #if talk.registration_required and self.conference.subscriptions_open:
+#        #    links += mark_safe("""
+#        #    <link tag="registration">%(link)s</link>""" % {
+#        #        'link': reverse('register-for-a-talk', args=[talk.slug]),
+#        #    })
+#        #    registration = """
+#        #  <attendees_max>%(max)s</attendees_max>
+#        #  <attendees_remain>%(remain)s</attendees_remain>""" % {
+#        #    'max': talk.attendees_limit,
+#        #    'remain': talk.remaining_attendees or 0,
+#        #  }
+        xml.start('tags')
+        for tag in talk.public_tags:
+            xml.element('tag', tag.name, {'slug': str(tag.slug)})
+        xml.end('tags')
+        xml.element('start', localtime(talk.start_date).strftime('%H:%M'))
+        xml.element('duration', '%02d:%02d' % (talk.estimated_duration / 60, talk.estimated_duration % 60))
+        xml.element('room', room.name)
+        xml.element('slug', talk.slug)
+        xml.element('title', talk.title)
+        xml.element('subtitle')
+        xml.element('track', str(talk.track) if talk.track else '')
+        xml.element('type', talk.category.label)
+        xml.element('language')
+        xml.element('description', talk.description)
+        xml.start('links')
+        if talk.materials:
+            xml.element('link', talk.materials.url, {'tag': 'slides'})
+        if talk.video and self.conference.videos_available:
+            xml.element('link', talk.video, {'tag': 'video'})
+        xml.end('links')
+        xml.end('event')
+
+    def _as_xml(self):
+        return b''.join(self._iter_xml())
 
     def _as_ics(self, citymeo=False):
         if not self.initialized:
@@ -297,16 +440,121 @@ class Program:
             cal.add_component(event)
         return cal.to_ical()
 
+    def _cached_render(self, output, **kwargs):
+        params = '|'.join(map(str, [output, self.pending, self.staff] + sorted(kwargs.items())))
+        key = 'ponyconf-schedule-%d-%s' % (self.site.pk, sha256(params.encode('utf-8')).hexdigest())
+        version = get_schedule_version(self.site.pk)
+        entry = cache.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        # only one request renders the new version, others get the stale one
+        lock = '%s-%s-lock' % (key, version)
+        if entry is not None and not cache.add(lock, True, SCHEDULE_RENDER_TIMEOUT):
+            return entry[1]
+        result = getattr(self, '_as_%s' % output)(**kwargs)
+        timeout = SCHEDULE_LIVE_CACHE_TIMEOUT if kwargs.get('citymeo') else SCHEDULE_CACHE_TIMEOUT
+        cache.set(key, (version, result), timeout)
+        cache.delete(lock)
+        return result
+
+    @profiled('schedule')
     def render(self, output='html', **kwargs):
         if self.cache:
-            cache_entry = 'ponyconf-%d' % adler32('|'.join(map(str, [self.site.domain, output, self.pending] + list(kwargs.values()))).encode('utf-8'))
-            result = cache.get(cache_entry)
-            if not result:
-                result = getattr(self, '_as_%s' % output)(**kwargs)
-                cache.set(cache_entry, result, 3 * 60 * 60) # 3H
-            return result
+            return self._cached_render(output, **kwargs)
         else:
             return getattr(self, '_as_%s' % output)(**kwargs)
 
+    def stream(self, output='xml', **kwargs):
+        if self.cache:
+            return iter([self.render(output, **kwargs)])
+        if not self.initialized:
+            self._lazy_init()
+        return getattr(self, '_iter_%s' % output)(**kwargs)
+
     def __str__(self):
         return self.render()
+
+
+# Static snapshots of the public schedule, written under MEDIA_ROOT so the web
+# server can serve them (and their gzip version) without reaching Django.
+# They are deleted when the schedule changes and written again by the next
+# request, or by the snapshotschedule command. The citymeo format depends on
+# the current time and is left out.
+SNAPSHOT_FORMATS = OrderedDict([
+    ('html', ('schedule.html', 'text/html; charset=utf-8')),
+    ('xml', ('schedule.xml', 'application/xml')),
+    ('ics', ('schedule.ics', 'text/calendar')),
+])
+
+
+def get_schedule_snapshot_path(site, program_format):
+    return os.path.join(settings.MEDIA_ROOT, 'schedule', site.domain, SNAPSHOT_FORMATS[program_format][0])
+
+
+def _write_file(path, content):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def write_schedule_snapshot(conference, program_format, program=None):
+    """
+    Render the public schedule of a conference and write it to its snapshot
+    file. The snapshot is not written if the schedule is not published or if
+    it changed during the rendering. Return the rendered content.
+    """
+    site = conference.site
+    version = get_schedule_version(site.pk)
+    if program is None:
+        program = Program(site=site, cache=False)
+    content = program.render(program_format)
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    if conference.schedule_available and get_schedule_version(site.pk) == version:
+        path = get_schedule_snapshot_path(site, program_format)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # the compressed file first, so it is never older than the other one
+        _write_file(path + '.gz', gzip.compress(content))
+        _write_file(path, content)
+    return content
+
+
+def write_schedule_snapshots(conference):
+    program = Program(site=conference.site, cache=False)
+    for program_format in SNAPSHOT_FORMATS:
+        write_schedule_snapshot(conference, program_format, program=program)
+
+
+def read_schedule_snapshot(site, program_format):
+    try:
+        with open(get_schedule_snapshot_path(site, program_format), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def get_schedule_snapshot_date(site, program_format):
+    try:
+        mtime = os.path.getmtime(get_schedule_snapshot_path(site, program_format))
+    except FileNotFoundError:
+        return None
+    return datetime.fromtimestamp(mtime, tz=utc)
+
+
+def delete_schedule_snapshots(site_id):
+    site = Site.objects.filter(pk=site_id).first()
+    if site is None:
+        return
+    for program_format in SNAPSHOT_FORMATS:
+        path = get_schedule_snapshot_path(site, program_format)
+        for name in [path, path + '.gz']:
+            try:
+                os.unlink(name)
+            except FileNotFoundError:
+                pass
@@ -1,5 +1,6 @@
-from django.db.models.signals import pre_save, post_save
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
+from django.db.models import F
 from django.contrib.sites.models import Site
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
@@ -9,8 +10,11 @@ from django.contrib.auth import get_user_model
 
 from ponyconf.decorators import disable_for_loaddata
 from mailing.models import MessageThread, Message
-from mailing.utils import send_message
-from .models import Participant, Talk, Conference, Volunteer
+from mailing.utils import send_message, forget_email_authors
+from .models import Participant, Talk, Conference, Volunteer, Vote, Room, Tag, TalkCategory, Track
+from .middleware import invalidate_conference
+from .utils import invalidate_staff_ids
+from .planning import invalidate_schedule
 
 
 @receiver(post_save, sender=Site, dispatch_uid="Create Conference for Site")
@@ -19,6 +23,159 @@ def create_conference(sender, instance, **kwargs):
     conference, created = Conference.objects.get_or_create(site=instance)
 
 
+@receiver(post_save, sender=Conference, dispatch_uid="Invalidate cached conference on save")
+@receiver(post_delete, sender=Conference, dispatch_uid="Invalidate cached conference on delete")
+def invalidate_cached_conference(sender, instance, **kwargs):
+    invalidate_conference(instance.site_id)
+
+
+@receiver(post_save, sender=Site, dispatch_uid="Invalidate cached conference on site save")
+@receiver(post_delete, sender=Site, dispatch_uid="Invalidate cached conference on site delete")
+def invalidate_cached_conference_site(sender, instance, **kwargs):
+    invalidate_conference(instance.pk)
+
+
+@receiver(m2m_changed, sender=Conference.staff.through, dispatch_uid="Invalidate cached conference on staff change")
+def invalidate_cached_conference_staff(sender, instance, action, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if kwargs['reverse']: # instance is a user
+        conferences = Conference.objects.all()
+        if pk_set is not None:
+            conferences = conferences.filter(pk__in=pk_set)
+        for conference_id, site_id in conferences.values_list('pk', 'site_id'):
+            invalidate_conference(site_id)
+            invalidate_staff_ids(conference_id)
+    else:
+        invalidate_conference(instance.site_id)
+        invalidate_staff_ids(instance.pk)
+
+
+@receiver(post_save, sender=Talk, dispatch_uid="Update speakers talk counts on talk save")
+@disable_for_loaddata
+def update_talk_counts_on_save(sender, instance, **kwargs):
+    Participant.objects.filter(talk=instance).update_talk_counts()
+
+
+@receiver(pre_delete, sender=Talk, dispatch_uid="Remember speakers of deleted talk")
+def remember_talk_speakers(sender, instance, **kwargs):
+    instance._speaker_ids = list(instance.speakers.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Talk, dispatch_uid="Update speakers talk counts on talk deletion")
+def update_talk_counts_on_delete(sender, instance, **kwargs):
+    Participant.objects.filter(pk__in=getattr(instance, '_speaker_ids', [])).update_talk_counts()
+
+
+@receiver(m2m_changed, sender=Talk.speakers.through, dispatch_uid="Update speakers talk counts on speakers change")
+def update_talk_counts_on_speakers_change(sender, instance, action, pk_set, **kwargs):
+    if kwargs['reverse']: # instance is a participant
+        if action.startswith('post_'):
+            Participant.objects.filter(pk=instance.pk).update_talk_counts()
+    elif action == 'pre_clear':
+        instance._speaker_ids = list(instance.speakers.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        Participant.objects.filter(pk__in=getattr(instance, '_speaker_ids', [])).update_talk_counts()
+    elif action in ['post_add', 'post_remove']:
+        Participant.objects.filter(pk__in=pk_set).update_talk_counts()
+
+
+@receiver(pre_save, sender=Vote, dispatch_uid="Remember previous vote")
+@disable_for_loaddata
+def remember_previous_vote(sender, instance, **kwargs):
+    if instance.pk:
+        instance._previous_vote = Vote.objects.filter(pk=instance.pk).values_list('vote', flat=True).first()
+
+
+@receiver(post_save, sender=Vote, dispatch_uid="Update talk votes on vote save")
+@disable_for_loaddata
+def update_votes_on_save(sender, instance, created, **kwargs):
+    previous = getattr(instance, '_previous_vote', None)
+    if created or previous is None:
+        Talk.objects.filter(pk=instance.talk_id).update(vote_count=F('vote_count') + 1,
+                                                        vote_sum=F('vote_sum') + instance.vote)
+    elif previous != instance.vote:
+        Talk.objects.filter(pk=instance.talk_id).update(vote_sum=F('vote_sum') + instance.vote - previous)
+
+
+@receiver(post_delete, sender=Vote, dispatch_uid="Update talk votes on vote deletion")
+def update_votes_on_delete(sender, instance, **kwargs):
+    Talk.objects.filter(pk=instance.talk_id).update(vote_count=F('vote_count') - 1,
+                                                    vote_sum=F('vote_sum') - instance.vote)
+
+
+# addresses used to resolve the authors of inbound emails, see mailing.utils.get_email_author
+SENDER_EMAIL_FIELDS = {
+    User: 'email',
+    Participant: 'email',
+    Conference: 'contact_email',
+}
+
+
+def remember_sender_email(sender, instance, update_fields=None, **kwargs):
+    field = SENDER_EMAIL_FIELDS[sender]
+    if instance.pk and (update_fields is None or field in update_fields):
+        instance._previous_email = sender.objects.filter(pk=instance.pk).values_list(field, flat=True).first()
+
+
+def forget_sender_email(sender, instance, created=False, update_fields=None, **kwargs):
+    field = SENDER_EMAIL_FIELDS[sender]
+    if update_fields is not None and field not in update_fields:
+        return
+    email = getattr(instance, field)
+    previous = getattr(instance, '_previous_email', None)
+    if created or previous != email or kwargs['signal'] == post_delete:
+        forget_email_authors(email, previous)
+
+
+for model in SENDER_EMAIL_FIELDS:
+    pre_save.connect(remember_sender_email, sender=model, dispatch_uid="Remember sender email of %s" % model.__name__)
+    post_save.connect(forget_sender_email, sender=model, dispatch_uid="Forget sender email of %s on save" % model.__name__)
+    post_delete.connect(forget_sender_email, sender=model, dispatch_uid="Forget sender email of %s on delete" % model.__name__)
+
+
+# fields displayed in the schedule: saving other fields keeps the cached schedules
+SCHEDULE_FIELDS = {
+    Talk: ['site', 'title', 'slug', 'description', 'track', 'category', 'accepted', 'confirmed',
+           'start_date', 'duration', 'room', 'plenary', 'materials', 'video'],
+    Room: ['name', 'label'],
+    Tag: ['name', 'slug', 'color', 'inverted', 'public', 'staff'],
+    TalkCategory: ['name', 'duration', 'color', 'label'],
+    Track: ['name'],
+    Participant: ['name'],
+    Conference: ['name', 'venue', 'city', 'schedule_publishing_date', 'video_publishing_date'],
+}
+
+
+def remember_schedule_fields(sender, instance, update_fields=None, **kwargs):
+    fields = [field for field in SCHEDULE_FIELDS[sender] if update_fields is None or field in update_fields]
+    if not fields:
+        instance._schedule_changed = False
+    elif instance.pk:
+        attnames = [sender._meta.get_field(field).attname for field in fields]
+        previous = sender._base_manager.filter(pk=instance.pk).values_list(*attnames).first()
+        instance._schedule_changed = previous != tuple(getattr(instance, attname) for attname in attnames)
+
+
+def invalidate_cached_schedule(sender, instance, created=False, **kwargs):
+    changed = instance.__dict__.pop('_schedule_changed', True)
+    if created or changed or kwargs['signal'] == post_delete:
+        invalidate_schedule(instance.site_id)
+
+
+def invalidate_cached_schedule_m2m(sender, instance, action, **kwargs):
+    if action.startswith('post_'):
+        invalidate_schedule(instance.site_id)
+
+
+for model in SCHEDULE_FIELDS:
+    pre_save.connect(remember_schedule_fields, sender=model, dispatch_uid="Remember schedule fields of %s" % model.__name__)
+    post_save.connect(invalidate_cached_schedule, sender=model, dispatch_uid="Invalidate schedule on %s save" % model.__name__)
+    post_delete.connect(invalidate_cached_schedule, sender=model, dispatch_uid="Invalidate schedule on %s delete" % model.__name__)
+for through in [Talk.speakers.through, Talk.tags.through]:
+    m2m_changed.connect(invalidate_cached_schedule_m2m, sender=through, dispatch_uid="Invalidate schedule on %s change" % through.__name__)
+
+
 def create_conversation(sender, instance, **kwargs):
     if not hasattr(instance, 'conversation'):
         instance.conversation = MessageThread.objects.create()
@@ -53,6 +210,8 @@ def send_message_notifications(sender, instance, **kwargs):
         sender = str(author)
     sender = (sender, conf.contact_email)
     staff_dests = [ (user, user.get_full_name(), user.email) for user in conf.staff.all() ]
+    options = dict(sender=sender, reply_to=reply_to, message_id=message_id, reference=reference)
+    notifications = []
     if hasattr(thread, 'participant') or hasattr(thread, 'volunteer'):
         if hasattr(thread, 'participant'):
             user = thread.participant
@@ -66,14 +225,14 @@ def send_message_notifications(sender, instance, **kwargs):
             user_subject = _('[%(conference)s] Message from the staff') % {'conference': str(conf)}
             staff_subject = _('[%(conference)s] Conversation with %(user)s') % {'conference': str(conf), 'user': str(user)}
         if author == user: # message from the user, notify the staff
-            message.send_notification(sender=sender, dests=staff_dests, reply_to=reply_to, message_id=message_id, reference=reference, subject=staff_subject)
+            notifications.append((message, dict(options, dests=staff_dests, subject=staff_subject)))
         else: # message to the user, notify the user, and the staff if the message is not a conference notification
-            message.send_notification(sender=sender, dests=dests, reply_to=reply_to, message_id=message_id, reference=reference, subject=user_subject)
+            notifications.append((message, dict(options, dests=dests, subject=user_subject)))
             if author != conf:
-                message.send_notification(sender=sender, dests=staff_dests, reply_to=reply_to, message_id=message_id, reference=reference, subject=staff_subject)
+                notifications.append((message, dict(options, dests=staff_dests, subject=staff_subject)))
     elif hasattr(thread, 'talk'):
-        message.send_notification(sender=sender, dests=staff_dests,
-                                  reply_to=reply_to, message_id=message_id, reference=reference)
+        notifications.append((message, dict(options, dests=staff_dests)))
+    Message.objects.send_notifications(notifications)
 
 
 # connected in apps.py
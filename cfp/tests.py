@@ -1,17 +1,46 @@
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.urls import reverse
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import DatabaseError, connection, transaction
+from django.db.models import F
+from django.core.management import call_command
+from django.core.cache import cache
 from django.utils import timezone
-from django.contrib import messages
+from django.contrib import admin, messages
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.forms import modelform_factory
+from django.test import RequestFactory
 
 from datetime import datetime, timedelta
 from xml.etree import ElementTree as ET
 from icalendar import Calendar
+from io import StringIO
+from unittest.mock import patch
+import gzip
+import os
+import shutil
+import tempfile
 import pytz
+import csv
 
 from .models import *
+from .admin import TalkAdmin
 from .forms import VolunteerForm
+from .planning import Grid, Program, get_schedule_updated, get_schedule_version, SCHEDULE_CACHE_TIMEOUT, SCHEDULE_LIVE_CACHE_TIMEOUT
+from .export import iter_chunks, talks_csv
+from .emails import talk_email_render, speaker_email_render
+from .middleware import get_conference, conference_cache_stats
+from .factories import create_conference_data
+from .conflicts import find_overlaps, get_conflicts, get_talk_conflicts, scheduled_talks, ROOM, SPEAKER
+from .utils import get_staff_ids
+from mailing.models import Message, OutgoingMail
+from ponyconf import utils as ponyconf_utils
+from ponyconf.utils import markdown_to_html, markdown_cache_stats
+from ponyconf import profiling
+from ponyconf.management.commands.benchmark import measure_staff_views
+from django.conf import settings
 
 
 class VolunteersTests(TestCase):
@@ -118,6 +147,76 @@ class VolunteersTests(TestCase):
         self.assertRedirects(response, reverse('volunteer-mail-token'))
 
 
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'conference-tests'}})
+class ConferenceCacheTest(TestCase):
+    def setUp(self):
+        self.site = Site.objects.first()
+        User.objects.create_user('staff', email='staff@example.org', password='staff')
+
+    def test_cache(self):
+        conf = get_conference(self.site)
+        stats = conference_cache_stats.copy()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_conference(self.site), conf)
+            self.assertEqual(get_conference(self.site).site, self.site)
+            self.assertEqual(get_staff_ids(get_conference(self.site)), frozenset())
+        self.assertEqual(conference_cache_stats['local_hits'], stats['local_hits'] + 3)
+        conf.name = 'PonyConf'
+        conf.save()
+        self.assertEqual(get_conference(self.site).name, 'PonyConf')
+        self.assertEqual(conference_cache_stats['misses'], stats['misses'] + 1)
+        user = User.objects.get(username='staff')
+        conf.staff.add(user)
+        self.assertEqual(get_staff_ids(get_conference(self.site)), frozenset([user.pk]))
+        # only the field values and the staff ids are cached, not the users
+        self.assertFalse(any(user.password.encode() in value for value in cache._cache.values()))
+        user.conference_set.clear()
+        self.assertEqual(get_staff_ids(get_conference(self.site)), frozenset())
+        self.assertEqual(conference_cache_stats['misses'], stats['misses'] + 3)
+
+    def test_middleware(self):
+        self.client.get(reverse('home'))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(reverse('proposal-home')).status_code, 200)
+        self.assertFalse([q for q in queries if 'cfp_conference' in q['sql']])
+
+    def test_staff_ids(self):
+        user = User.objects.get(username='staff')
+        conf = Conference.objects.get(site=self.site)
+        self.assertEqual(get_staff_ids(conf), frozenset())
+        with self.assertNumQueries(0):
+            self.assertEqual(get_staff_ids(conf), frozenset())
+        conf.staff.add(user)
+        self.assertEqual(get_staff_ids(Conference.objects.get(pk=conf.pk)), frozenset([user.pk]))
+        self.client.login(username='staff', password='staff')
+        self.client.get(reverse('talk-list'))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(reverse('talk-list')).status_code, 200)
+        self.assertFalse([q for q in queries if 'cfp_conference_staff' in q['sql']])
+
+    def test_markdown(self):
+        ponyconf_utils._markdown_cache.clear()
+        stats = markdown_cache_stats.copy()
+        html = markdown_to_html('# Pony <script>')
+        self.assertEqual(markdown_to_html('# Pony <script>'), html)
+        self.assertEqual(markdown_cache_stats['misses'], stats['misses'] + 1)
+        self.assertEqual(markdown_cache_stats['local_hits'], stats['local_hits'] + 1)
+        ponyconf_utils._markdown_cache.clear()
+        self.assertEqual(markdown_to_html('# Pony <script>'), html)
+        self.assertEqual(markdown_cache_stats['shared_hits'], stats['shared_hits'] + 1)
+        with self.settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}):
+            for i in range(ponyconf_utils.MARKDOWN_CACHE_SIZE + 1):
+                markdown_to_html('Pony %d' % i)
+        self.assertEqual(len(ponyconf_utils._markdown_cache), ponyconf_utils.MARKDOWN_CACHE_SIZE)
+        self.assertNotIn(html, ponyconf_utils._markdown_cache.values())
+        # the homepage is rendered when saved
+        conf = Conference.objects.get(site=self.site)
+        conf.home = '**Welcome**'
+        conf.save()
+        self.assertEqual(Conference.objects.get(pk=conf.pk).home_html, '<p><strong>Welcome</strong></p>')
+        self.assertContains(self.client.get(reverse('home')), '<p><strong>Welcome</strong></p>')
+
+
 class ProposalTest(TestCase):
     def setUp(self):
         user = User.objects.create_user('jean-mi', email='jean-mi@example.org', password='jean-mi', first_name='Jean', last_name='Mi')
@@ -469,8 +568,33 @@ class StaffTest(TestCase):
         response = self.client.get(url + '?format=csv')
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.get('Content-Disposition'), 'attachment; filename="participants.csv"')
-        self.assertContains(response, 'Speaker 1')
-        self.assertContains(response, 'Speaker 2')
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertIn('Speaker 1', content)
+        self.assertIn('Speaker 2', content)
+
+    def test_talk_counts(self):
+        def counts(name):
+            p = Participant.objects.get(name=name)
+            return (p.accepted_talk_count, p.pending_talk_count, p.refused_talk_count)
+        self.assertEqual(counts('Speaker 1'), (0, 1, 0))
+        talk1, talk2 = Talk.objects.get(title='Talk 1'), Talk.objects.get(title='Talk 2')
+        talk1.accepted = True
+        talk1.save()
+        self.assertEqual(counts('Speaker 1'), (1, 0, 0))
+        talk2.speakers.add(Participant.objects.get(name='Speaker 1'))
+        self.assertEqual(counts('Speaker 1'), (1, 1, 0))
+        talk1.speakers.clear()
+        self.assertEqual(counts('Speaker 1'), (0, 1, 0))
+        self.assertEqual(counts('Speaker 2'), (0, 0, 0))
+        Participant.objects.get(name='Speaker 2').talk_set.add(talk2)
+        self.assertEqual(counts('Speaker 2'), (0, 1, 0))
+        talk2.delete()
+        self.assertEqual(counts('Speaker 2'), (0, 0, 0))
+        Participant.objects.update(pending_talk_count=42)
+        call_command('updatetalkcounts', stdout=StringIO())
+        self.assertEqual(counts('Speaker 3'), (0, 0, 0))
+        live = Participant.objects.with_live_talk_counts()
+        self.assertFalse(live.exclude(pending_talk_count=F('live_pending_talk_count')).exists())
 
     def test_speaker_details(self):
         speaker1 = Participant.objects.get(name='Speaker 1')
@@ -521,6 +645,64 @@ class StaffTest(TestCase):
         response = self.client.get(url + '?format=csv')
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.get('Content-Disposition'), 'attachment; filename="talks.csv"')
+        self.assertContains(response, 'Speaker 1')
+
+    def test_talk_list_actions(self):
+        site = Site.objects.first()
+        conf = site.conference
+        conf.staff.add(User.objects.get(username='user2'), User.objects.get(username='user3'))
+        track = Track.objects.create(site=site, name='Track 1')
+        tag = Tag.objects.create(site=site, name='Tag 1')
+        room = Room.objects.get(name='Room 1')
+        talk1, talk2 = Talk.objects.get(title='Talk 1'), Talk.objects.get(title='Talk 2')
+        talk2.tags.add(tag)
+        self.client.login(username='admin', password='admin')
+        data = {'talks': [talk1.pk, talk2.pk], 'decision': 'True', 'track': track.slug, 'tag': tag.slug, 'room': room.slug}
+        n_messages, n_mails = Message.objects.count(), OutgoingMail.objects.count()
+        response = self.client.post(reverse('talk-list'), data)
+        self.assertRedirects(response, reverse('talk-list'))
+        for talk in Talk.objects.filter(pk__in=[talk1.pk, talk2.pk]):
+            self.assertTrue(talk.accepted)
+            self.assertEqual((talk.track, talk.room), (track, room))
+            self.assertEqual(list(talk.tags.all()), [tag])
+        self.assertEqual(Participant.objects.get(name='Speaker 1').accepted_talk_count, 1)
+        self.assertEqual(Message.objects.count(), n_messages + 2)
+        self.assertEqual(OutgoingMail.objects.count(), n_mails + 4)
+        message = Message.objects.get(thread=talk1.conversation)
+        self.assertIn('accepted', message.subject)
+        self.assertEqual(message.outgoingmail_set.count(), 2)
+        # nothing changes, nothing is notified
+        self.client.post(reverse('talk-list'), data)
+        self.assertEqual(Message.objects.count(), n_messages + 2)
+
+    def test_export_csv(self):
+        site = Site.objects.first()
+        talks = Talk.objects.filter(site=site).order_by('-title')
+        self.assertEqual([t.title for t in iter_chunks(talks, chunk_size=1)], ['Talk 2', 'Talk 1'])
+        rows = list(csv.reader(talks_csv(talks, chunk_size=1)))
+        self.assertEqual(rows[1][1], 'Talk 1')
+        self.assertEqual(rows[1][6], "['Speaker 1', 'Speaker 2']")
+        for export, count in [('talks', 2), ('participants', 3), ('volunteers', 1)]:
+            out = StringIO()
+            call_command('exportcsv', export, '--site', site.domain, stdout=out)
+            self.assertEqual(len(list(csv.reader(out.getvalue().splitlines()))), count)
+
+    def test_talk_email_render(self):
+        talks = Talk.objects.filter(site=Site.objects.first())
+        with CaptureQueriesContext(connection) as queries:
+            list(talk_email_render(talks.filter(title='Talk 2'), '{{ talk.title }}', ''))
+        with self.assertNumQueries(len(queries)):
+            mails = [(s, c) for talk, speaker, s, c in talk_email_render(talks, '{{ talk.title }}', 'Hi {{ speaker.name }}')]
+        self.assertEqual(sorted(mails), [('Talk 1', 'Hi Speaker 1'), ('Talk 1', 'Hi Speaker 2'), ('Talk 2', 'Hi Speaker 3')])
+
+    def test_speaker_email_render(self):
+        speakers = Participant.objects.filter(site=Site.objects.first())
+        template = '{% for talk in speaker.talks %}{{ talk.title }} ({{ talk.speakers|length }}){% endfor %}'
+        with CaptureQueriesContext(connection) as queries:
+            list(speaker_email_render(speakers.filter(name='Speaker 3'), template, ''))
+        with self.assertNumQueries(len(queries)):
+            mails = [(speaker.name, s) for speaker, s, c in speaker_email_render(speakers, template, '')]
+        self.assertEqual(sorted(mails), [('Speaker 1', 'Talk 1 (2)'), ('Speaker 2', 'Talk 1 (2)'), ('Speaker 3', 'Talk 2 (1)')])
 
     def test_talk_details(self):
         talk = Talk.objects.get(title='Talk 1')
@@ -609,6 +791,43 @@ class StaffTest(TestCase):
         self.assertTrue(conf.videos_available)
         self.assertContains(self.client.get(xml_url), talk.video)
 
+    def test_talk_vote(self):
+        talk = Talk.objects.get(title='Talk 1')
+        url = reverse('talk-vote', kwargs={'talk_id': talk.pk, 'score': 2})
+        self.client.login(username='admin', password='admin')
+        self.assertRedirects(self.client.get(url), talk.get_absolute_url())
+        talk = Talk.objects.get(pk=talk.pk)
+        self.assertEqual((talk.vote_count, talk.vote_sum, talk.score), (1, 2, 2))
+        stale = Talk.objects.get(pk=talk.pk)
+        Vote.objects.create(talk=talk, user=User.objects.get(username='user1'), vote=-1)
+        self.client.get(reverse('talk-vote', kwargs={'talk_id': talk.pk, 'score': 1}))
+        stale.title = 'Talk 1bis'
+        stale.save()
+        talk = Talk.objects.get(pk=talk.pk)
+        self.assertEqual((talk.vote_count, talk.vote_sum, talk.score), (2, 0, 0))
+        self.assertEqual(Talk.objects.order_by_score().first().title, 'Talk 1bis')
+        response = self.client.get(reverse('talk-list') + '?sort=score&order=desc')
+        self.assertEqual(response.context['talk_list'][0].title, 'Talk 1bis')
+        # the counters are left out of the update, other fields are saved as usual
+        deferred = Talk.objects.defer('description').get(pk=talk.pk)
+        with CaptureQueriesContext(connection) as queries:
+            deferred.save()
+        update = [query['sql'] for query in queries if query['sql'].startswith('UPDATE "cfp_talk"')][0]
+        self.assertIn('"title"', update)
+        self.assertNotIn('"vote_count"', update)
+        self.assertEqual(deferred.get_deferred_fields(), {'description'})
+        Vote.objects.filter(vote=-1).delete()
+        self.assertEqual(Talk.objects.get(pk=talk.pk).vote_sum, 1)
+        Talk.objects.update(vote_count=0, vote_sum=0)
+        call_command('updatevotes', stdout=StringIO())
+        talk = Talk.objects.get(pk=talk.pk)
+        self.assertEqual((talk.vote_count, talk.vote_sum), (1, 1))
+        # a talk deleted meanwhile is not inserted again
+        Talk.objects.filter(pk=talk.pk).delete()
+        with self.assertRaises(DatabaseError), transaction.atomic():
+            stale.save()
+        self.assertFalse(Talk.objects.filter(pk=talk.pk).exists())
+
     def test_talk_decide(self):
         talk = Talk.objects.get(title='Talk 1')
         talk.accepted = None
@@ -695,6 +914,79 @@ class StaffTest(TestCase):
         self.assertEqual(response.status_code, 200)
 
 
+class QueryBudgetTest(TestCase):
+    def test_staff_views(self):
+        site = Site.objects.first()
+        users = create_conference_data(site, talks=30)
+        self.client.force_login(users[0])
+        for measure in measure_staff_views(self.client, site):
+            with self.subTest(view=measure.name):
+                self.assertEqual(measure.status, 200)
+                self.assertLessEqual(len(measure.queries), measure.budget,
+                                     '\n'.join(query['sql'] for query in measure.queries))
+
+    def test_track_statistics(self):
+        site = Site.objects.first()
+        create_conference_data(site, talks=30)
+        with self.assertNumQueries(1):
+            tracks = list(Track.objects.filter(site=site).with_statistics())
+        for track in tracks:
+            talks = list(track.talk_set.all())
+            self.assertEqual(track.talk_count, len(talks))
+            self.assertEqual(track.accepted_talk_count, len([talk for talk in talks if talk.accepted]))
+            self.assertEqual(track.pending_talk_count, len([talk for talk in talks if talk.accepted is None]))
+            self.assertEqual(track.total_duration, sum(talk.estimated_duration for talk in talks))
+            self.assertEqual(track.total_duration, track.estimated_duration())
+            self.assertEqual(track.scheduled_duration, sum(talk.estimated_duration for talk in talks if talk.start_date))
+        self.assertTrue(any(track.scheduled_duration for track in tracks))
+
+    def test_room_list(self):
+        site = Site.objects.first()
+        users = create_conference_data(site, talks=30)
+        Room.objects.create(site=site, name='Empty room')
+        scheduled = Talk.objects.filter(site=site, room__isnull=False, accepted=True).values_list('pk', flat=True)
+        Talk.objects.filter(pk__in=list(scheduled[:5])).update(start_date=None)
+        self.client.force_login(users[0])
+        for room in self.client.get(reverse('room-list')).context['room_list']:
+            self.assertEqual(room.talk_count, room.talks.count())
+            self.assertEqual(room.unscheduled_talk_count, room.unscheduled_talks.count())
+        self.assertEqual(sum(room.unscheduled_talk_count for room in self.client.get(reverse('room-list')).context['room_list']), 5)
+
+
+@override_settings(MIDDLEWARE=settings.MIDDLEWARE + ['ponyconf.profiling.ProfilingMiddleware'], PROFILING_SAMPLE_RATE=1)
+class ProfilingTest(TestCase):
+    def setUp(self):
+        profiling.profiles.clear()
+        profiling.profile_totals.clear()
+        site = Site.objects.first()
+        staff = User.objects.create_user('staff', email='staff@example.org', password='staff')
+        Conference.objects.get(site=site).staff.add(staff)
+        self.client.login(username='staff', password='staff')
+
+    def test_profiles(self):
+        self.client.get(reverse('talk-list'))
+        self.client.get(reverse('staff-schedule'))
+        self.client.post(reverse('markdown-preview'), {'data': '*Pony*'})
+        talk_list, schedule, preview = profiling.profiles
+        self.assertEqual(talk_list['view'], 'talk-list')
+        self.assertGreater(talk_list['db_calls'], 0)
+        self.assertEqual(talk_list['template_calls'], 1)
+        self.assertEqual(schedule['schedule_calls'], 1)
+        self.assertEqual(preview['markdown_calls'], 1)
+        metrics = self.client.get(reverse('staff-metrics')).content.decode('utf-8')
+        self.assertIn('ponyconf_requests_total{view="talk-list"} 1', metrics)
+        self.assertIn('ponyconf_section_calls_total{view="talk-list",section="template"} 1', metrics)
+        self.assertIn('ponyconf_recent_request_seconds_count{view="staff-schedule"} 1', metrics)
+        self.assertIn('ponyconf_conference_cache_total{result="misses"}', metrics)
+
+    def test_sampling(self):
+        with self.settings(PROFILING_SAMPLE_RATE=0.5), patch('ponyconf.profiling.random', side_effect=[0.7, 0.2]):
+            self.client.get(reverse('talk-list'))
+            self.client.get(reverse('talk-list'))
+        self.assertEqual(len(profiling.profiles), 1)
+        self.assertIsNone(profiling.get_profile())
+
+
 class ScheduleTest(TestCase):
     def setUp(self):
         site = Site.objects.first()
@@ -739,7 +1031,274 @@ class ScheduleTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, 'Public tag')
         self.assertNotContains(response, 'Private tag')
-        ET.fromstring(response.content)
+        response = self.client.get(reverse('staff-schedule') + 'xml/')
+        ET.fromstring(b''.join(response.streaming_content))
+
+    def test_xml_queries(self):
+        site = Site.objects.first()
+        with CaptureQueriesContext(connection) as queries:
+            Program(site=site, cache=False).render('xml')
+        room = Room.objects.create(site=site, name='Room 2')
+        category = TalkCategory.objects.get(name='Conference')
+        track = Track.objects.create(site=site, name='Track')
+        participant = Participant.objects.get(name='Participant 1')
+        tag = Tag.objects.get(name='Public tag')
+        start_date = Talk.objects.get(accepted=True).start_date
+        for i in range(10):
+            talk = Talk.objects.create(site=site, title='Talk %d' % i, description='A talk.', category=category, track=track,
+                                       room=room, start_date=start_date + timedelta(days=i % 3, hours=i), duration=45, accepted=True)
+            talk.speakers.add(participant)
+            talk.tags.add(tag)
+        with self.assertNumQueries(len(queries)):
+            xml = Program(site=site, cache=False).render('xml')
+        schedule = ET.fromstring(xml)
+        self.assertEqual(len(schedule.findall('day')), 3)
+        self.assertEqual(len(schedule.findall('day/event')), 11)
+        self.assertEqual(len(schedule.findall("day/event/tags/tag[@slug='public-tag']")), 11)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'schedule-tests'}})
+    def test_cache(self):
+        cache.clear()
+        site = Site.objects.first()
+        other = Site.objects.create(domain='other.example.org', name='Other')
+        xml = Program(site=site, cache=True).render('xml')
+        self.assertIn(b'Participant 1', xml)
+        Program(site=other, cache=True).render('xml')
+        other_version = get_schedule_version(other.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(Program(site=site, cache=True).render('xml'), xml)
+        talk = Talk.objects.get(accepted=True)
+        talk.title = 'Renamed talk'
+        talk.save()
+        self.assertEqual(get_schedule_version(other.pk), other_version)
+        self.assertIn(b'Renamed talk', Program(site=site, cache=True).render('xml'))
+        # while the new version is being rendered, the outdated one is served
+        talk.speakers.clear()
+        with patch('cfp.planning.cache.add', return_value=False):
+            with self.assertNumQueries(0):
+                self.assertIn(b'Renamed talk', Program(site=site, cache=True).render('xml'))
+        self.assertNotIn(b'Participant 1', Program(site=site, cache=True).render('xml'))
+        # the staff can force the invalidation of the schedule of their site
+        self.client.login(username='admin', password='admin')
+        Conference.objects.get(site=site).staff.add(User.objects.get(username='admin'))
+        version = get_schedule_version(site.pk)
+        self.client.get(reverse('schedule-evict'))
+        self.assertNotEqual(get_schedule_version(site.pk), version)
+        self.assertEqual(get_schedule_version(other.pk), other_version)
+
+    def test_version_without_cache(self):
+        site = Site.objects.first()
+        version = get_schedule_version(site.pk)
+        self.assertEqual(get_schedule_version(site.pk), version)
+        talk = Talk.objects.get(accepted=True)
+        talk.speakers.clear()
+        self.assertNotEqual(get_schedule_version(site.pk), version)
+
+    def test_invalidate_on_schedule_fields(self):
+        site = Site.objects.first()
+        talk = Talk.objects.get(accepted=True)
+        participant = Participant.objects.get(name='Participant 1')
+        updated = get_schedule_updated(site.pk)
+        # the schedule does not show the notes nor the biographies
+        with CaptureQueriesContext(connection) as queries:
+            talk.notes = 'Some notes'
+            talk.save()
+            participant.biography = 'New biography'
+            participant.save()
+            talk.save(update_fields=['notes'])
+        self.assertFalse([q for q in queries if 'UPDATE "cfp_conference"' in q['sql']])
+        self.assertEqual(get_schedule_updated(site.pk), updated)
+        talk.title = 'Renamed talk'
+        talk.save()
+        self.assertGreater(get_schedule_updated(site.pk), updated)
+        updated = get_schedule_updated(site.pk)
+        participant.name = 'Renamed participant'
+        participant.save(update_fields=['name'])
+        self.assertGreater(get_schedule_updated(site.pk), updated)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'schedule-tests'}})
+    def test_live_cache_timeout(self):
+        cache.clear()
+        site = Site.objects.first()
+        with patch('cfp.planning.cache.set') as cache_set:
+            Program(site=site, cache=True).render('ics', citymeo=True)
+            Program(site=site, cache=True).render('ics')
+        self.assertEqual([call[0][2] for call in cache_set.call_args_list],
+                         [SCHEDULE_LIVE_CACHE_TIMEOUT, SCHEDULE_CACHE_TIMEOUT])
+
+    def test_conditional_get(self):
+        # the default cache is disabled, the validators come from the database
+        site = Site.objects.first()
+        conf = Conference.objects.get(site=site)
+        conf.schedule_publishing_date = timezone.now() - timedelta(hours=1)
+        conf.save()
+        url = reverse('public-schedule') + 'ics/'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        self.assertFalse([q for q in queries if 'cfp_talk' in q['sql']])
+        self.assertEqual(self.client.get(reverse('public-schedule') + 'xml/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        # the citymeo feed lists the next talks: it has no validators
+        response = self.client.get(reverse('public-schedule') + 'citymeo/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+        self.assertFalse(response.has_header('Last-Modified'))
+        talk = Talk.objects.get(accepted=True)
+        talk.title = 'Renamed talk'
+        talk.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'Renamed talk')
+        self.assertNotEqual(response['ETag'], etag)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'schedule-tests'}},
+                       SCHEDULE_SNAPSHOTS=True)
+    def test_snapshots(self):
+        cache.clear()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        site = Site.objects.first()
+        conf = Conference.objects.get(site=site)
+        with self.settings(MEDIA_ROOT=media_root):
+            call_command('snapshotschedule', stdout=StringIO())
+            self.assertFalse(os.path.exists(os.path.join(media_root, 'schedule', site.domain, 'schedule.xml')))
+            conf.schedule_publishing_date = timezone.now() - timedelta(hours=1)
+            conf.save()
+            call_command('snapshotschedule', stdout=StringIO())
+            path = os.path.join(media_root, 'schedule', site.domain, 'schedule.xml')
+            with open(path, 'rb') as f, gzip.open(path + '.gz') as g:
+                self.assertEqual(f.read(), g.read())
+            self.assertTrue(os.path.exists(os.path.join(media_root, 'schedule', site.domain, 'schedule.ics.gz')))
+            # the citymeo format depends on the current time and is always rendered
+            self.assertFalse(os.path.exists(os.path.join(media_root, 'schedule', site.domain, 'citymeo.ics')))
+            self.assertEqual(self.client.get(reverse('public-schedule') + 'citymeo/').status_code, 200)
+            self.assertFalse(os.path.exists(os.path.join(media_root, 'schedule', site.domain, 'citymeo.ics')))
+            self.client.get(reverse('public-schedule') + 'xml/')
+            with self.assertNumQueries(0):
+                response = self.client.get(reverse('public-schedule') + 'xml/')
+            with open(path, 'rb') as f:
+                self.assertEqual(response.content, f.read())
+            talk = Talk.objects.get(accepted=True)
+            talk.title = 'Renamed talk'
+            talk.save()
+            self.assertFalse(os.path.exists(path))
+            self.assertContains(self.client.get(reverse('public-schedule') + 'xml/'), 'Renamed talk')
+            with open(path, 'rb') as f:
+                self.assertIn(b'Renamed talk', f.read())
+            self.assertEqual(self.client.get(reverse('public-schedule') + 'pdf/').status_code, 404)
+
+    def test_talk_schedule_queries(self):
+        site = Site.objects.create(domain='other.example.org', name='Other')
+        create_conference_data(site, talks=50)
+        talks = Talk.objects.filter(site=site).select_related('category')
+        for talk in talks.with_schedule():
+            self.assertEqual(talk.effective_duration, talk.estimated_duration)
+            self.assertEqual(talk.computed_end, talk.end_date if talk.start_date else None)
+        scheduled = [talk for talk in talks if talk.room and talk.start_date and talk.estimated_duration]
+        self.assertEqual(set(talks.scheduled()), set(scheduled))
+        date = sorted(talk.start_date for talk in scheduled)[len(scheduled) // 2] + timedelta(minutes=10)
+        self.assertEqual(set(talks.at(date)), {talk for talk in scheduled if talk.start_date <= date < talk.end_date})
+        self.assertEqual(set(talks.ending_before(date)), {talk for talk in scheduled if talk.end_date <= date})
+        end = date + timedelta(hours=1)
+        self.assertEqual(set(talks.overlapping(date, end)),
+                         {talk for talk in scheduled if talk.start_date < end and talk.end_date > date})
+        self.assertTrue(talks.at(date).exists())
+
+    def test_find_overlaps(self):
+        intervals = [(0, 10, 'a'), (10, 20, 'b'), (5, 15, 'c'), (12, 13, 'd'), (30, 40, 'e')]
+        self.assertEqual(set(find_overlaps(intervals)), {('a', 'c'), ('c', 'b'), ('b', 'd'), ('c', 'd')})
+        self.assertEqual(find_overlaps([]), [])
+
+    def test_conflicts(self):
+        site = Site.objects.first()
+        talk = Talk.objects.get(accepted=True)
+        participant = Participant.objects.get(name='Participant 1')
+        self.assertEqual(get_conflicts(site), [])
+        same_room = Talk.objects.create(site=site, title='Same room', description='A talk.', category=talk.category,
+                                        room=talk.room, start_date=talk.start_date + timedelta(minutes=30), duration=60)
+        other_room = Talk.objects.create(site=site, title='Other room', description='A talk.', category=talk.category,
+                                         room=Room.objects.create(site=site, name='Room 2'),
+                                         start_date=talk.start_date - timedelta(minutes=30), duration=60)
+        other_room.speakers.add(participant)
+        # refused, cancelled, unlabelled and adjacent talks are not in conflict
+        Talk.objects.create(site=site, title='Refused', description='A talk.', category=talk.category, accepted=False,
+                            room=talk.room, start_date=talk.start_date, duration=60)
+        Talk.objects.create(site=site, title='Cancelled', description='A talk.', category=talk.category, accepted=True,
+                            confirmed=False, room=talk.room, start_date=talk.start_date, duration=60)
+        Talk.objects.create(site=site, title='Unlabelled', description='A talk.', accepted=True,
+                            category=TalkCategory.objects.create(site=site, name='Hidden', label=''),
+                            room=talk.room, start_date=talk.start_date, duration=60)
+        Talk.objects.create(site=site, title='After', description='A talk.', category=talk.category,
+                            room=talk.room, start_date=talk.start_date + timedelta(minutes=90), duration=60)
+        conflicts = get_conflicts(site)
+        self.assertEqual([(c.kind, c.subject, c.talks) for c in conflicts],
+                         [(SPEAKER, participant, (other_room, talk)), (ROOM, talk.room, (talk, same_room))])
+        self.assertEqual(conflicts[0].talks[0].computed_end, talk.start_date + timedelta(minutes=30))
+        self.assertEqual(sorted(get_talk_conflicts(talk)), sorted(conflicts))
+        self.assertEqual(get_talk_conflicts(same_room), conflicts[1:])
+        self.assertEqual(get_talk_conflicts(Talk.objects.get(title='Refused')), [])
+        self.assertEqual(get_talk_conflicts(Talk.objects.get(title='Cancelled')), [])
+        self.assertEqual(get_talk_conflicts(Talk.objects.get(title='Unlabelled')), [])
+        out = StringIO()
+        call_command('checkschedule', stdout=out)
+        self.assertIn('2 conflict(s)', out.getvalue())
+        self.client.login(username='admin', password='admin')
+        response = self.client.get(reverse('schedule-conflicts'))
+        self.assertContains(response, 'Same room')
+        self.assertContains(response, 'Participant 1')
+        # the staff is warned when saving a talk
+        response = self.client.post(reverse('talk-edit', kwargs={'talk_id': same_room.pk}), {
+            'category': same_room.category.pk, 'title': same_room.title, 'description': same_room.description,
+            'start_date': same_room.start_date.strftime('%Y-%m-%d %H:%M'), 'duration': 60, 'room': same_room.room.pk,
+            'speakers': [participant.pk], 'video': '',
+        }, follow=True)
+        warnings = [str(m) for m in response.context['messages']]
+        self.assertEqual(len(warnings), 3, warnings)
+        # and when moving talks with the bulk actions
+        room = talk.room
+        response = self.client.post(reverse('talk-list'), {
+            'talks': [talk.pk, Talk.objects.get(title='After').pk], 'room': other_room.room.slug,
+        }, follow=True)
+        warnings = [m.message for m in response.context['messages'] if m.level == messages.WARNING]
+        self.assertEqual(warnings, ['"Other room" overlaps with "Talk" in the room Room 2.',
+                                    '"Other room" overlaps with "Talk" of the speaker Participant 1.',
+                                    '"Talk" overlaps with "Same room" of the speaker Participant 1.'])
+        # and when saving a talk in the Django admin
+        request = RequestFactory().post('/')
+        request.conference = Conference.objects.get(site=site)
+        request.session = {}
+        request._messages = FallbackStorage(request)
+        form = modelform_factory(Talk, fields=['room'])({'room': room.pk}, instance=Talk.objects.get(pk=talk.pk))
+        self.assertTrue(form.is_valid())
+        form.save(commit=False).save()
+        TalkAdmin(Talk, admin.site).save_related(request, form, [], True)
+        warnings = [str(m) for m in messages.get_messages(request)]
+        self.assertIn('"Talk" overlaps with "Same room" in the room %s.' % room, warnings)
+
+    def test_conflicts_sweep(self):
+        site = Site.objects.create(domain='other.example.org', name='Other')
+        create_conference_data(site, talks=60)
+        first, second, third = scheduled_talks(site)[:3]
+        Talk.objects.filter(pk=second.pk).update(room=first.room, start_date=first.start_date)
+        third.speakers.add(*first.speakers.all())
+        Talk.objects.filter(pk=third.pk).update(start_date=first.start_date)
+        talks = list(scheduled_talks(site))
+        expected = set()
+        for i, first in enumerate(talks):
+            for second in talks[i + 1:]:
+                if first.start_date < second.computed_end and second.start_date < first.computed_end:
+                    if first.room_id == second.room_id:
+                        expected.add((ROOM, first.room_id, frozenset([first.pk, second.pk])))
+                    for speaker in set(first.speakers.all()) & set(second.speakers.all()):
+                        expected.add((SPEAKER, speaker.pk, frozenset([first.pk, second.pk])))
+        conflicts = {(c.kind, c.subject.pk, frozenset(talk.pk for talk in c.talks)) for c in get_conflicts(site)}
+        self.assertEqual(conflicts, expected)
+        self.assertTrue(conflicts)
+        for talk in talks:
+            self.assertEqual({(c.kind, c.subject.pk, frozenset(t.pk for t in c.talks)) for c in get_talk_conflicts(talk)},
+                             {conflict for conflict in expected if talk.pk in conflict[2]})
 
     def test_ics(self):
         self.client.login(username='admin', password='admin')
@@ -754,6 +1313,35 @@ class ScheduleTest(TestCase):
         self.assertNotContains(response, 'Not staff tag')
         self.assertEqual(response.status_code, 200)
 
+    def test_plenary_column(self):
+        site = Site.objects.first()
+        talk = Talk.objects.get(accepted=True)
+        talk.plenary = True
+        talk.save()
+        Talk.objects.create(site=site, category=talk.category, title='Other talk', accepted=True,
+                            room=talk.room, start_date=talk.start_date, duration=30)
+        program = Program(site=site, pending=True, cache=False, staff=True)
+        program.render('html')
+        # plenary talks are placed last, next to the other talks
+        self.assertEqual(program.grid.placements[talk.pk].col, 1)
+
+    def test_grid_columns(self):
+        site = Site.objects.first()
+        room = Room.objects.get(name='Room 1')
+        category = TalkCategory.objects.get(name='Conference')
+        start_date = Talk.objects.get(accepted=True).start_date
+        grid = Grid()
+        t1 = Talk(pk=1001, site=site, category=category, room=room, start_date=start_date, duration=60)
+        t2 = Talk(pk=1002, site=site, category=category, room=room, start_date=start_date + timedelta(minutes=30), duration=60)
+        t3 = Talk(pk=1003, site=site, category=category, room=room, start_date=start_date + timedelta(minutes=60), duration=30)
+        self.assertEqual([grid.add(t).col for t in (t1, t2, t3)], [0, 1, 0])
+        self.assertEqual(grid.cols[room], 2)
+        self.assertEqual(len(grid.timeslots[grid.days[0]]), 4)
+        rows = grid.rows(grid.days[0])
+        self.assertEqual([[event.talk.pk if event else None for event in events[room]] for events in rows.values()],
+                         [[1001], [1001, 1002], [1003, 1002]])
+        self.assertEqual(rows[start_date][room][0].rowcount, 2)
+
     def test_inexistent_format(self):
         self.client.login(username='admin', password='admin')
         self.assertEqual(self.client.get(reverse('staff-schedule') + 'inexistent/').status_code, 404)
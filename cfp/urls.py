@@ -59,7 +59,9 @@ urlpatterns = [
     path('staff/volunteers/email/', views.volunteer_email, name='volunteer-email'),
     path('staff/volunteers/email/preview/', views.volunteer_email_preview, name='volunteer-email-preview'),
     path('staff/add-user/', views.create_user, name='create-user'),
+    path('staff/schedule/conflicts/', views.schedule_conflicts, name='schedule-conflicts'),
     re_path(r'^staff/schedule/((?P<program_format>[\w]+)/)?$', views.staff_schedule, name='staff-schedule'),
+    path('staff/metrics/', views.staff_metrics, name='staff-metrics'),
     path('staff/select2/', views.Select2View.as_view(), name='django_select2-json'),
     path('admin/', views.admin, name='admin'),
     path('admin/conference/', views.conference_edit, name='conference-edit'),
@@ -1,4 +1,5 @@
 from django.utils.crypto import get_random_string
+from django.core.cache import cache
 from django.db.models import Sum
 from django.db.models.functions import Coalesce
 
@@ -10,6 +11,38 @@ def query_sum(queryset, field):
 def generate_user_uid():
     return get_random_string(length=12, allowed_chars='abcdefghijklmnopqrstuvwxyz0123456789')
 
-  
+
+STAFF_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def _staff_key(conference_id):
+    return 'ponyconf-staff-%d' % conference_id
+
+
+def get_staff_ids(conference):
+    """Return the ids of the staff members of the conference as a frozenset."""
+    if hasattr(conference, 'staff_ids'): # set by get_conference
+        return conference.staff_ids
+    prefetched = getattr(conference, '_prefetched_objects_cache', {})
+    if 'staff' in prefetched:
+        return frozenset(user.pk for user in prefetched['staff'])
+    staff_ids = cache.get(_staff_key(conference.pk))
+    if staff_ids is None:
+        staff_ids = frozenset(conference.staff.values_list('pk', flat=True))
+        cache.set(_staff_key(conference.pk), staff_ids, STAFF_CACHE_TIMEOUT)
+    return staff_ids
+
+
+def invalidate_staff_ids(conference_id):
+    cache.delete(_staff_key(conference_id))
+
+
 def is_staff(request, user):
-    return user.is_authenticated and (user.is_superuser or request.conference.staff.filter(pk=user.pk).exists())
+    if not user.is_authenticated:
+        return False
+    if user.is_superuser:
+        return True
+    # resolved once per request, the staff filter is used many times by templates
+    if not hasattr(request, 'staff_ids'):
+        request.staff_ids = get_staff_ids(request.conference)
+    return user.pk in request.staff_ids
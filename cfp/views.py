@@ -5,29 +5,36 @@ from django.urls import reverse, reverse_lazy
 from django.utils.translation import ugettext_lazy as _
 from django.views.generic import DeleteView, FormView, TemplateView
 from django.contrib import messages
+from django.db import transaction
 from django.db.models import Q, Count, Sum
 from django.views.generic import CreateView, DetailView, ListView, UpdateView
-from django.http import HttpResponse, Http404, HttpResponseServerError
+from django.http import HttpResponse, StreamingHttpResponse, Http404, HttpResponseServerError
 from django.utils import timezone
 from django.core.exceptions import PermissionDenied
 from django.core.mail import send_mail
 from django.forms import modelform_factory
 from django import forms
-from django.views.decorators.http import require_http_methods
-from django.core.cache import cache
+from django.conf import settings
+from django.views.decorators.http import require_http_methods, condition
 
 from django_select2.views import AutoResponseView
 
 from functools import reduce
-import csv
 
+from ponyconf.profiling import render_metrics
+from ponyconf.utils import markdown_cache_stats
 from mailing.forms import MessageForm
-from mailing.utils import send_message
-from .planning import Program
+from mailing.utils import send_message, get_fetchmail_stats
+from .middleware import conference_cache_stats
+from .planning import Program, get_schedule_updated, invalidate_schedule, \
+                      SNAPSHOT_FORMATS, read_schedule_snapshot, write_schedule_snapshot, get_schedule_snapshot_date
 from .decorators import speaker_required, volunteer_required, staff_required
 from .mixins import StaffRequiredMixin, OnSiteMixin, OnSiteFormMixin
 from .utils import is_staff
 from .models import Participant, Talk, TalkCategory, Vote, Track, Tag, Room, Volunteer, Activity
+from .export import talks_csv, participants_csv, volunteers_csv
+from .actions import apply_talk_actions
+from .conflicts import get_conflicts, warn_talk_conflicts
 from .emails import talk_email_send, talk_email_render_preview, \
                     speaker_email_send, speaker_email_render_preview, \
                     volunteer_email_send, volunteer_email_render_preview
@@ -187,11 +194,8 @@ def volunteer_list(request):
             return redirect(reverse('volunteer-email'))
         return redirect(request.get_full_path())
     if request.GET.get('format') == 'csv':
-        response = HttpResponse(content_type='text/csv')
+        response = StreamingHttpResponse(volunteers_csv(volunteers), content_type='text/csv')
         response['Content-Disposition'] = 'attachment; filename="volunteers.csv"'
-        writer = csv.writer(response)
-        for volunteer in volunteers:
-            writer.writerow(volunteer.get_csv_row())
         return response
     else:
         contact_link = 'mailto:' + ','.join([volunteer.email for volunteer in volunteers.all()])
@@ -602,6 +606,8 @@ def talk_acknowledgment(request, talk_id, confirm):
         content=thread_note,
     )
     messages.success(request, confirmation_message)
+    if confirm:
+        warn_talk_conflicts(request, [talk])
     return redirect(reverse('talk-details', kwargs=dict(talk_id=talk_id)))
 
 
@@ -641,7 +647,7 @@ def talk_list(request):
             talks = talks.filter(start_date__isnull=not data['scheduled'])
         if len(data['tag']):
             show_filters = True
-            talks = talks.filter(tags__slug__in=data['tag'])
+            talks = talks.filter(tags__slug__in=data['tag']).distinct()
         if len(data['track']):
             show_filters = True
             q = Q()
@@ -673,43 +679,18 @@ def talk_list(request):
     talks = talks.prefetch_related('category', 'speakers', 'track', 'tags')
 
     if request.GET.get('format') == 'csv':
-        response = HttpResponse(content_type='text/csv')
+        response = StreamingHttpResponse(talks_csv(talks), content_type='text/csv')
         response['Content-Disposition'] = 'attachment; filename="talks.csv"'
-        writer = csv.writer(response)
-        for talk in talks:
-            writer.writerow(talk.get_csv_row())
         return response
 
     # Action
     action_form = TalkActionForm(request.POST or None, talks=talks, site=request.conference.site)
     if request.method == 'POST' and action_form.is_valid():
         data = action_form.cleaned_data
-        for talk_id in data['talks']:
-            talk = Talk.objects.get(site=request.conference.site, pk=talk_id)
-            if data['decision'] != None and data['decision'] != talk.accepted:
-                if data['decision']:
-                    action = _('accepted')
-                else:
-                    action = _('declined')
-                note = _('The talk has been %(action)s.') % {'action': action}
-                send_message(
-                    thread=talk.conversation,
-                    author=request.user,
-                    subject=_("[%(conference)s] The talk '%(talk)s' have been %(action)s") % {
-                        'conference': request.conference,
-                        'talk': talk,
-                        'action': action,
-                    },
-                    content=note,
-                )
-                talk.accepted = data['decision']
-            if data['track']:
-                talk.track = Track.objects.get(site=request.conference.site, slug=data['track'])
-            if data['tag']:
-                talk.tags.add(Tag.objects.get(site=request.conference.site, slug=data['tag']))
-            if data['room']:
-                talk.room = Room.objects.get(site=request.conference.site, slug=data['room'])
-            talk.save()
+        apply_talk_actions(request.conference, request.user, data['talks'], decision=data['decision'],
+                           track=data['track'], tag=data['tag'], room=data['room'])
+        if data['room'] or data['decision']:
+            warn_talk_conflicts(request, Talk.objects.filter(site=request.conference.site, pk__in=data['talks']).only('pk'))
         if data['email']:
             email = int(data['email'])
             if email == TalkActionForm.EMAIL_TALKS:
@@ -730,9 +711,12 @@ def talk_list(request):
         'title': 'title',
         'category': 'category',
         'status': 'accepted',
+        'score': 'score',
     }
     sort = request.GET.get('sort')
-    if sort in SORT_MAPPING.keys():
+    if sort == 'score':
+        talks = talks.order_by_score(descending=sort_reverse)
+    elif sort in SORT_MAPPING.keys():
         if sort_reverse:
             talks = talks.order_by('-' + SORT_MAPPING[sort])
         else:
@@ -806,9 +790,10 @@ def talk_vote(request, talk_id, score):
     if score not in [-2, -1, 0, 1, 2]:
         raise Http404
     talk = get_object_or_404(Talk, pk=talk_id, site=request.conference.site)
-    vote, created = Vote.objects.get_or_create(talk=talk, user=request.user)
-    vote.vote = score
-    vote.save()
+    with transaction.atomic():
+        vote, created = Vote.objects.select_for_update().get_or_create(talk=talk, user=request.user)
+        vote.vote = score
+        vote.save()
     messages.success(request, _('Vote successfully created') if created else _('Vote successfully updated'))
     return redirect(talk.get_absolute_url())
 
@@ -849,6 +834,8 @@ def talk_decide(request, talk_id, accept):
             content=_('The talk has been %(action)s.') % {'action': action},
         )
         messages.success(request, _('Decision taken in account'))
+        if accept:
+            warn_talk_conflicts(request, [talk])
         return redirect(talk.get_absolute_url())
     return render(request, 'cfp/staff/talk_decide.html', {
         'talk': talk,
@@ -925,7 +912,7 @@ def participant_list(request):
             if len(data['track']):
                 q |= Q(track__slug__in=data['track'])
             talks = talks.filter(q)
-        participants = participants.filter(talk__in=talks)
+        participants = participants.filter(talk__in=talks).distinct()
     # Action
     action_form = SpeakerActionForm(request.POST or None, speakers=participants)
     if request.method == 'POST' and action_form.is_valid():
@@ -935,11 +922,8 @@ def participant_list(request):
             return redirect(reverse('speaker-email'))
         return redirect(request.get_full_path())
     if request.GET.get('format') == 'csv':
-        response = HttpResponse(content_type='text/csv')
+        response = StreamingHttpResponse(participants_csv(participants), content_type='text/csv')
         response['Content-Disposition'] = 'attachment; filename="participants.csv"'
-        writer = csv.writer(response)
-        for participant in participants:
-            writer.writerow(participant.get_csv_row())
         return response
     else:
         contact_link = 'mailto:' + ','.join([participant.email for participant in participants.all()])
@@ -974,6 +958,7 @@ def participant_details(request, participant_id):
         return redirect(reverse('participant-details', args=[participant.pk]))
     return render(request, 'cfp/staff/participant_details.html', {
         'participant': participant,
+        'talks': participant.talk_set.select_related('category', 'track').prefetch_related('speakers'),
     })
 
 
@@ -1126,6 +1111,11 @@ class TalkUpdate(StaffRequiredMixin, OnSiteMixin, OnSiteFormMixin, UpdateView):
     def get_form_class(self):
         return get_talk_speaker_form_class(self.object.site)
 
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        warn_talk_conflicts(self.request, [self.object])
+        return response
+
 
 class TrackMixin(OnSiteMixin):
     model = Track
@@ -1134,6 +1124,9 @@ class TrackMixin(OnSiteMixin):
 class TrackList(StaffRequiredMixin, TrackMixin, ListView):
     template_name = 'cfp/staff/track_list.html'
 
+    def get_queryset(self):
+        return super().get_queryset().with_statistics()
+
 
 class TrackFormMixin(OnSiteFormMixin, TrackMixin):
     template_name = 'cfp/staff/track_form.html'
@@ -1156,6 +1149,14 @@ class RoomMixin(OnSiteMixin):
 class RoomList(StaffRequiredMixin, RoomMixin, ListView):
     template_name = 'cfp/staff/room_list.html'
 
+    def get_queryset(self):
+        talks = ~Q(talk__accepted=False)
+        unscheduled = Q(talk__start_date__isnull=True) | Q(talk__duration=0, talk__category__duration=0)
+        return super().get_queryset().annotate(
+            talk_count=Count('talk', filter=talks),
+            unscheduled_talk_count=Count('talk', filter=talks & unscheduled),
+        )
+
 
 class RoomDetail(StaffRequiredMixin, RoomMixin, DetailView):
     template_name = 'cfp/staff/room_details.html'
@@ -1290,7 +1291,7 @@ def schedule(request, program_format, pending, template, staff, cache=None):
     elif program_format == 'html':
         return HttpResponse(program.render('html'))
     elif program_format == 'xml':
-        return HttpResponse(program.render('xml'), content_type="application/xml")
+        return StreamingHttpResponse(program.stream('xml'), content_type="application/xml")
     elif program_format in ['ics', 'citymeo']:
         response = HttpResponse(program.render('ics', citymeo=bool(program_format == 'citymeo')), content_type='text/calendar')
         response['Content-Disposition'] = 'attachment; filename="planning.ics"'
@@ -1299,13 +1300,59 @@ def schedule(request, program_format, pending, template, staff, cache=None):
         raise Http404(_("Format '%s' not available" % program_format))
 
 
+def get_public_schedule_updated(request):
+    # read once per request, by the etag and last modified functions
+    if not hasattr(request, 'schedule_updated'):
+        request.schedule_updated = get_schedule_updated(request.conference.site_id)
+    return request.schedule_updated
+
+
+def public_schedule_etag(request, program_format):
+    return '%s-%.6f' % (program_format, get_public_schedule_updated(request).timestamp())
+
+
+def public_schedule_last_modified(request, program_format):
+    return get_public_schedule_updated(request)
+
+
+# the feeds are polled by calendar clients, answer them without rendering
+# the schedule when it has not changed
+@condition(etag_func=public_schedule_etag, last_modified_func=public_schedule_last_modified)
+def public_schedule_feed(request, program_format):
+    return schedule(request, program_format=program_format, pending=False, template='cfp/schedule.html', staff=False)
+
+
+def public_schedule_snapshot_last_modified(request, program_format):
+    if program_format in SNAPSHOT_FORMATS:
+        return get_schedule_snapshot_date(request.conference.site, program_format)
+
+
+@condition(last_modified_func=public_schedule_snapshot_last_modified)
+def public_schedule_snapshot(request, program_format):
+    if program_format not in SNAPSHOT_FORMATS:
+        raise Http404(_("Format '%s' not available" % program_format))
+    content = read_schedule_snapshot(request.conference.site, program_format)
+    if content is None:
+        content = write_schedule_snapshot(request.conference, program_format)
+    response = HttpResponse(content, content_type=SNAPSHOT_FORMATS[program_format][1])
+    if program_format == 'ics':
+        response['Content-Disposition'] = 'attachment; filename="planning.ics"'
+    return response
+
+
 def public_schedule(request, program_format):
     if not request.conference.schedule_available and not is_staff(request, request.user):
         raise PermissionDenied
     if request.conference.schedule_redirection_url and program_format is None:
         return redirect(request.conference.schedule_redirection_url)
-    else:
+    elif program_format is None: # the page depends on the user
         return schedule(request, program_format=program_format, pending=False, template='cfp/schedule.html', staff=False)
+    elif program_format == 'citymeo': # the feed depends on the current time, not only on the schedule
+        return schedule(request, program_format=program_format, pending=False, template='cfp/schedule.html', staff=False)
+    elif getattr(settings, 'SCHEDULE_SNAPSHOTS', False) and program_format in SNAPSHOT_FORMATS:
+        return public_schedule_snapshot(request, program_format)
+    else:
+        return public_schedule_feed(request, program_format)
 
 
 @staff_required
@@ -1313,12 +1360,29 @@ def staff_schedule(request, program_format):
     return schedule(request, program_format=program_format, pending=True, template='cfp/staff/schedule.html', staff=True, cache=False)
 
 
+@staff_required
+def schedule_conflicts(request):
+    return render(request, 'cfp/staff/schedule_conflicts.html', {
+        'conflicts': get_conflicts(request.conference.site),
+    })
+
+
 @staff_required
 def schedule_evict(request):
-    cache.clear()
+    invalidate_schedule(request.conference.site_id)
     messages.success(request, _('Schedule evicted from cache.'))
     return redirect('/')
 
 
+@staff_required
+def staff_metrics(request):
+    content = render_metrics(counters={
+        'conference_cache': conference_cache_stats,
+        'markdown_cache': markdown_cache_stats,
+        'fetchmail': get_fetchmail_stats(),
+    })
+    return HttpResponse(content, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 class Select2View(StaffRequiredMixin, AutoResponseView):
     pass
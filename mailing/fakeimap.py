@@ -0,0 +1,196 @@
+"""
+Minimal in-process IMAP server, used by the tests and the fetchmail benchmark.
+
+It implements just enough of IMAP4rev1 for fetch_imap_box and watch_imap_box:
+LOGIN, ENABLE, SELECT, UID SEARCH/FETCH/COPY/STORE, EXPUNGE and NOOP (announcing
+the new emails), without any authentication check. A delay can be added before each response to simulate
+network latency.
+"""
+
+from collections import OrderedDict
+import re
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+
+TOKEN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|\([^)]*\)|\S+')
+
+
+def parse_uid_set(uid_set, uids):
+    """Return the uids of the mailbox matching an IMAP sequence set like 1:3,5,7:*."""
+    selected = set()
+    last = max(uids) if uids else 0
+    for part in uid_set.split(','):
+        if ':' in part:
+            start, end = (last if n == '*' else int(n) for n in part.split(':'))
+            start, end = min(start, end), max(start, end)
+            selected.update(uid for uid in uids if start <= uid <= end)
+        else:
+            uid = last if part == '*' else int(part)
+            if uid in uids:
+                selected.add(uid)
+    return sorted(selected)
+
+
+class Mailbox:
+    def __init__(self):
+        self.messages = OrderedDict() # uid -> [raw_email, flags]
+        self.next_uid = 1
+
+    def append(self, raw_email, flags=()):
+        uid = self.next_uid
+        self.next_uid += 1
+        self.messages[uid] = [raw_email, set(flags)]
+        return uid
+
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    wbufsize = 64 * 1024 # responses are flushed after the tagged line
+
+    def finish(self):
+        try:
+            super().finish()
+        except OSError:
+            pass # disconnected client
+
+    def send(self, line):
+        self.wfile.write(line if isinstance(line, bytes) else line.encode('utf-8'))
+
+    def handle(self):
+        self.selected = None
+        self.exists = 0
+        self.send('* OK Fake IMAP server ready\r\n')
+        self.wfile.flush()
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            tag, command, *args = TOKEN_RE.findall(line.decode('utf-8'))
+            args = [arg.strip('"') for arg in args]
+            self.server.commands.append(' '.join([command] + args[:1]).upper())
+            if self.server.delay:
+                time.sleep(self.server.delay)
+            with self.server.lock:
+                handler = getattr(self, 'do_' + command.upper(), None)
+                if handler is None:
+                    self.send('%s BAD Unknown command\r\n' % tag)
+                    self.wfile.flush()
+                    continue
+                result = handler(*args)
+            self.send('%s %s\r\n' % (tag, result or 'OK completed'))
+            self.wfile.flush()
+            if command.upper() == 'LOGOUT':
+                break
+
+    def do_CAPABILITY(self):
+        self.send('* CAPABILITY IMAP4rev1 ENABLE UTF8=ACCEPT\r\n')
+
+    def do_LOGIN(self, user, password):
+        pass
+
+    def do_ENABLE(self, *capabilities):
+        self.send('* ENABLED %s\r\n' % ' '.join(capabilities))
+
+    def do_NOOP(self):
+        if self.selected is not None and len(self.selected.messages) != self.exists:
+            self.exists = len(self.selected.messages)
+            self.send('* %d EXISTS\r\n' % self.exists)
+
+    def do_LOGOUT(self):
+        self.send('* BYE\r\n')
+
+    def do_SELECT(self, name):
+        if name not in self.server.mailboxes:
+            return 'NO Mailbox does not exist'
+        self.selected = self.server.mailboxes[name]
+        self.exists = len(self.selected.messages)
+        self.send('* %d EXISTS\r\n' % self.exists)
+        return 'OK [READ-WRITE] SELECT completed'
+
+    def do_EXPUNGE(self):
+        for seq, uid in reversed(list(enumerate(self.selected.messages, start=1))):
+            if '\\Deleted' in self.selected.messages[uid][1]:
+                del self.selected.messages[uid]
+                self.exists -= 1
+                self.send('* %d EXPUNGE\r\n' % seq)
+
+    def do_UID(self, command, *args):
+        return getattr(self, 'uid_' + command.upper())(*args)
+
+    def uid_SEARCH(self, *criteria):
+        uids = [uid for uid, (_, flags) in self.selected.messages.items() if '\\Seen' not in flags]
+        self.send('* SEARCH %s\r\n' % ' '.join(map(str, uids)))
+
+    def uid_FETCH(self, uid_set, items):
+        seqs = {uid: seq for seq, uid in enumerate(self.selected.messages, start=1)}
+        for uid in parse_uid_set(uid_set, list(self.selected.messages)):
+            raw_email, flags = self.selected.messages[uid]
+            flags.add('\\Seen')
+            self.send(('* %d FETCH (UID %d RFC822 {%d}\r\n' % (seqs[uid], uid, len(raw_email))).encode('utf-8')
+                      + raw_email + b')\r\n')
+
+    def uid_COPY(self, uid_set, name):
+        if name not in self.server.mailboxes:
+            return 'NO [TRYCREATE] Mailbox does not exist'
+        for uid in parse_uid_set(uid_set, list(self.selected.messages)):
+            raw_email, flags = self.selected.messages[uid]
+            self.server.mailboxes[name].append(raw_email, flags)
+
+    def uid_STORE(self, uid_set, action, flags):
+        flags = flags.strip('()').split()
+        for uid in parse_uid_set(uid_set, list(self.selected.messages)):
+            if action.upper().startswith('+'):
+                self.selected.messages[uid][1].update(flags)
+            else:
+                self.selected.messages[uid][1].difference_update(flags)
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mailboxes=('INBOX', 'Trash'), delay=0):
+        super().__init__(('127.0.0.1', 0), IMAPHandler)
+        self.mailboxes = {name: Mailbox() for name in mailboxes}
+        self.delay = delay
+        self.lock = threading.RLock()
+        self.commands = []
+        self.requests = set()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def deliver(self, raw_email, name='INBOX'):
+        """Add an email to a mailbox, announced to the clients by their next NOOP."""
+        with self.lock:
+            return self.mailboxes[name].append(raw_email)
+
+    def disconnect(self):
+        """Drop the connections of the clients."""
+        with self.lock:
+            for request in list(self.requests):
+                request.shutdown(socket.SHUT_RDWR)
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], OSError): # disconnected clients are expected
+            super().handle_error(request, client_address)
+
+    def process_request(self, request, client_address):
+        self.requests.add(request)
+        super().process_request(request, client_address)
+
+    def shutdown_request(self, request):
+        self.requests.discard(request)
+        super().shutdown_request(request)
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
@@ -1,6 +1,6 @@
 from django.core.management.base import BaseCommand
 
-from mailing.utils import fetch_imap_box
+from mailing.utils import fetch_imap_box, watch_imap_box, fetchmail_stats
 
 
 class Command(BaseCommand):
@@ -11,7 +11,13 @@ class Command(BaseCommand):
         parser.add_argument('--port', type=int)
         parser.add_argument('--user', required=True)
         parser.add_argument('--password', required=True)
+        parser.add_argument('--no-ssl', action='store_true')
         parser.add_argument('--inbox')
+        parser.add_argument('--batch-size', type=int, default=100, help='Number of emails fetched per IMAP command')
+        parser.add_argument('--workers', type=int, default=1, help='Number of threads processing the emails')
+        parser.add_argument('--watch', action='store_true', help='Keep running and poll the inbox for new emails')
+        parser.add_argument('--poll-interval', type=float, default=5, help='Delay (in seconds) between two checks for new emails in watch mode')
+        parser.add_argument('--stats-interval', type=float, default=60, help='Delay (in seconds) between two reports of the counters in watch mode')
         grp = parser.add_mutually_exclusive_group()
         grp.add_argument('--trash')
         grp.add_argument('--no-trash', action='store_true')
@@ -22,7 +28,11 @@ class Command(BaseCommand):
             'host': options['host'],
             'user': options['user'],
             'password': options['password'],
+            'batch_size': options['batch_size'],
+            'workers': options['workers'],
         }
+        if options['no_ssl']:
+            params['use_ssl'] = False
         if options['port']:
             params['port'] = options['port']
         if options['inbox']:
@@ -31,4 +41,12 @@ class Command(BaseCommand):
             params['trash'] = options['trash']
         elif options['no_trash']:
             params['trash'] = None
-        fetch_imap_box(**params)
+        if not options['watch']:
+            fetch_imap_box(**params)
+            return
+        try:
+            watch_imap_box(poll_interval=options['poll_interval'], stats_interval=options['stats_interval'], **params)
+        except KeyboardInterrupt:
+            pass
+        for key, value in sorted(fetchmail_stats.items()):
+            self.stdout.write('%s: %s' % (key, value))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from time import sleep
+
+from mailing.utils import send_queued_mails
+
+
+class Command(BaseCommand):
+    help = 'Send queued emails'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--loop', action='store_true', help='Keep running and wait for new emails')
+        parser.add_argument('--interval', type=float, default=5, help='Delay (in seconds) between two polls in loop mode')
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = send_queued_mails(batch_size=options['batch_size'])
+            if sent or failed:
+                self.stdout.write('%d sent, %d failed' % (sent, failed))
+                continue
+            if not options['loop']:
+                break
+            sleep(options['interval'])
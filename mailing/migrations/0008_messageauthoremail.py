@@ -0,0 +1,22 @@
+# Generated by Django 2.0.13 on 2026-10-18 09:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0007_outgoingmail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageAuthorEmail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.EmailField(max_length=254, unique=True)),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mailing.MessageAuthor')),
+            ],
+        ),
+    ]
@@ -1,13 +1,22 @@
-from django.db import models
+from django.db import models, transaction, connection
+from django.db.models import Q
+from django.utils import timezone
 from django.utils.crypto import get_random_string
-from django.core.mail import EmailMessage, get_connection
+from django.core.mail import EmailMessage
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth import get_user_model
 
+from collections import defaultdict
+from datetime import timedelta
+from functools import reduce
+from operator import or_
 import hashlib
+import json
+
+from ponyconf.profiling import profiled
 
 
 def generate_message_token():
@@ -27,12 +36,39 @@ class MessageCorrespondent(models.Model):
     token = models.CharField(max_length=64, default=generate_message_token, unique=True)
 
 
+class MessageAuthorManager(models.Manager):
+    def get_for_objects(self, objects):
+        """
+        Return a dict mapping (content type id, pk) of each object to its
+        MessageAuthor, creating the missing ones with a single insert.
+        """
+        keys = {(ContentType.objects.get_for_model(obj).pk, obj.pk) for obj in objects}
+        if not keys:
+            return dict()
+        pks_by_type = defaultdict(set)
+        for author_type_id, author_id in keys:
+            pks_by_type[author_type_id].add(author_id)
+        query = reduce(or_, [Q(author_type_id=author_type_id, author_id__in=pks)
+                             for author_type_id, pks in pks_by_type.items()])
+        authors = {(author.author_type_id, author.author_id): author for author in self.filter(query)}
+        missing = [self.model(author_type_id=author_type_id, author_id=author_id)
+                   for author_type_id, author_id in keys - authors.keys()]
+        if missing:
+            self.bulk_create(missing)
+            # primary keys are not set by bulk_create on every database backend
+            for author in self.filter(token__in=[author.token for author in missing]):
+                authors[(author.author_type_id, author.author_id)] = author
+        return authors
+
+
 class MessageAuthor(models.Model):
     author_type = models.ForeignKey(ContentType, on_delete=models.CASCADE, null=True, blank=True)
     author_id = models.PositiveIntegerField(null=True, blank=True)
     author = GenericForeignKey('author_type', 'author_id')
     token = models.CharField(max_length=64, default=generate_message_token, unique=True)
 
+    objects = MessageAuthorManager()
+
     def __str__(self):
         author_class = self.author_type.model_class()
         if author_class == get_user_model():
@@ -41,18 +77,43 @@ class MessageAuthor(models.Model):
             return str(self.author)
 
 
+class MessageAuthorEmail(models.Model):
+    """Author of the inbound emails sent from an address (lowercase), see mailing.utils.get_email_author."""
+    email = models.EmailField(unique=True)
+    author = models.ForeignKey(MessageAuthor, on_delete=models.CASCADE)
+
+    def __str__(self):
+        return self.email
+
+
 class MessageThread(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     token = models.CharField(max_length=64, default=generate_message_token, unique=True)
 
 
 class MessageManager(models.Manager):
-    def get_queyset(self):
+    def get_queryset(self):
         qs = super().get_queryset()
-        # Does not work so well as prefetch_related is limited to one content type for generic foreign keys
-        qs = qs.prefetch_related('author__author')
+        # the generic authors are resolved on demand with prefetch_related('author__author'),
+        # which costs one query per content type
+        qs = qs.select_related('author__author_type')
         return qs
 
+    @profiled('mail')
+    def send_notifications(self, notifications):
+        """
+        Queue the notifications of several messages at once.
+        `notifications` is a list of (message, keyword arguments of send_notification).
+        The authors of all the recipients are resolved together.
+        """
+        authors = MessageAuthor.objects.get_for_objects(dest for message, kwargs in notifications
+                                                        for dest, dest_name, dest_email in kwargs['dests'])
+        mails = []
+        for message, kwargs in notifications:
+            emails = message.build_notification(authors=authors, **kwargs)
+            mails += [OutgoingMail.from_email_message(email, message=message) for email in emails]
+        return OutgoingMail.objects.bulk_create(mails)
+
 
 class Message(models.Model):
     created = models.DateTimeField(auto_now_add=True)
@@ -69,11 +130,30 @@ class Message(models.Model):
         ordering = ['created']
 
     def send_notification(self, sender, dests, reply_to=None, message_id=None, reference=None, footer=None, subject=None):
+        Message.objects.send_notifications([(self, {
+            'sender': sender,
+            'dests': dests,
+            'reply_to': reply_to,
+            'message_id': message_id,
+            'reference': reference,
+            'footer': footer,
+            'subject': subject,
+        })])
+
+    def build_notification(self, sender, dests, reply_to=None, message_id=None, reference=None, footer=None, subject=None,
+                           authors=None):
+        if authors is None:
+            authors = MessageAuthor.objects.get_for_objects(dest for dest, dest_name, dest_email in dests)
+        # same as hexdigest_sha256(settings.SECRET_KEY, self.token, dest.token), hashing the prefix once
+        key = hashlib.sha256()
+        key.update(str(settings.SECRET_KEY).encode('utf-8'))
+        key.update(self.token.encode('utf-8'))
         messages = []
         for dest, dest_name, dest_email in dests:
-            dest_type = ContentType.objects.get_for_model(dest)
-            dest, _ = MessageAuthor.objects.get_or_create(author_type=dest_type, author_id=dest.pk)
-            token = self.token + dest.token + hexdigest_sha256(settings.SECRET_KEY, self.token, dest.token)[:16]
+            dest = authors[(ContentType.objects.get_for_model(dest).pk, dest.pk)]
+            dest_key = key.copy()
+            dest_key.update(dest.token.encode('utf-8'))
+            token = self.token + dest.token + dest_key.hexdigest()[:16]
             if reply_to:
                 reply_to_name, reply_to_email = reply_to
                 reply_to_list = ['%s <%s>' % (reply_to_name, reply_to_email.format(token=token))]
@@ -99,8 +179,113 @@ class Message(models.Model):
                 reply_to=reply_to_list,
                 headers=headers,
             ))
-        connection = get_connection()
-        connection.send_messages(messages)
+        return messages
 
     def __str__(self):
         return _("Message from %(author)s") % {'author': str(self.author)}
+
+
+class OutgoingMailManager(models.Manager):
+    def enqueue(self, emails, message=None):
+        return self.bulk_create([self.model.from_email_message(email, message=message) for email in emails])
+
+    def pending(self):
+        """Mails due for a delivery attempt, including those of an expired claim."""
+        return self.filter(status__in=[self.model.PENDING, self.model.SENDING], next_attempt__lte=timezone.now())
+
+    def claim(self, owner, batch_size):
+        """
+        Mark a batch of pending mails as being sent by `owner` and return them.
+
+        The claim is a conditional update committed at once, so a mail is never
+        claimed by two workers, even without row locks. If its owner does not
+        record the result before MAILING_CLAIM_TIMEOUT seconds, the mail is
+        pending again.
+        """
+        claim_timeout = getattr(settings, 'MAILING_CLAIM_TIMEOUT', 600)
+        with transaction.atomic():
+            mails = self.pending().order_by('next_attempt', 'pk')
+            if connection.features.has_select_for_update_skip_locked:
+                mails = mails.select_for_update(skip_locked=True)
+            pks = list(mails.values_list('pk', flat=True)[:batch_size])
+            self.pending().filter(pk__in=pks).update(
+                status=self.model.SENDING,
+                owner=owner,
+                next_attempt=timezone.now() + timedelta(seconds=claim_timeout),
+            )
+        return list(self.filter(status=self.model.SENDING, owner=owner))
+
+
+class OutgoingMail(models.Model):
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, _('Pending')),
+        (SENDING, _('Sending')),
+        (SENT, _('Sent')),
+        (FAILED, _('Failed')),
+    )
+
+    created = models.DateTimeField(auto_now_add=True)
+    message = models.ForeignKey(Message, null=True, blank=True, on_delete=models.SET_NULL)
+    subject = models.CharField(max_length=1000, blank=True)
+    body = models.TextField(blank=True)
+    from_email = models.CharField(max_length=1000)
+    to = models.TextField()
+    reply_to = models.TextField(blank=True)
+    headers = models.TextField(blank=True, default='{}')
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    owner = models.CharField(max_length=64, blank=True) # worker sending the mail
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    sent = models.DateTimeField(null=True, blank=True)
+
+    objects = OutgoingMailManager()
+
+    class Meta:
+        ordering = ['pk']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt']),
+        ]
+
+    @classmethod
+    def from_email_message(cls, email, message=None):
+        return cls(
+            message=message,
+            subject=email.subject,
+            body=email.body,
+            from_email=email.from_email,
+            to='\n'.join(email.to),
+            reply_to='\n'.join(email.reply_to),
+            headers=json.dumps(email.extra_headers),
+        )
+
+    def get_email_message(self):
+        return EmailMessage(
+            subject=self.subject,
+            body=self.body,
+            from_email=self.from_email,
+            to=self.to.splitlines(),
+            reply_to=self.reply_to.splitlines(),
+            headers=json.loads(self.headers),
+        )
+
+    def attempt_failed(self, error):
+        """Record a delivery failure and schedule a retry with exponential backoff."""
+        max_attempts = getattr(settings, 'MAILING_MAX_ATTEMPTS', 5)
+        retry_delay = getattr(settings, 'MAILING_RETRY_DELAY', 60)
+        self.attempts += 1
+        self.last_error = str(error)
+        self.owner = ''
+        if self.attempts >= max_attempts:
+            self.status = self.FAILED
+        else:
+            self.status = self.PENDING
+            self.next_attempt = timezone.now() + timedelta(seconds=retry_delay * 2 ** (self.attempts - 1))
+        self.save()
+
+    def __str__(self):
+        return _("Mail to %(to)s (%(status)s)") % {'to': ', '.join(self.to.splitlines()), 'status': self.get_status_display()}
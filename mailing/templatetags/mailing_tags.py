@@ -0,0 +1,43 @@
+from django import template
+from django.core.cache import cache
+from django.db.models import Count, Max
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from django.utils.translation import get_language
+
+
+register = template.Library()
+
+
+MESSAGES_PER_PAGE = 20
+THREAD_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+@register.simple_tag(takes_context=True)
+def message_thread(context, thread, per_page=MESSAGES_PER_PAGE):
+    """
+    Render the messages of a thread, by pages of per_page messages. The last page
+    is shown unless the messages_page GET parameter asks for an older one.
+    Rendered pages are cached, keyed by the id of the last message of the thread.
+    """
+    messages = thread.message_set.order_by('created', 'pk')
+    stats = messages.aggregate(count=Count('pk'), last=Max('pk'))
+    num_pages = max(1, (stats['count'] + per_page - 1) // per_page)
+    try:
+        page = int(context['request'].GET.get('messages_page', num_pages))
+    except ValueError:
+        page = num_pages
+    page = min(max(page, 1), num_pages)
+    key = 'mailing-thread-%d-%s-%d-%d-%s' % (thread.pk, stats['last'], page, per_page, get_language())
+    html = cache.get(key)
+    if html is None:
+        messages = messages.prefetch_related('author__author')[(page - 1) * per_page:page * per_page]
+        html = render_to_string('mailing/_message_list.html', {
+            'messages': messages,
+            'page': page,
+            'num_pages': num_pages,
+            'previous_page': page - 1,
+            'next_page': page + 1 if page < num_pages else None,
+        })
+        cache.set(key, html, THREAD_CACHE_TIMEOUT)
+    return mark_safe(html)
@@ -1,11 +1,269 @@
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.urls import reverse
-from django.test import TestCase, override_settings
+from django.test import TestCase, RequestFactory, override_settings
+from django.template import Context, Template
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from django.core import mail
+from django.core.mail.backends.base import BaseEmailBackend
 from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
 
-from .models import Message, MessageThread, MessageCorrespondent
+import threading
+import time
+
+from cfp.models import Participant
+from .fakeimap import FakeIMAPServer
+from .models import Message, MessageThread, MessageAuthor, MessageAuthorEmail, MessageCorrespondent, OutgoingMail, \
+                    hexdigest_sha256
+from .utils import send_message, send_queued_mails, fetch_imap_box, watch_imap_box, fetchmail_stats, get_fetchmail_stats, process_email, \
+                   get_email_author, process_new_token
+
+
+class FailingBackend(BaseEmailBackend):
+    def send_messages(self, email_messages):
+        raise ConnectionError('SMTP server unavailable')
+
+
+class OutgoingMailTests(TestCase):
+    def setUp(self):
+        site = Site.objects.first()
+        self.conference = site.conference
+        self.conference.name = 'PonyConf'
+        self.conference.contact_email = 'contact@example.org'
+        self.conference.save()
+        self.participant = Participant.objects.create(site=site, name='Participant', email='participant@example.org')
+
+    def test_enqueue(self):
+        send_message(self.participant.conversation, self.conference, subject='Hello', content='Hello you')
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutgoingMail.objects.filter(status=OutgoingMail.PENDING).count(), 1)
+        self.assertEqual(send_queued_mails(), (1, 0))
+        self.assertEqual(send_queued_mails(), (0, 0))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['Participant <participant@example.org>'])
+        self.assertEqual(mail.outbox[0].extra_headers['Message-ID'], '<%s@%s>' % (Message.objects.get().token, 'example.com'))
+        outgoing = OutgoingMail.objects.get()
+        self.assertEqual(outgoing.status, OutgoingMail.SENT)
+        self.assertEqual(outgoing.attempts, 1)
+
+    def test_fan_out(self):
+        def notify_staff():
+            with CaptureQueriesContext(connection) as queries:
+                send_message(self.participant.conversation, self.participant, subject='Hello', content='Hello staff')
+            return len(queries)
+        self.conference.reply_email = 'reply+{token}@example.org'
+        self.conference.save()
+        staff = [User.objects.create_user('staff%d' % i, email='staff%d@example.org' % i) for i in range(10)]
+        self.conference.staff.add(*staff[:2])
+        notify_staff()
+        queries = notify_staff()
+        self.conference.staff.add(*staff[2:])
+        # the authors of the new staff members are created with a single insert
+        self.assertEqual(notify_staff(), queries + 2)
+        self.assertEqual(notify_staff(), queries)
+        message = Message.objects.last()
+        self.assertEqual(message.outgoingmail_set.count(), 10)
+        outgoing = message.outgoingmail_set.get(to=' <staff3@example.org>')
+        token = outgoing.reply_to.split('+')[1].split('@')[0]
+        self.assertEqual(process_new_token(token), (message, MessageAuthor.objects.get(author_id=staff[3].pk, author_type__model='user')))
+
+    def test_claim(self):
+        for i in range(3):
+            send_message(self.participant.conversation, self.conference, subject='Hello %d' % i, content='Hello you')
+        first = OutgoingMail.objects.claim('first', batch_size=2)
+        second = OutgoingMail.objects.claim('second', batch_size=2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertEqual(OutgoingMail.objects.claim('third', batch_size=2), [])
+        self.assertEqual(send_queued_mails(), (0, 0))
+        # the claims of a crashed worker expire
+        OutgoingMail.objects.filter(owner='first').update(next_attempt=timezone.now())
+        self.assertEqual(send_queued_mails(), (2, 0))
+        self.assertEqual(OutgoingMail.objects.filter(status=OutgoingMail.SENT).count(), 2)
+        self.assertEqual(OutgoingMail.objects.filter(status=OutgoingMail.SENDING, owner='second').count(), 1)
+
+    @override_settings(EMAIL_BACKEND='mailing.tests.FailingBackend', MAILING_MAX_ATTEMPTS=2)
+    def test_retry(self):
+        send_message(self.participant.conversation, self.conference, subject='Hello', content='Hello you')
+        self.assertEqual(send_queued_mails(), (0, 1))
+        outgoing = OutgoingMail.objects.get()
+        self.assertEqual(outgoing.status, OutgoingMail.PENDING)
+        self.assertEqual(outgoing.attempts, 1)
+        self.assertIn('SMTP server unavailable', outgoing.last_error)
+        self.assertGreater(outgoing.next_attempt, timezone.now())
+        self.assertEqual(send_queued_mails(), (0, 0))
+        OutgoingMail.objects.update(next_attempt=timezone.now())
+        self.assertEqual(send_queued_mails(), (0, 1))
+        self.assertEqual(OutgoingMail.objects.get().status, OutgoingMail.FAILED)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'thread-tests'}})
+class MessageThreadTests(TestCase):
+    def setUp(self):
+        site = Site.objects.first()
+        self.conference = site.conference
+        self.conference.name = 'PonyConf'
+        self.conference.save()
+        self.participant = Participant.objects.create(site=site, name='Participant', email='participant@example.org')
+        staff = User.objects.create_user('staff', email='staff@example.org', first_name='Staff', last_name='Member')
+        for i in range(25):
+            author = [self.conference, self.participant, staff][i % 3]
+            send_message(self.participant.conversation, author, subject='Message %d' % i, content='Content %d' % i)
+        cache.clear()
+
+    def render(self, query=''):
+        template = Template('{% load mailing_tags %}{% message_thread thread %}')
+        context = Context({'thread': self.participant.conversation, 'request': RequestFactory().get('/' + query)})
+        with CaptureQueriesContext(connection) as queries:
+            html = template.render(context)
+        return html, len(queries)
+
+    def test_pages(self):
+        html, queries = self.render()
+        self.assertIn('Message 24', html)
+        self.assertNotIn('Message 4<', html)
+        self.assertIn('Staff Member', html)
+        self.assertIn('?messages_page=1', html)
+        # aggregate, messages, and one query per author content type
+        self.assertEqual(queries, 5)
+        html, queries = self.render('?messages_page=1')
+        self.assertIn('Message 0', html)
+        self.assertNotIn('Message 24', html)
+        self.assertIn('?messages_page=2', html)
+
+    def test_cache(self):
+        html, queries = self.render()
+        self.assertEqual(self.render(), (html, 1))
+        send_message(self.participant.conversation, self.participant, subject='Message 25', content='New')
+        html, queries = self.render()
+        self.assertIn('Message 25', html)
+        self.assertEqual(queries, 5)
+
+
+def make_reply(token, subject='Re: Hello', content='Hello staff'):
+    return ('From: participant@example.org\r\n'
+            'To: reply+%s@example.org\r\n'
+            'Subject: %s\r\n'
+            'Content-Type: text/plain; charset=utf-8\r\n'
+            '\r\n'
+            '%s\r\n' % (token, subject, content)).encode('utf-8')
+
+
+class FetchMailTests(TestCase):
+    def setUp(self):
+        site = Site.objects.first()
+        conference = site.conference
+        conference.name = 'PonyConf'
+        conference.contact_email = 'contact@example.org'
+        conference.save()
+        participant = Participant.objects.create(site=site, name='Participant', email='Participant@Example.org')
+        send_message(participant.conversation, conference, subject='Hello', content='Hello you')
+        message = Message.objects.get()
+        author = MessageAuthor.objects.get(author_id=participant.pk, author_type__model='participant')
+        self.token = message.token + author.token + hexdigest_sha256(settings.SECRET_KEY, message.token, author.token)[:16]
+
+    def fetch(self, server, **kwargs):
+        return fetch_imap_box(user='user', password='password', host='127.0.0.1', port=server.port,
+                              use_ssl=False, **kwargs)
+
+    def test_fetch(self):
+        with FakeIMAPServer() as server:
+            inbox = server.mailboxes['INBOX']
+            for i in range(3):
+                inbox.append(make_reply(self.token, content='Reply %d' % i))
+            no_token = inbox.append(make_reply('x'))
+            invalid_key = inbox.append(make_reply(self.token[:64] + '0' * 16))
+            self.assertEqual(self.fetch(server, batch_size=2), (3, 2))
+            self.assertEqual(server.commands.count('UID FETCH'), 3)
+            self.assertEqual(server.commands.count('UID COPY'), 2)
+            self.assertEqual(len(server.mailboxes['Trash'].messages), 3)
+            self.assertEqual(set(inbox.messages), {no_token, invalid_key})
+            self.assertIn('NoTokenFound', inbox.messages[no_token][1])
+            self.assertIn('InvalidKey', inbox.messages[invalid_key][1])
+        self.assertEqual(Message.objects.filter(content__startswith='Reply').count(), 3)
+        self.assertEqual(Message.objects.filter(in_reply_to__isnull=False).count(), 3)
+
+    def test_workers(self):
+        processed = []
+        def process(raw_email):
+            if b'Fail' in raw_email:
+                raise ValueError
+            processed.append(raw_email)
+        with FakeIMAPServer() as server:
+            inbox = server.mailboxes['INBOX']
+            for i in range(20):
+                inbox.append(make_reply(self.token, content='Fail' if i % 5 == 0 else 'Reply %d' % i))
+            self.assertEqual(self.fetch(server, batch_size=8, workers=3, trash=None, process=process), (16, 4))
+            self.assertEqual(len(processed), 16)
+            self.assertEqual(len(inbox.messages), 4)
+            self.assertTrue(all('UnknowError' in flags for _, flags in inbox.messages.values()))
+
+    def test_token_case(self):
+        with CaptureQueriesContext(connection) as queries:
+            process_email(make_reply(self.token.upper()))
+        self.assertEqual(Message.objects.filter(in_reply_to__isnull=False).count(), 1)
+        self.assertFalse([q for q in queries if 'LIKE' in q['sql'] or 'UPPER' in q['sql']])
+
+    def test_old_token(self):
+        participant = Participant.objects.get()
+        thread = participant.conversation
+        sender = MessageCorrespondent.objects.create(email='Participant@example.org')
+        token = thread.token + sender.token + hexdigest_sha256(settings.SECRET_KEY, thread.token, sender.token)[:16]
+        process_email(make_reply(token))
+        self.assertEqual(Message.objects.last().author.author, participant)
+        self.assertEqual(MessageAuthorEmail.objects.get().email, 'participant@example.org')
+        # the addresses are kept as entered, only the index key is lowercase
+        participant.refresh_from_db()
+        self.assertEqual(participant.email, 'Participant@Example.org')
+        MessageAuthorEmail.objects.all().delete()
+        self.assertEqual(get_email_author('PARTICIPANT@example.org').author_id, participant.pk)
+        self.assertEqual(MessageAuthorEmail.objects.get().email, 'participant@example.org')
+        with self.assertNumQueries(1):
+            self.assertEqual(get_email_author('participant@example.org').author_id, participant.pk)
+        # a user account takes precedence over the participant
+        user = User.objects.create_user('participant', email='participant@example.org')
+        self.assertFalse(MessageAuthorEmail.objects.exists())
+        process_email(make_reply(token))
+        self.assertEqual(Message.objects.last().author.author, user)
+        user.email = 'other@example.org'
+        user.save()
+        self.assertEqual(get_email_author('participant@example.org').author, participant)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'fetchmail-tests'}})
+    def test_watch(self):
+        processed = []
+        stop = threading.Event()
+        def wait_for(condition):
+            deadline = time.monotonic() + 5
+            while not condition():
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+        with FakeIMAPServer() as server:
+            server.deliver(make_reply(self.token, content='Reply 1'))
+            stats = fetchmail_stats.copy()
+            watcher = threading.Thread(target=watch_imap_box, args=('user', 'password', '127.0.0.1'), kwargs={
+                'port': server.port, 'use_ssl': False, 'process': processed.append,
+                'poll_interval': 0.05, 'retry_delay': 0.05, 'stop': stop,
+            })
+            watcher.start()
+            try:
+                wait_for(lambda: len(processed) == 1 and 'NOOP' in server.commands)
+                server.deliver(make_reply(self.token, content='Reply 2'))
+                wait_for(lambda: len(processed) == 2)
+                server.disconnect()
+                server.deliver(make_reply(self.token, content='Reply 3'))
+                wait_for(lambda: len(processed) == 3)
+            finally:
+                stop.set()
+                watcher.join()
+        self.assertEqual(fetchmail_stats['processed'] - stats['processed'], 3)
+        self.assertEqual(fetchmail_stats['connections'] - stats['connections'], 2)
+        self.assertGreaterEqual(fetchmail_stats['notifications'] - stats['notifications'], 1)
+        # the counters are reported while running and on exit
+        self.assertEqual(get_fetchmail_stats()['processed'], fetchmail_stats['processed'])
 
 
 #class MailingTests(TestCase):
@@ -1,8 +1,16 @@
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction, connection as db_connection
+from django.core.mail import get_connection
 from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+from django.core.cache import cache
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from uuid import uuid4
 import imaplib
+import threading
 import ssl
 import logging
 from email import policy
@@ -11,7 +19,15 @@ import chardet
 import re
 
 from cfp.models import User, Conference, Participant
-from .models import MessageThread, MessageCorrespondent, MessageAuthor, Message, hexdigest_sha256
+from .models import MessageThread, MessageCorrespondent, MessageAuthor, MessageAuthorEmail, Message, OutgoingMail, hexdigest_sha256
+
+
+# counters of fetched emails, failures by error tag, IMAP connections, and
+# announcement to processing latency (sum in seconds) of the watcher
+fetchmail_stats = Counter()
+
+FETCHMAIL_STATS_KEY = 'ponyconf-fetchmail-stats'
+FETCHMAIL_STATS_TIMEOUT = 24 * 60 * 60
 
 
 class NoTokenFoundException(Exception):
@@ -36,78 +52,278 @@ def send_message(thread, author, subject, content, in_reply_to=None):
     )
 
 
-def fetch_imap_box(user, password, host, port=993, use_ssl=True, inbox='INBOX', trash='Trash'):
-    logging.basicConfig(level=logging.DEBUG)
-    context = ssl.create_default_context()
-    success, failure = 0, 0
+def send_queued_mails(batch_size=100):
+    """
+    Send a batch of pending mails over a single connection.
+
+    The mails are claimed in a short transaction and sent outside of it, so
+    concurrent workers never send the same mail; the mails of a crashed worker
+    are pending again after MAILING_CLAIM_TIMEOUT seconds.
+    Returns the number of sent and failed mails.
+    """
+    sent, failed = 0, 0
+    owner = uuid4().hex
+    mails = OutgoingMail.objects.claim(owner, batch_size)
+    if not mails:
+        return sent, failed
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as e:
+        logging.exception("Unable to open mail connection")
+        for mail in mails:
+            mail.attempt_failed(e)
+        return sent, len(mails)
+    delivered = []
+    try:
+        for mail in mails:
+            try:
+                connection.send_messages([mail.get_email_message()])
+            except Exception as e:
+                logging.warning("Unable to send mail %d: %s" % (mail.pk, e))
+                mail.attempt_failed(e)
+                failed += 1
+            else:
+                delivered.append(mail.pk)
+    finally:
+        connection.close()
+    sent = OutgoingMail.objects.filter(pk__in=delivered, owner=owner).update(
+        status=OutgoingMail.SENT,
+        sent=timezone.now(),
+        attempts=models.F('attempts') + 1,
+        last_error='',
+        owner='',
+    )
+    return sent, failed
+
+
+def error_tag(error):
+    """IMAP flag set on the emails whose processing failed with this error."""
+    if isinstance(error, NoTokenFoundException):
+        return 'NoTokenFound'
+    elif isinstance(error, InvalidTokenException):
+        return 'InvalidToken'
+    elif isinstance(error, InvalidKeyException):
+        return 'InvalidKey'
+    else:
+        return 'UnknowError'
+
+
+def uid_set(uids):
+    return b','.join(uids)
+
+
+def parse_fetch_response(data):
+    """Return a dict uid -> raw email from the response of a UID FETCH (RFC822)."""
+    emails = dict()
+    uid_regex = re.compile(rb'UID (\d+)')
+    for i, item in enumerate(data):
+        if not isinstance(item, tuple):
+            continue
+        m = uid_regex.search(item[0])
+        if m is None and i + 1 < len(data) and isinstance(data[i + 1], bytes):
+            # some servers send the UID after the message literal
+            m = uid_regex.search(data[i + 1])
+        if m is None:
+            logging.warning("No UID found in FETCH response: %r" % item[0])
+            continue
+        emails[m.group(1)] = item[1]
+    return emails
+
+
+def process_emails(emails, process=None, close_connection=False):
+    """
+    Process each (uid, raw email) in its own transaction.
+    Return a list of (uid, error), error being None on success.
+    """
+    process = process or process_email
+    results = []
+    try:
+        for uid, raw_email in emails:
+            try:
+                with transaction.atomic():
+                    process(raw_email)
+            except Exception as e:
+                logging.exception("An error occured during mail processing")
+                results.append((uid, e))
+            else:
+                results.append((uid, None))
+    finally:
+        if close_connection:
+            # worker threads have their own database connection
+            db_connection.close()
+    return results
+
+
+def imap_connect(user, password, host, port=993, use_ssl=True):
     kwargs = {'host': host, 'port': port}
     if use_ssl:
         IMAP4 = imaplib.IMAP4_SSL
         kwargs.update({'ssl_context': ssl.create_default_context()})
     else:
         IMAP4 = imaplib.IMAP4
-    with IMAP4(**kwargs) as M:
+    M = IMAP4(**kwargs)
+    try:
         typ, data = M.login(user, password)
         if typ != 'OK':
             raise Exception(data[0].decode('utf-8'))
         typ, data = M.enable('UTF8=ACCEPT')
         if typ != 'OK':
             raise Exception(data[0].decode('utf-8'))
-        if trash is not None:
-            # Vérification de l’existence de la poubelle
-            typ, data = M.select(mailbox=trash)
-            if typ != 'OK':
-                raise Exception(data[0].decode('utf-8'))
-        typ, data = M.select(mailbox=inbox)
+    except Exception:
+        M.shutdown()
+        raise
+    return M
+
+
+def fetch_imap_box(user, password, host, port=993, use_ssl=True, inbox='INBOX', trash='Trash',
+                   batch_size=100, workers=1, process=None):
+    """
+    Fetch and process the unseen emails of an IMAP inbox.
+
+    Emails are fetched by batches of batch_size UIDs with one command, and
+    processed by a pool of workers threads. Successfully processed emails are
+    copied to the trash (if any) and deleted, the others are flagged with the
+    error tag, with one command per batch. Return the number of processed emails
+    and failures.
+    """
+    logging.basicConfig(level=logging.DEBUG)
+    with imap_connect(user, password, host, port, use_ssl) as M:
+        success, failure = process_imap_box(M, inbox, trash, batch_size, workers, process)
+    if failure:
+        total = success + failure
+        logging.info("Total: %d, success: %d, failure: %d" % (total, success, failure))
+    return success, failure
+
+
+def process_imap_box(M, inbox='INBOX', trash='Trash', batch_size=100, workers=1, process=None):
+    success, failure = 0, 0
+    if trash is not None:
+        # Vérification de l’existence de la poubelle
+        typ, data = M.select(mailbox=trash)
         if typ != 'OK':
             raise Exception(data[0].decode('utf-8'))
-        typ, data = M.uid('search', None, 'UNSEEN')
+    typ, data = M.select(mailbox=inbox)
+    if typ != 'OK':
+        raise Exception(data[0].decode('utf-8'))
+    typ, data = M.uid('search', None, 'UNSEEN')
+    if typ != 'OK':
+        raise Exception(data[0].decode('utf-8'))
+    uids = data[0].split()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i in range(0, len(uids), batch_size):
+            s, f = fetch_imap_batch(M, uids[i:i+batch_size], trash, workers, executor, process)
+            success += s
+            failure += f
+    typ, data = M.expunge()
+    if typ != 'OK':
+        failure += 1
+        raise Exception(data[0].decode('utf-8'))
+    fetchmail_stats['processed'] += success
+    fetchmail_stats['failures'] += failure
+    return success, failure
+
+
+def report_fetchmail_stats():
+    """Log the fetchmail counters and share them with the staff metrics view."""
+    logging.info("fetchmail: %s" % ', '.join('%s=%s' % item for item in sorted(fetchmail_stats.items())))
+    cache.set(FETCHMAIL_STATS_KEY, fetchmail_stats.copy(), FETCHMAIL_STATS_TIMEOUT)
+
+
+def get_fetchmail_stats():
+    """Return the last counters reported by a running watcher, if any."""
+    return cache.get(FETCHMAIL_STATS_KEY) or Counter()
+
+
+def imap_wait(M, poll_interval, timeout, stop):
+    """
+    Poll the selected mailbox with NOOP every poll_interval seconds, until the
+    server announces new emails (untagged EXISTS response), `timeout` seconds
+    elapsed or `stop` is set. Return the time of the announcement, or None.
+    """
+    deadline = monotonic() + timeout
+    M.response('EXISTS') # forget the size announced by SELECT
+    while monotonic() < deadline and not stop.wait(poll_interval):
+        typ, data = M.noop()
         if typ != 'OK':
             raise Exception(data[0].decode('utf-8'))
-        for num in data[0].split():
-            typ, data = M.uid('fetch', num, '(RFC822)')
-            if typ != 'OK':
-                failure += 1
-                logging.warning(data[0].decode('utf-8'))
-                continue
-            raw_email = data[0][1]
-            try:
-                process_email(raw_email)
-            except Exception as e:
-                failure += 1
-                logging.exception("An error occured during mail processing")
-                if type(e) == NoTokenFoundException:
-                    tag = 'NoTokenFound'
-                if type(e) == InvalidTokenException:
-                    tag = 'InvalidToken'
-                if type(e) == InvalidKeyException:
-                    tag = 'InvalidKey'
-                else:
-                    print('Unexpected error:', e)
-                    tag = 'UnknowError'
-                typ, data = M.uid('store', num, '+FLAGS', tag)
-                if typ != 'OK':
-                    logging.warning(data[0].decode('utf-8'))
-                continue
-            if trash is not None:
-                typ, data = M.uid('copy', num, trash)
-                if typ != 'OK':
-                    failure += 1
-                    logging.warning(data[0].decode('utf-8'))
-                    continue
-            typ, data = M.uid('store', num, '+FLAGS', '\Deleted')
-            if typ != 'OK':
-                failure += 1
-                logging.warning(data[0].decode('utf-8'))
-                continue
-            success += 1
-        typ, data = M.expunge()
+        if M.response('EXISTS')[1] != [None]:
+            return monotonic()
+    return None
+
+
+def watch_imap_box(user, password, host, port=993, use_ssl=True, inbox='INBOX', trash='Trash',
+                   batch_size=100, workers=1, process=None,
+                   poll_interval=5, stats_interval=60, retry_delay=1, max_retry_delay=300, stop=None):
+    """
+    Keep an IMAP connection open and poll it with NOOP every poll_interval
+    seconds (IMAP IDLE is not used), processing the new emails the server
+    announces, until the `stop` event is set. The whole inbox is checked again and the counters are
+    reported every stats_interval seconds. The connection is re-established
+    with exponential backoff on errors.
+    """
+    stop = stop or threading.Event()
+    delay = retry_delay
+    reported_at = monotonic()
+    while not stop.is_set():
+        try:
+            with imap_connect(user, password, host, port, use_ssl) as M:
+                fetchmail_stats['connections'] += 1
+                delay = retry_delay
+                notified_at = None
+                while not stop.is_set():
+                    process_imap_box(M, inbox, trash, batch_size, workers, process)
+                    if notified_at is not None:
+                        fetchmail_stats['notifications'] += 1
+                        fetchmail_stats['latency'] += monotonic() - notified_at
+                    if monotonic() - reported_at >= stats_interval:
+                        report_fetchmail_stats()
+                        reported_at = monotonic()
+                    notified_at = imap_wait(M, poll_interval, stats_interval, stop)
+        except Exception as e:
+            fetchmail_stats['disconnections'] += 1
+            logging.warning("IMAP connection lost (%s), retrying in %s seconds" % (e, delay))
+            stop.wait(delay)
+            delay = min(delay * 2, max_retry_delay)
+    report_fetchmail_stats()
+
+
+def fetch_imap_batch(M, uids, trash, workers, executor, process):
+    success, failure = 0, 0
+    typ, data = M.uid('fetch', uid_set(uids), '(UID RFC822)')
+    if typ != 'OK':
+        logging.warning(data[0].decode('utf-8'))
+        return 0, len(uids)
+    emails = parse_fetch_response(data)
+    failure += len(uids) - len(emails)
+    emails = [(uid, emails[uid]) for uid in uids if uid in emails]
+    if workers > 1:
+        chunks = [emails[i::workers] for i in range(workers)]
+        results = sum(executor.map(lambda chunk: process_emails(chunk, process, close_connection=True), chunks), [])
+    else:
+        results = process_emails(emails, process)
+    processed = [uid for uid, error in results if error is None]
+    errors = dict()
+    for uid, error in results:
+        if error is not None:
+            errors.setdefault(error_tag(error), []).append(uid)
+    for tag, tagged in errors.items():
+        failure += len(tagged)
+        fetchmail_stats['failures_%s' % tag] += len(tagged)
+        typ, data = M.uid('store', uid_set(tagged), '+FLAGS', tag)
         if typ != 'OK':
-            failure += 1
-            raise Exception(data[0].decode('utf-8'))
-    if failure:
-        total = success + failure
-        logging.info("Total: %d, success: %d, failure: %d" % (total, success, failure))
+            logging.warning(data[0].decode('utf-8'))
+    if processed and trash is not None:
+        typ, data = M.uid('copy', uid_set(processed), trash)
+        if typ != 'OK':
+            logging.warning(data[0].decode('utf-8'))
+            return success, failure + len(processed)
+    if processed:
+        typ, data = M.uid('store', uid_set(processed), '+FLAGS', '\\Deleted')
+        if typ != 'OK':
+            logging.warning(data[0].decode('utf-8'))
+            return success, failure + len(processed)
+    return success + len(processed), failure
 
 
 def process_email(raw_email):
@@ -130,7 +346,8 @@ def process_email(raw_email):
     if not m:
         raise NoTokenFoundException
 
-    token = m.group('token')
+    # tokens are generated lowercase: exact lookups can use the unique indexes
+    token = m.group('token').lower()
 
     try:
         in_reply_to, author = process_new_token(token)
@@ -144,12 +361,12 @@ def process_email(raw_email):
 
 def process_new_token(token):
     try:
-        in_reply_to = Message.objects.get(token__iexact=token[:32])
-        author = MessageAuthor.objects.get(token__iexact=token[32:64])
+        in_reply_to = Message.objects.get(token=token[:32])
+        author = MessageAuthor.objects.get(token=token[32:64])
     except models.ObjectDoesNotExist:
         raise InvalidTokenException
 
-    if token[64:].lower() != hexdigest_sha256(settings.SECRET_KEY, in_reply_to.token, author.token)[:16]:
+    if token[64:] != hexdigest_sha256(settings.SECRET_KEY, in_reply_to.token, author.token)[:16]:
         raise InvalidKeyException
 
     return in_reply_to, author
@@ -157,34 +374,42 @@ def process_new_token(token):
 
 def process_old_token(token):
     try:
-        thread = MessageThread.objects.get(token__iexact=token[:32])
-        sender = MessageCorrespondent.objects.get(token__iexact=token[32:64])
+        thread = MessageThread.objects.get(token=token[:32])
+        sender = MessageCorrespondent.objects.get(token=token[32:64])
     except models.ObjectDoesNotExist:
         raise InvalidTokenException
 
-    if token[64:].lower() != hexdigest_sha256(settings.SECRET_KEY, thread.token, sender.token)[:16]:
+    if token[64:] != hexdigest_sha256(settings.SECRET_KEY, thread.token, sender.token)[:16]:
         raise InvalidKeyException
 
     in_reply_to = thread.message_set.last()
-    author = None
+    author = get_email_author(sender.email)
+
+    return in_reply_to, author
 
-    if author is None:
-        try:
-            author = User.objects.get(email=sender.email)
-        except User.DoesNotExist:
-            pass
-    if author is None:
-        try:
-            author = Participant.objects.get(email=sender.email)
-        except Participant.DoesNotExist:
-            pass
-    if author is None:
-        try:
-            author = Conference.objects.get(contact_email=sender.email)
-        except Conference.DoesNotExist:
-            raise # this was last hope...
 
+def get_email_author(email):
+    """
+    Return the MessageAuthor sending from this address: a user, else a
+    participant, else a conference contact address. Resolved addresses are
+    stored in MessageAuthorEmail, cleared by signals when these emails change.
+    """
+    email = email.lower()
+    try:
+        return MessageAuthorEmail.objects.select_related('author').get(email=email).author
+    except MessageAuthorEmail.DoesNotExist:
+        pass
+    # the addresses are kept as entered: only the index stores them lowercase
+    author = User.objects.filter(email__iexact=email).order_by('pk').first() \
+        or Participant.objects.filter(email__iexact=email).order_by('pk').first() \
+        or Conference.objects.filter(contact_email__iexact=email).order_by('pk').first()
+    if author is None:
+        raise Conference.DoesNotExist # this was last hope...
     author_type = ContentType.objects.get_for_model(author)
     author, _ = MessageAuthor.objects.get_or_create(author_type=author_type, author_id=author.pk)
+    MessageAuthorEmail.objects.get_or_create(email=email, defaults={'author': author})
+    return author
 
-    return in_reply_to, author
+
+def forget_email_authors(*emails):
+    MessageAuthorEmail.objects.filter(email__in=[email.lower() for email in emails if email]).delete()
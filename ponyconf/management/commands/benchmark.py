@@ -0,0 +1,326 @@
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+from django.utils import timezone
+
+from jinja2.sandbox import SandboxedEnvironment
+
+from email import policy
+from email.parser import BytesParser
+from collections import namedtuple
+from datetime import timedelta
+from functools import partial
+from random import Random
+from time import perf_counter, sleep
+import tracemalloc
+
+from cfp.conflicts import find_overlaps
+from cfp.environment import compile_template
+from cfp.factories import create_conference_data
+from cfp.models import Participant, Room, Talk, TalkCategory, Volunteer
+from cfp.planning import Grid, Program
+from mailing.fakeimap import FakeIMAPServer
+from mailing.models import Message, MessageAuthor, MessageThread
+from mailing.utils import fetch_imap_box
+
+
+# Query budgets of the staff views. The number of queries of a view must not
+# depend on the amount of data: the budgets are checked by the tests on a small
+# conference and by the views benchmark on a large one.
+# url name, url kwargs built from the site, maximum number of queries
+STAFF_VIEW_BUDGETS = [
+    ('staff', None, 5),
+    ('talk-list', None, 22),
+    ('talk-details', lambda site: {'talk_id': Talk.objects.filter(site=site).earliest('pk').pk}, 17),
+    ('participant-list', None, 10),
+    ('participant-details', lambda site: {'participant_id': Participant.objects.filter(site=site).earliest('pk').pk}, 12),
+    ('track-list', None, 6),
+    ('room-list', None, 6),
+    ('room-details', lambda site: {'slug': Room.objects.filter(site=site).earliest('pk').slug}, 9),
+    ('volunteer-list', None, 12),
+    ('volunteer-details', lambda site: {'volunteer_id': Volunteer.objects.filter(site=site).earliest('pk').pk}, 10),
+    ('staff-schedule', None, 14),
+    ('schedule-conflicts', None, 8),
+    ('category-list', None, 6),
+    ('tag-list', None, 6),
+    ('activity-list', None, 6),
+]
+
+
+Measure = namedtuple('Measure', ['name', 'url', 'status', 'queries', 'budget', 'seconds', 'peak_memory'])
+
+
+def measure_view(client, url):
+    """Request a view and return its status, queries, duration and peak memory allocation."""
+    tracemalloc.start()
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            t0 = perf_counter()
+            response = client.get(url)
+            if response.streaming:
+                b''.join(response.streaming_content)
+            t1 = perf_counter()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return response.status_code, list(queries), t1 - t0, peak_memory
+
+
+def measure_staff_views(client, site):
+    """Measure each staff view with a client logged in as a staff member."""
+    for name, kwargs, budget in STAFF_VIEW_BUDGETS:
+        url = reverse(name, kwargs=kwargs(site) if kwargs else None)
+        status, queries, seconds, peak_memory = measure_view(client, url)
+        yield Measure(name, url, status, queries, budget, seconds, peak_memory)
+
+
+def bench_schedule(command, count, **options):
+    rnd = Random(options['seed'])
+    category = TalkCategory(pk=1, name='Conference', duration=30)
+    rooms = [Room(pk=i, name='Room %d' % i) for i in range(1, 21)]
+    start = timezone.now().replace(hour=8, minute=0, second=0, microsecond=0)
+    talks = []
+    for pk in range(1, count + 1):
+        talks.append(Talk(
+            pk=pk,
+            category=category,
+            room=rnd.choice(rooms),
+            start_date=start + timedelta(days=rnd.randrange(5), minutes=5 * rnd.randrange(12 * 10)),
+            duration=rnd.choice([0, 15, 20, 30, 45, 60, 90]),
+        ))
+
+    # the steps of Program, which builds the grid on each request
+    grid = Grid()
+    t0 = perf_counter()
+    for talk in sorted(talks, key=Program._placement_order):
+        grid.add(talk)
+    t1 = perf_counter()
+    command.report('place %d talks' % count, t1 - t0)
+
+    t0 = perf_counter()
+    for day in grid.days:
+        grid.rows(day)
+    t1 = perf_counter()
+    command.report('build rows of %d days' % len(grid.days), t1 - t0)
+
+
+EMAIL_SUBJECT = "[{{ talk.category }}] {{ talk.title }}"
+EMAIL_BODY = """Hi {{ speaker.name }},
+
+{% if talk.accepted %}Your talk '{{ talk.title }}' has been accepted!
+It will take place on {{ talk.start_date }} ({{ talk.duration }} min) in the track {{ talk.track }}.
+{% for s in talk.speakers %}{% if s.name != speaker.name %}Co-speaker: {{ s.name }} <{{ s.email }}>
+{% endif %}{% endfor %}
+Please confirm: {{ talk.confirm_link }}
+{% else %}Your talk '{{ talk.title }}' has not been accepted.{% endif %}
+
+Thanks!
+"""
+
+
+def bench_emails(command, count, **options):
+    rnd = Random(options['seed'])
+    contexts = []
+    for i in range(count):
+        speaker = {'name': 'Speaker %d' % i, 'email': 'speaker%d@example.org' % i}
+        contexts.append({
+            'speaker': speaker,
+            'talk': {
+                'title': 'Talk %d' % i,
+                'category': 'Conference',
+                'accepted': rnd.random() < 0.5,
+                'start_date': timezone.now(),
+                'duration': 30,
+                'track': 'Track',
+                'speakers': [speaker, {'name': 'Co-speaker', 'email': 'co@example.org'}],
+                'confirm_link': 'https://example.org/cfp/%d/confirm/' % i,
+            },
+        })
+
+    t0 = perf_counter()
+    for context in contexts:
+        env = SandboxedEnvironment()
+        env.globals.update(context)
+        env.from_string(EMAIL_SUBJECT).render()
+        env.from_string(EMAIL_BODY).render()
+    t1 = perf_counter()
+    command.report('compile per recipient (%d)' % count, t1 - t0)
+
+    compile_template.cache_clear()
+    t0 = perf_counter()
+    subject, body = compile_template(EMAIL_SUBJECT), compile_template(EMAIL_BODY)
+    for context in contexts:
+        subject.render(context)
+        body.render(context)
+    t1 = perf_counter()
+    command.report('compile once (%d)' % count, t1 - t0)
+
+
+def parse_email(raw_email, delay=0):
+    msg = BytesParser(policy=policy.default).parsebytes(raw_email)
+    msg.get_body(preferencelist=['plain']).get_payload(decode=True)
+    # stands for the database round-trips of process_email
+    sleep(delay)
+
+
+def bench_imap(command, count, **options):
+    rnd = Random(options['seed'])
+    emails = []
+    for i in range(count):
+        emails.append(('From: speaker%d@example.org\r\n'
+                       'To: reply+%s@example.org\r\n'
+                       'Subject: Re: Talk %d\r\n'
+                       'Content-Type: text/plain; charset=utf-8\r\n'
+                       '\r\n'
+                       '%s\r\n' % (i, 'a' * 80, i, 'Some reply. ' * rnd.randrange(10, 200))).encode('utf-8'))
+    # simulated round-trip time of each IMAP command and database access
+    delay = options['latency'] / 1000
+    for label, batch_size, workers in [('one email per command', 1, 1),
+                                       ('batches of 100', 100, 1),
+                                       ('batches of 100, 4 workers', 100, 4)]:
+        with FakeIMAPServer(delay=delay) as server:
+            for email in emails:
+                server.mailboxes['INBOX'].append(email)
+            t0 = perf_counter()
+            fetch_imap_box('user', 'password', '127.0.0.1', port=server.port, use_ssl=False,
+                           batch_size=batch_size, workers=workers, process=partial(parse_email, delay=delay))
+            t1 = perf_counter()
+        command.report('%s (%d)' % (label, count), t1 - t0)
+
+
+def bench_tokens(command, count, **options):
+    rnd = Random(options['seed'])
+    alphabet = 'abcdefghijklmnopqrstuvwxyz0123456789'
+    lookups = 200
+    thread = MessageThread.objects.create()
+    author = MessageAuthor.objects.create()
+    tokens = []
+    t0 = perf_counter()
+    for i in range(0, count, 10000):
+        messages = [Message(thread=thread, author=author, token=''.join(rnd.choices(alphabet, k=32)))
+                    for _ in range(min(10000, count - i))]
+        Message.objects.bulk_create(messages)
+        tokens += [message.token for message in rnd.sample(messages, min(len(messages), lookups))]
+    t1 = perf_counter()
+    command.report('create %d messages' % count, t1 - t0)
+    tokens = [token.upper() for token in rnd.sample(tokens, min(len(tokens), lookups))]
+
+    t0 = perf_counter()
+    for token in tokens:
+        Message.objects.get(token__iexact=token)
+    t1 = perf_counter()
+    command.report('iexact lookup (per email)', (t1 - t0) / len(tokens))
+
+    t0 = perf_counter()
+    for token in tokens:
+        Message.objects.get(token=token.lower())
+    t1 = perf_counter()
+    command.report('normalized exact lookup (per email)', (t1 - t0) / len(tokens))
+
+
+def bench_views(command, count, **options):
+    setup_test_environment()
+    try:
+        site = Site.objects.get_current()
+        t0 = perf_counter()
+        users = create_conference_data(site, talks=count, seed=options['seed'])
+        t1 = perf_counter()
+        command.report('create %d talks' % count, t1 - t0)
+        client = Client()
+        client.force_login(users[0])
+        over_budget = []
+        for measure in measure_staff_views(client, site):
+            command.report('%s (%d queries, %d KiB)' % (measure.name, len(measure.queries), measure.peak_memory // 1024),
+                           measure.seconds)
+            if measure.status != 200 or len(measure.queries) > measure.budget:
+                over_budget.append('%s: status %d, %d queries (budget: %d)'
+                                   % (measure.name, measure.status, len(measure.queries), measure.budget))
+    finally:
+        teardown_test_environment()
+    if over_budget:
+        raise CommandError('Views over budget:\n' + '\n'.join(over_budget))
+
+
+def bench_conflicts(command, count, **options):
+    rnd = Random(options['seed'])
+    start = timezone.now().replace(hour=8, minute=0, second=0, microsecond=0)
+    # talks one after the other in each room, a few of them starting too early
+    rooms = dict()
+    for pk in range(count):
+        intervals = rooms.setdefault(rnd.randrange(20), [])
+        talk_start = intervals[-1][1] + timedelta(minutes=5) if intervals else start
+        if rnd.random() < 0.02:
+            talk_start -= timedelta(minutes=15)
+        intervals.append((talk_start, talk_start + timedelta(minutes=rnd.choice([15, 30, 60])), pk))
+
+    t0 = perf_counter()
+    naive = set()
+    for intervals in rooms.values():
+        for i, (start1, end1, pk1) in enumerate(intervals):
+            for start2, end2, pk2 in intervals[i + 1:]:
+                if start1 < end2 and start2 < end1:
+                    naive.add(frozenset([pk1, pk2]))
+    t1 = perf_counter()
+    command.report('pairwise comparison (%d talks)' % count, t1 - t0)
+
+    t0 = perf_counter()
+    swept = set()
+    for intervals in rooms.values():
+        swept.update(frozenset(pair) for pair in find_overlaps(intervals))
+    t1 = perf_counter()
+    command.report('sweep line (%d conflicts)' % len(swept), t1 - t0)
+    assert swept == naive
+
+
+# name: (function, default count, uses the database)
+BENCHMARKS = {
+    'schedule': (bench_schedule, 5000, False),
+    'emails': (bench_emails, 1000, False),
+    'imap': (bench_imap, 1000, False),
+    'tokens': (bench_tokens, 1000000, True),
+    'views': (bench_views, 2000, True),
+    'conflicts': (bench_conflicts, 5000, False),
+}
+
+
+# The synthetic data is written to a test database created for the run, and
+# the signals write the conference and schedule entries to local caches, so
+# the configured database and caches are never touched.
+def benchmark_caches():
+    return {alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmark-%s' % alias}
+            for alias in settings.CACHES}
+
+
+class Command(BaseCommand):
+    help = 'Run performance benchmarks on synthetic data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+        parser.add_argument('--count', type=int, help='Size of the synthetic data set')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--latency', type=float, default=1, help='Simulated IMAP and database latency in ms (imap benchmark)')
+        parser.add_argument('--noinput', '--no-input', action='store_false', dest='interactive',
+                            help='Destroy an existing test database without asking')
+
+    def report(self, label, seconds):
+        self.stdout.write('%-40s %10.3f ms' % (label, seconds * 1000))
+
+    def handle(self, *args, **options):
+        func, default_count, uses_database = BENCHMARKS[options['benchmark']]
+        count = options.pop('count') or default_count
+        if not uses_database:
+            func(self, count, **options)
+            return
+        old_name = connection.settings_dict['NAME']
+        if connection.settings_dict['TEST']['NAME'] == old_name:
+            raise CommandError('The %s benchmark needs a test database distinct from the configured one.' % options['benchmark'])
+        connection.creation.create_test_db(verbosity=0, autoclobber=not options['interactive'], serialize=False)
+        try:
+            with override_settings(CACHES=benchmark_caches()):
+                func(self, count, **options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
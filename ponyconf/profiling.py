@@ -0,0 +1,178 @@
+"""
+Opt-in request profiling. Add 'ponyconf.profiling.ProfilingMiddleware' to
+MIDDLEWARE to record, for a sample of the requests (PROFILING_SAMPLE_RATE,
+between 0 and 1), the time spent in the database, the templates and the
+sections marked with @profiled (schedule, markdown, mail). The last
+PROFILING_BUFFER_SIZE profiles are kept in memory by each worker process, and
+are summarized in the Prometheus text format by render_metrics().
+
+Sections may be nested: the queries run while rendering a template are
+counted in both.
+"""
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from collections import Counter, defaultdict, deque
+from contextlib import ExitStack
+from functools import wraps
+from random import random
+from time import perf_counter, time
+import threading
+
+
+_local = threading.local()
+_lock = threading.Lock()
+
+profiles = deque(maxlen=1000)
+profile_totals = defaultdict(Counter)
+
+SECTIONS = ['db', 'template', 'schedule', 'markdown', 'mail']
+
+
+def get_profile():
+    """Return the profile of the current request, or None if it is not sampled."""
+    return getattr(_local, 'profile', None)
+
+
+def profiled(section):
+    """
+    Decorator adding the duration of each call to the profile of the current
+    request. The calls nested in a call of the same section are not counted.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            profile = get_profile()
+            if profile is None or section in _local.sections:
+                return func(*args, **kwargs)
+            _local.sections.add(section)
+            t0 = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile['%s_seconds' % section] += perf_counter() - t0
+                profile['%s_calls' % section] += 1
+                _local.sections.discard(section)
+        return wrapped
+    return decorator
+
+
+def _time_query(profile):
+    def wrapper(execute, sql, params, many, context):
+        t0 = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            profile['db_seconds'] += perf_counter() - t0
+            profile['db_calls'] += 1
+    return wrapper
+
+
+def _instrument_templates():
+    # the included templates go through the engine, not the backend, but the
+    # form widgets are rendered with the backend
+    from django.template.backends.django import Template
+    if not getattr(Template.render, 'profiled', False):
+        Template.render = profiled('template')(Template.render)
+        Template.render.profiled = True
+
+
+def record_profile(view, status, seconds, profile):
+    entry = dict(profile, view=view, status=status, seconds=seconds, time=time())
+    with _lock:
+        profiles.append(entry)
+        totals = profile_totals[view]
+        totals['requests'] += 1
+        totals['seconds'] += seconds
+        totals.update(profile)
+
+
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        global profiles
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 1)
+        if not self.sample_rate:
+            raise MiddlewareNotUsed
+        buffer_size = getattr(settings, 'PROFILING_BUFFER_SIZE', 1000)
+        if profiles.maxlen != buffer_size:
+            with _lock:
+                profiles = deque(profiles, maxlen=buffer_size)
+        _instrument_templates()
+
+    def __call__(self, request):
+        if random() >= self.sample_rate:
+            return self.get_response(request)
+        profile = _local.profile = Counter()
+        _local.sections = set()
+        t0 = perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(_time_query(profile)))
+                response = self.get_response(request)
+        finally:
+            _local.profile = None
+        # the content of streaming responses is produced after this point
+        seconds = perf_counter() - t0
+        match = request.resolver_match
+        record_profile((match.url_name or match.view_name) if match else '', response.status_code, seconds, profile)
+        return response
+
+
+def _quantile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _label(value):
+    return '"%s"' % str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_metrics(counters=None):
+    """
+    Return the totals of the sampled requests of this process, and the
+    quantiles of their duration over the profiles in the buffer, in the
+    Prometheus text format. `counters` maps names to other Counter objects
+    to export, like the cache statistics.
+    """
+    with _lock:
+        totals = {view: totals.copy() for view, totals in profile_totals.items()}
+        durations = defaultdict(list)
+        for entry in profiles:
+            durations[entry['view']].append(entry['seconds'])
+    lines = [
+        '# HELP ponyconf_requests_total Number of profiled requests.',
+        '# TYPE ponyconf_requests_total counter',
+    ]
+    lines += ['ponyconf_requests_total{view=%s} %d' % (_label(view), t['requests']) for view, t in sorted(totals.items())]
+    lines += [
+        '# HELP ponyconf_request_seconds_total Time spent in the profiled requests.',
+        '# TYPE ponyconf_request_seconds_total counter',
+    ]
+    lines += ['ponyconf_request_seconds_total{view=%s} %f' % (_label(view), t['seconds']) for view, t in sorted(totals.items())]
+    for kind, help_text in [('seconds', 'Time spent in each section of the profiled requests.'),
+                            ('calls', 'Number of calls to each section (queries for db) in the profiled requests.')]:
+        lines += [
+            '# HELP ponyconf_section_%s_total %s' % (kind, help_text),
+            '# TYPE ponyconf_section_%s_total counter' % kind,
+        ]
+        for view, t in sorted(totals.items()):
+            for section in SECTIONS:
+                lines.append('ponyconf_section_%s_total{view=%s,section=%s} %s'
+                             % (kind, _label(view), _label(section), t['%s_%s' % (section, kind)]))
+    lines += [
+        '# HELP ponyconf_recent_request_seconds Duration of the last profiled requests.',
+        '# TYPE ponyconf_recent_request_seconds summary',
+    ]
+    for view, values in sorted(durations.items()):
+        values.sort()
+        for q in [0.5, 0.9, 0.99]:
+            lines.append('ponyconf_recent_request_seconds{view=%s,quantile="%s"} %f' % (_label(view), q, _quantile(values, q)))
+        lines.append('ponyconf_recent_request_seconds_sum{view=%s} %f' % (_label(view), sum(values)))
+        lines.append('ponyconf_recent_request_seconds_count{view=%s} %d' % (_label(view), len(values)))
+    for name, counter in sorted((counters or {}).items()):
+        lines += ['# TYPE ponyconf_%s_total counter' % name]
+        lines += ['ponyconf_%s_total{result=%s} %d' % (name, _label(key), value) for key, value in sorted(counter.items())]
+    return '\n'.join(lines) + '\n'
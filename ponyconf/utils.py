@@ -1,10 +1,17 @@
 from django.contrib.sites.shortcuts import get_current_site
+from django.core.cache import cache
 from django.db import models
 from django.utils.html import mark_safe
 
 from markdown import markdown
 import bleach
 
+from collections import Counter, OrderedDict
+from hashlib import sha256
+import threading
+
+from .profiling import profiled
+
 
 class PonyConfModel(models.Model):
     created = models.DateTimeField(auto_now_add=True)
@@ -14,8 +21,64 @@ class PonyConfModel(models.Model):
         abstract = True
 
 
-def markdown_to_html(md):
+class CounterFieldsMixin:
+    """
+    Model mixin for the fields maintained in database by signals (counter_fields):
+    they are never written back by the update of a possibly outdated instance.
+    """
+    counter_fields = ()
+
+    def save(self, *args, **kwargs):
+        if kwargs.get('update_fields') is None and not self._state.adding and not kwargs.get('force_insert'):
+            # like Model.save(), only the loaded fields are updated
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.attname not in deferred
+                                       and field.name not in self.counter_fields]
+        super().save(*args, **kwargs)
+
+
+# Rendered markdown is cached by content hash, first in a small process-local
+# LRU, then in the shared cache. Bump the version when the rendering changes.
+MARKDOWN_CACHE_VERSION = 1
+MARKDOWN_CACHE_SIZE = 256
+MARKDOWN_CACHE_MAX_LENGTH = 64 * 1024
+MARKDOWN_CACHE_TIMEOUT = 24 * 60 * 60
+
+_markdown_cache = OrderedDict()
+_markdown_cache_lock = threading.Lock()
+
+markdown_cache_stats = Counter(local_hits=0, shared_hits=0, misses=0, uncached=0)
+
+
+def render_markdown(md):
     html = markdown(md)
     allowed_tags = bleach.ALLOWED_TAGS + ['p', 'pre', 'span' ] + ['h%d' % i for i in range(1, 7) ]
-    html = bleach.clean(html, tags=allowed_tags)
+    return bleach.clean(html, tags=allowed_tags)
+
+
+@profiled('markdown')
+def markdown_to_html(md):
+    if not md or len(md) > MARKDOWN_CACHE_MAX_LENGTH:
+        markdown_cache_stats['uncached'] += 1
+        return mark_safe(render_markdown(md))
+    key = 'ponyconf-markdown-%d-%s' % (MARKDOWN_CACHE_VERSION, sha256(md.encode('utf-8')).hexdigest())
+    with _markdown_cache_lock:
+        html = _markdown_cache.get(key)
+        if html is not None:
+            _markdown_cache.move_to_end(key)
+    if html is not None:
+        markdown_cache_stats['local_hits'] += 1
+    else:
+        html = cache.get(key)
+        if html is None:
+            markdown_cache_stats['misses'] += 1
+            html = render_markdown(md)
+            cache.set(key, html, MARKDOWN_CACHE_TIMEOUT)
+        else:
+            markdown_cache_stats['shared_hits'] += 1
+        with _markdown_cache_lock:
+            _markdown_cache[key] = html
+            while len(_markdown_cache) > MARKDOWN_CACHE_SIZE:
+                _markdown_cache.popitem(last=False)
     return mark_safe(html)